@@ -1,3 +1,3 @@
 #! /bin/bash
 
-poetry export -f requirements.txt --output requirements.txt
+poetry export -f requirements.txt --output requirements.txt -E loadtest -E analyzer -E asgi
@@ -1,6 +1,16 @@
-var socket = io();
-let hasEverRun = false;
+// The reconnect delay is randomized, so pages that lost their connection at
+// the same time (e.g. on a restart) don't come back at the same time
+var socket = io({
+    reconnectionDelay: reconnectDelay * 1000,
+    reconnectionDelayMax: reconnectDelayMax * 1000,
+    randomizationFactor: 0.5,
+});
+let hasEverRun = initialState !== null && initialState.stream !== null && initialState.stream.active;
 let player = null;
+// Updates older than the state the page was rendered with are ignored
+let stateVersion = initialState !== null ? initialState.version : -1;
+let connectedBefore = false;
+let refusals = 0;
 
 // Extract foobar from the .stream-foobar key of an element
 function extractStreamKey(e) {
@@ -11,6 +21,16 @@ function extractStreamKey(e) {
   }
 }
 
+// Turn the compact {"fields": [...], "streams": [[...], ...]} list sent by the
+// server into a list of stream objects
+function decodeStreamList(list) {
+  return list.streams.map(row => {
+    let stream = {};
+    list.fields.forEach((field, i) => stream[field] = row[i]);
+    return stream;
+  });
+}
+
 // Get the streamkey from the current page
 function getStreamKey() {
     let stream = document.getElementById("stream");
@@ -22,33 +42,71 @@ function hasStream(streamlist, k) {
   return streamlist.some(({ key }) => key === k);
 }
 
-// Returns the Stream from the streamlist
-function getStream(streamlist, k) {
-  return streamlist.find(({ key }) => key === k);
-}
-
 // Send a message to the server when the socket is established
 socket.on('connect', function() {
+    refusals = 0;
+    // Streams of other federation origins are not known to this server
+    if (streamOrigin !== null) {
+        return;
+    }
     let key = getStreamKey()
-    socket.emit('join', {"key" : key});
-    // Ask about the state of the stream
-    socket.emit('stream_info', {"key" : key});
+    // The server answers with the stream info if the stream list changed
+    // since the state of the page (something may have been missed since the
+    // page was rendered or the connection was lost). After a reconnect the
+    // server may have been restarted, its versions start over then
+    if (connectedBefore) {
+        stateVersion = -1;
+    }
+    socket.emit('join', {"key" : key, "version": stateVersion});
+    connectedBefore = true;
 });
 
-// After initial connect, receive a streamlist
-socket.on('stream_info', function(data) {
-    var stream = JSON.parse(data)
-    updateStream(stream, "update");
+// The server paces new sessions. A refused page is told when to try again,
+// without that hint it backs off like a reconnect. socket.io doesn't
+// reconnect by itself after a refusal, so the page always tries again (while
+// socket.io reconnects after a lost connection, connect() does nothing)
+socket.on('connect_error', function(error) {
+    let retryAfter = error.data && error.data.retry_after;
+    if (!retryAfter) {
+        retryAfter = Math.min(reconnectDelayMax, reconnectDelay * 2 ** refusals) * (1 + Math.random() * 0.5);
+    }
+    refusals++;
+    console.log("Connection failed (" + error.message + "), retrying in " + retryAfter.toFixed(1) + " s");
+    setTimeout(() => {
+        if (!socket.connected) {
+            socket.connect();
+        }
+    }, retryAfter * 1000);
+});
+
+// All fields of the stream, sent on request (the list only carries a few)
+socket.on('stream_info', function(stream) {
+    if (stream.key !== getStreamKey()) {
+        return;
+    }
+    stateVersion = Math.max(stateVersion, stream.version);
+    if (stream.active && document.body.classList.contains("inactive")) {
+        updateStream(stream, "added");
+    } else {
+        updateStream(stream, "update");
+    }
 });
 
 // Send a message to the server when the socket is established
 socket.on('disconnect', function() {
+    // Pages of other federation origins never joined
+    if (streamOrigin !== null) {
+        return;
+    }
     let key = getStreamKey()
     socket.emit('leave', {"key" : key});
 });
 
 // Send a leave message to the server before unloading the page
 window.onbeforeunload = function(event) {
+    if (streamOrigin !== null) {
+        return;
+    }
     let key = getStreamKey()
     socket.emit('leave', {"key" : key});
     console.log("Sent leave message");
@@ -59,30 +117,84 @@ socket.on('viewercount', function(viewercount) {
     updateViewCount(viewercount);
 });
 
-// New streamlist arrives here when webserver gets notivied of an stream addition
-socket.on('stream_added', function(data) {
-    console.log('Stream ' + data['key'] + ' added.');
-    var streamlist = JSON.parse(data["list"])
-    let streamkey = getStreamKey();
-    if (hasStream(streamlist, streamkey)) {
-        let stream = getStream(streamlist, streamkey);
-        updateStream(stream, "added");
-    }else{
-        console.log("..but "+streamkey+" was not in streamlist");
-        console.log(streamlist);
+// New streamlist arrives here when webserver gets notified of stream additions
+// or removals (changes within a short time arrive together)
+socket.on('streams_changed', function(data) {
+    if (data['version'] <= stateVersion) {
+        return;
     }
-});
-
-// New streamlist arrives here when webserver gets notivied of a stream removal
-socket.on('stream_removed', function(data) {
-    console.log('Stream ' + data['key'] + ' removed.');
+    stateVersion = data['version'];
     let streamkey = getStreamKey();
-    if (streamkey == data['key']) {
+    if (data['added'].includes(streamkey)) {
+        console.log('Stream ' + streamkey + ' added.');
+        var streamlist = decodeStreamList(data["list"])
+        if (hasStream(streamlist, streamkey)) {
+            // The description and the rest arrive with the stream info
+            socket.emit('stream_info', {"key" : streamkey});
+        }else{
+            console.log("..but "+streamkey+" was not in streamlist");
+            console.log(streamlist);
+        }
+    } else if (data['removed'].includes(streamkey)) {
+        console.log('Stream ' + streamkey + ' removed.');
         updateStream(streamkey, "removed");
     }
 });
 
 
+// A fraction of the players reports its distance to the live edge and its
+// stalls. Ten samples are taken per report interval and sent as one report
+let reportsLatency = streamOrigin === null && Math.random() < latencyReportRate;
+let latencySamples = [];
+let stalls = 0;
+let playedSeconds = 0;
+
+function sampleLatency() {
+    // A recording has no live edge
+    if (player === null || player.paused() || !player.liveTracker || archiveUrl !== null) {
+        return;
+    }
+    playedSeconds += latencyReportInterval / 10;
+    let edge = player.liveTracker.liveCurrentTime();
+    let current = player.currentTime();
+    if (isFinite(edge) && isFinite(current)) {
+        latencySamples.push(Math.max(0, edge - current));
+    }
+}
+
+function sendLatencyReport() {
+    if (latencySamples.length > 0 || stalls > 0) {
+        socket.emit('latency_report', {"key": getStreamKey(), "samples": latencySamples, "stalls": stalls, "seconds": playedSeconds});
+    }
+    latencySamples = [];
+    stalls = 0;
+    playedSeconds = 0;
+}
+
+if (reportsLatency) {
+    setInterval(sampleLatency, latencyReportInterval * 100);
+    setInterval(sendLatencyReport, latencyReportInterval * 1000);
+}
+
+
+// Show the viewcount of the initial state until the server sends one, this
+// viewer is about to join
+if (initialState !== null && initialState.stream !== null) {
+    updateViewCount({"count": initialState.stream.viewcount + 1});
+}
+
+
+// Record the seconds from the start of the page load to the first frame
+function reportFirstFrame() {
+    let seconds = performance.now() / 1000;
+    console.log("First frame after " + seconds.toFixed(2) + " s");
+    // Only the first frames of live streams are of interest
+    if (streamOrigin === null && archiveUrl === null) {
+        socket.emit('first_frame', {"key": getStreamKey(), "seconds": seconds});
+    }
+}
+
+
 // Update the count of viewers
 function updateViewCount(viewercount) {
     if (document.getElementById("viewcount") !== null) { 
@@ -170,10 +282,12 @@ function activateStream(stream) {
     document.body.classList.remove("not-started");
     document.body.classList.remove("stopped");
 
-    // Remove div placeholder
+    // Remove div placeholder (or the player of a recording)
     if (document.getElementById("stream") !== null) { 
       document.querySelectorAll('#stream').forEach(e => e.remove());
     }
+    document.querySelectorAll('#archive-notice').forEach(e => e.remove());
+    archiveUrl = null;
 
     // TODO: Add description, ...
     addPlayer(stream.key);
@@ -213,6 +327,7 @@ function buildDescriptionBlock() {
 window.onload = function() {
     if (!document.body.classList.contains("inactive")){
         player = initializePlayer();
+        player.one('playing', reportFirstFrame);
     }
     // Run this block with a delay
     setTimeout(function() { 
@@ -265,7 +380,7 @@ function addPlayer(streamkey) {
     videojs.toggleAttribute('controls'); 
 
     let source = document.createElement("source");
-    source.src = "../hls/"+streamkey+".m3u8";
+    source.src = hlsUrl+"/"+streamkey+".m3u8";
     source.type = "application/x-mpegURL"
 
     videojs.prepend(source);
@@ -306,6 +421,13 @@ function initializePlayer() {
         displayMuteifNeeded(player);
     });
 
+    // Waiting for data after playback started is a stall
+    player.on("waiting", function(){
+        if (player.hasStarted()) {
+            stalls += 1;
+        }
+    });
+
     // player.on('error', () => {
     //     player.createModal('Retrying connection');
     //     if (player.error().code === 4) {
@@ -1,37 +1,91 @@
-var socket = io();
+// Server-sent events with the stream list: the current list on connect, then
+// a new one when the webserver gets notified of stream additions or removals
+// (changes within a short time arrive together), viewcounts included. The
+// browser reconnects by itself and only receives what it missed. Only while
+// the events are not connected the list is polled page by page instead. Called
+// by streams.html (but not by the benchmark page)
+function connectStreamList() {
+  let events = new EventSource("/events/streams");
 
+  events.addEventListener('streams', function(e) {
+    let data = JSON.parse(e.data);
+    console.log('Streams added: [' + data['added'] + '], removed: [' + data['removed'] + ']');
+    let streamlist = decodeStreamList(data["list"])
+    updateStreamList(streamlist);
+  });
 
-// Send a message to the server when the socket is established
-socket.on('connect', function() {
-    socket.emit('connect_list');
-});
+  setInterval(function() {
+    if (events.readyState !== EventSource.OPEN) {
+      fetchStreamList();
+    }
+    fetchRemoteStreamList();
+  }, 4000)
+}
 
-// After initial connect, receive a streamlist
-socket.on('stream_list', function(data) {
-    var streamlist = JSON.parse(data["list"])
-    updateStreamList(streamlist);
-});
 
-// New streamlist arrives here when webserver gets notivied of an stream addition
-socket.on('stream_added', function(data) {
-    console.log('Stream ' + data['key'] + ' added.');
-    var streamlist = JSON.parse(data["list"])
-    updateStreamList(streamlist);
-});
+// Fetch the streams of the other federation origins and replace the list of
+// remote streams with them (only rendered if federation is enabled)
+async function fetchRemoteStreamList() {
+  let remote = document.querySelector("#remote_streamlist");
+  if (!remote) {
+    return;
+  }
+  let response = await fetch("/api/origins");
+  if (!response.ok) {
+    return;
+  }
+  let data = await response.json();
+  let items = data.streams.map(stream => {
+    let li = document.createElement("li");
+    li.classList.add("remote_stream", "origin-"+stream.origin, "stream-"+stream.key);
+    let a = document.createElement("a");
+    a.href = "origins/"+stream.origin+"/streams/"+stream.key;
+    a.textContent = stream.key;
+    let span = document.createElement("span");
+    span.classList.add("origin");
+    span.textContent = stream.origin;
+    li.append(a, span);
+    return li;
+  });
+  remote.replaceChildren(...items);
+}
 
-// New streamlist arrives here when webserver gets notivied of a stream removal
-socket.on('stream_removed', function(data) {
-    console.log('Stream ' + data['key'] + ' removed.');
-    var streamlist = JSON.parse(data["list"])
-    updateStreamList(streamlist);
-});
 
+// Fetch the listed streams page by page from /api/streams. New streams and
+// viewcounts are rendered as soon as their page arrives, streams that ended
+// are only removed once the last page is in
+async function fetchStreamList() {
+  let streamlist = [];
+  let cursor = null;
+  do {
+    let url = "/api/streams?sort=started&limit=100&projection=list";
+    if (cursor !== null) {
+      url += "&cursor=" + encodeURIComponent(cursor);
+    }
+    let response = await fetch(url);
+    if (!response.ok) {
+      return;
+    }
+    let page = await response.json();
+    streamlist.push(...page.streams);
+    updateStreamPage(page.streams);
+    cursor = page.cursor;
+  } while (cursor !== null);
+  updateStreamList(streamlist);
+}
 
-setInterval(function() {
-    socket.emit("stream_list");
-}, 4000)
 
 
+// Turn the compact {"fields": [...], "streams": [[...], ...]} list sent by the
+// server into a list of stream objects
+function decodeStreamList(list) {
+  return list.streams.map(row => {
+    let stream = {};
+    list.fields.forEach((field, i) => stream[field] = row[i]);
+    return stream;
+  });
+}
+
 
 // Extract foobar from the .stream-foobar key of an element
 function extractStreamKey(e) {
@@ -43,144 +97,192 @@ function extractStreamKey(e) {
 }
 
 
-// Returns true if the key k is in the streamlist
-function hasStream(streamlist, k) {
-  return streamlist.some(({ key }) => key === k);
+// The <li> of every stream in the #streamlist by key, built from the server
+// rendered list on first use. Updates are diffed against this Map instead of
+// searching the DOM, so an update costs O(n) for n streams
+let streamElements = null;
+
+// Updates waiting for the next animation frame, each {streamlist, complete}
+// where complete is false for a single page of the list
+let pendingUpdates = [];
+let renderRequested = false;
+
+
+function getStreamElements(streams) {
+  if (streamElements === null) {
+    streamElements = new Map();
+    for (const li of streams.querySelectorAll('.active_stream')) {
+      streamElements.set(extractStreamKey(li), li);
+    }
+  }
+  return streamElements;
+}
+
+
+// Count the streams which are not on their way out
+function countStreams(elements) {
+  let count = 0;
+  for (const li of elements.values()) {
+    if (!li.classList.contains('inactive_stream')) {
+      count++;
+    }
+  }
+  return count;
 }
 
 
 // Update the count of streams displayed
-function updateStreamCount(streams) {
-  let existingStreams = Array.from(streams.querySelectorAll('.active_stream')).map(e => extractStreamKey(e))
-  // Update the streamcount in the title
-  if (document.getElementById("streamheader") !== null) { 
-    document.getElementById("streamheader").textContent = "Active Streams [" + existingStreams.length + "]";
+function updateStreamCount(count) {
+  let header = document.getElementById("streamheader");
+  if (header !== null) {
+    let text = "Active Streams [" + count + "]";
+    if (header.textContent !== text) {
+      header.textContent = text;
+    }
   }
 }
 
 
 // Remove/Add the "no streams" message if the streamcount is zero or > zero
-function updateNoStreamsMessage(streams) {
-  // Add or remove the notification "There are currently no active streams" based on the streamcount
-  let existingStreams = Array.from(streams.querySelectorAll('.active_stream')).map(e => extractStreamKey(e))
-  if (existingStreams.length > 0) {
-    // If there are streams remove the "no streams"-message
-    if (document.getElementById("no-stream-notice") !== null) { 
-      document.querySelectorAll('#no-stream-notice').forEach(e => e.remove());
-    }
-  }else{
-    if (document.getElementById("no-stream-notice") !== null) { 
-      // Make dead sure the notice doesn't exist yet
-      document.querySelectorAll('#no-stream-notice').forEach(e => e.remove());
-      // If there are no streams add a message
-      let h2 = document.createElement("h2");
-      h2.textContent = "There are currently no active streams"
-      h2.id = "no-stream-notice";
-      streams.appendChild(h2);
+function updateNoStreamsMessage(streams, count) {
+  let notice = document.getElementById("no-stream-notice");
+  if (count > 0 && notice !== null) {
+    notice.remove();
+  } else if (count === 0 && notice === null) {
+    let h2 = document.createElement("h2");
+    h2.textContent = "There are currently no active streams"
+    h2.id = "no-stream-notice";
+    streams.appendChild(h2);
+  }
+}
+
+
+function createStreamElement(stream) {
+  let li = document.createElement("li");
+  li.classList.add("active_stream");
+  li.classList.add("stream-"+stream.key);
+  // TODO: Add password and description classes
+  let a = document.createElement("a");
+  a.href = "streams/"+stream.key;
+  a.textContent = stream.key;
+  li.appendChild(a);
+  return li;
+}
+
+
+// Show the viewcount next to the stream, only touches the DOM if it changed
+function updateViewcount(li, viewcount) {
+  if (li.viewcount === viewcount) {
+    return;
+  }
+  li.viewcount = viewcount;
+  let div = li.querySelector(".viewcount");
+  if (viewcount == 0) {
+    if (div !== null) {
+      div.remove();
     }
+  } else if (div === null) {
+    let p = document.createElement("p");
+    div = document.createElement("div");
+    div.classList.add("viewcount");
+    let img = document.createElement("img");
+    img.src = "/static/eye.svg";
+    p.textContent = viewcount;
+    div.appendChild(img);
+    div.appendChild(p);
+    li.appendChild(div);
+  } else {
+    div.querySelector("p").textContent = viewcount;
   }
 }
 
-// Mark inactive streams with the .inactive_stream class (animating it's removal)
-// Elements with the class .inactive_stream get removed after the transition is
-// over by thecallback added by removeAfterAnimation()
-function markInaktiveStreams(active_streams, streamlist) {
-  // Mark inactive streams with the .inactive_stream class (animating it's removal)
-  active_streams.forEach(e => {
-    let key = extractStreamKey(e);
-    if (!hasStream(streamlist, key)) {
-      // Add a removal class to the stream (so the animation starts playing) 
-      e.classList.add('inactive_stream');
+
+// Mark a stream with the .inactive_stream class (animating its removal) and
+// remove it once the transition is over
+function removeStreamElement(elements, key, li) {
+  li.classList.add('inactive_stream');
+  li.addEventListener('transitionend', function onTransitionEnd(e) {
+    if (e.target !== li) {
+      return;
+    }
+    li.removeEventListener('transitionend', onTransitionEnd);
+    // The stream may have come back while it was animated
+    if (li.classList.contains('inactive_stream') && elements.get(key) === li) {
+      elements.delete(key);
+      li.remove();
     }
   });
 }
 
-// Add new streams to the ul #streamlist
-function addNewStreams(streams, streamlist) {
-  // Add all streams from the streamlist that dont exist yet
-  let existingStreams = [...streams.querySelectorAll('.active_stream')].map(e => extractStreamKey(e))
+
+// Add new streams and update the viewcounts of the known ones. If the list is
+// complete, streams that are not in it anymore get removed
+function renderStreams(streams, streamlist, complete) {
+  let elements = getStreamElements(streams);
+  let seen = new Set();
+  let added = document.createDocumentFragment();
   for (const stream of streamlist) {
-    if (!existingStreams.includes(stream.key)) {
-      // console.log("Streamlist had key "+stream.key+" so it was added");
-      let li = document.createElement("li");
-      li.classList.add("active_stream");
-      li.classList.add("stream-"+stream.key);
-      // TODO: Add password and description classes
-      let a = document.createElement("a");
-      a.href = "streams/"+stream.key;
-      a.textContent = stream.key;
-      li.appendChild(a);
-      streams.appendChild(li);
+    seen.add(stream.key);
+    let li = elements.get(stream.key);
+    if (li === undefined) {
+      li = createStreamElement(stream);
+      elements.set(stream.key, li);
+      added.appendChild(li);
+    } else if (li.classList.contains('inactive_stream')) {
+      li.classList.remove('inactive_stream');
     }
+    updateViewcount(li, stream.viewcount);
   }
-}
+  streams.appendChild(added);
 
-function updateViewcounts(streams, streamlist) {
-  let active_streams = streams.querySelectorAll('.active_stream');
-  for (const li of active_streams) {
-    let key = extractStreamKey(li);
-    let match = streamlist.find(stream => stream.key === key);
-    if (match === undefined) {
-      // Do nothing if stream gone
-    } else if (li.querySelector(".viewcount") == null && match.viewcount != 0) {
-      let p = document.createElement("p");
-      let div = document.createElement("div");
-      div.classList.add("viewcount");
-      let img = document.createElement("img");
-      img.src = "/static/eye.svg";
-      p.textContent = match.viewcount;
-      div.appendChild(img);
-      div.appendChild(p);
-      li.appendChild(div);
-    } else {
-      if (match.viewcount != 0) {
-        li.querySelector(".viewcount p").textContent = match.viewcount;
-      } else {
-        li.querySelectorAll('.viewcount').forEach(e => e.remove());
+  if (complete) {
+    for (const [key, li] of elements) {
+      if (!seen.has(key) && !li.classList.contains('inactive_stream')) {
+        removeStreamElement(elements, key, li);
       }
     }
   }
 }
 
 
-// Remove streams after animation played and update the streamcount
-function removeAfterAnimation(streams, active_streams) {
-  if (Array.from(active_streams).length > 0) {
-      [...active_streams].forEach(s => {
-        s.addEventListener('transitionend', function() {
-          this.remove();
-          updateStreamCount(streams);
-        });
-      });
-    }
+// Apply all pending updates at once. A complete list replaces everything that
+// arrived before it, so only the updates from the last complete list on are
+// rendered
+function renderStreamList() {
+  renderRequested = false;
+  let updates = pendingUpdates;
+  pendingUpdates = [];
+  let streams = document.querySelector("#streamlist");
+  if (!streams || updates.length === 0) {
+    return;
+  }
+  let last = updates.map(u => u.complete).lastIndexOf(true);
+  for (const update of updates.slice(Math.max(last, 0))) {
+    renderStreams(streams, update.streamlist, update.complete);
+  }
+  let count = countStreams(getStreamElements(streams));
+  updateNoStreamsMessage(streams, count);
+  updateStreamCount(count);
 }
 
 
-// Updates the list of streams on / or /streams via websockets
-function updateStreamList(streamlist) {
-  // Only do all of this if there is a #streamlist to begin with
-  if (document.querySelector("#streamlist")) {
-    // Get the location for the streamlist
-    let streams = document.querySelector("#streamlist");
-    let active_streams = streams.querySelectorAll('.active_stream');
-
-    // Mark inactive streams with the .inactive_stream class (animating it's removal)
-    markInaktiveStreams(active_streams, streamlist);
-
-    // Add new streams to the ul #streamlist
-    addNewStreams(streams, streamlist);
-
-    // Remove streams after animation played and update the streamcount
-    removeAfterAnimation(streams, active_streams);
+function scheduleRender(streamlist, complete) {
+  pendingUpdates.push({"streamlist": streamlist, "complete": complete});
+  if (!renderRequested) {
+    renderRequested = true;
+    requestAnimationFrame(renderStreamList);
+  }
+}
 
-    // Remove/Add the "no streams" message if the streamcount is zero or > zero
-    updateNoStreamsMessage(streams);
 
-    // Update the count of streams displayed
-    updateStreamCount(streams);
+// Adds the streams of a single page to the list and updates their viewcounts
+function updateStreamPage(page) {
+  scheduleRender(page, false);
+}
 
-    // Update the viewcounts next to the numbers
-    updateViewcounts(streams, streamlist);
-  }
 
+// Updates the list of streams on / or /streams, the DOM is changed with the
+// next animation frame
+function updateStreamList(streamlist) {
+  scheduleRender(streamlist, true);
 }
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import time
+import random
+from typing import Optional
+
+
+class SessionAdmission():
+    """
+    Paces the admission of new socket.io sessions with a token bucket, so a
+    restart (after which every open tab reconnects at once) doesn't build all
+    sessions in the same second.
+
+    Refused clients are told when to try again. The hints are consecutive
+    slots at the admission rate, so the refused clients come back spread out
+    instead of all at once again.
+
+    This uses a builder pattern, like the StreamList:
+    admission = SessionAdmission().set_rate(50).set_burst(200)
+    """
+    def __init__(self):
+        self.rate = 0.0
+        self.burst = 200.0
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.next_slot = 0.0
+        self.max_retry_after = 30.0
+        self.reconnect_delay = 1.0
+        self.reconnect_delay_max = 30.0
+        self.admitted = 0
+        self.refused = 0
+
+    def set_rate(self, sessions: float) -> 'SessionAdmission':
+        """
+        Set the new sessions admitted per second, 0 admits all of them
+        """
+        self.rate = max(0.0, float(sessions))
+        return self
+
+    def set_burst(self, sessions: int) -> 'SessionAdmission':
+        """
+        Set the number of sessions admitted at once before the rate applies
+        """
+        self.burst = max(1.0, float(sessions))
+        self.tokens = self.burst
+        return self
+
+    def set_reconnect_delay(self, seconds: float, max_seconds: float) -> 'SessionAdmission':
+        """
+        Set the delay before the first reconnect of a client and the maximum
+        its backoff grows to
+        """
+        self.reconnect_delay = float(seconds)
+        self.reconnect_delay_max = max(self.reconnect_delay, float(max_seconds))
+        return self
+
+    def admit(self, now: Optional[float]=None) -> Optional[float]:
+        """
+        Return None if a new session is admitted, otherwise the seconds after
+        which the client should try again
+        """
+        if self.rate == 0:
+            self.admitted += 1
+            return None
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.admitted += 1
+            return None
+
+        self.refused += 1
+        self.next_slot = max(self.next_slot, now) + 1 / self.rate
+        retry_after = self.next_slot - now
+        if retry_after > self.max_retry_after:
+            # More refused clients than slots within max_retry_after, they get
+            # a random one
+            self.next_slot = now + self.max_retry_after
+            return random.uniform(0.5, 1.0) * self.max_retry_after
+        return retry_after * random.uniform(1.0, 1.2)
+
+    def reconnect_hint(self) -> float:
+        """
+        Return the seconds a client should wait before it reconnects, spread
+        randomly so clients that lost their connection at the same time don't
+        come back at the same time
+        """
+        return self.reconnect_delay * random.uniform(1.0, 3.0)
+
+    def stats(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "refused": self.refused,
+            "tokens": self.tokens,
+        }
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Health analysis of the HLS segments nginx writes to the hls_path
+
+The newest MPEG-TS segments of each active stream are memory mapped and their
+packet headers and PES timestamps are scanned with numpy, nothing is decoded.
+From this the bitrate, the segment duration, the keyframe interval and the
+number of continuity errors are derived and attached to the Stream.
+
+Needs numpy (poetry install -E analyzer)
+"""
+import os
+import mmap
+import time
+from pathlib import Path
+from typing import Optional, List
+
+import numpy as np
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PTS_CLOCK = 90000
+
+
+def playlist_segments(playlist: Path) -> List[Path]:
+    """
+    Return the segments listed in a HLS playlist (oldest first), an empty list
+    if the playlist doesn't exist
+    """
+    try:
+        lines = playlist.read_text().splitlines()
+    except OSError:
+        return []
+    return [playlist.parent / l.strip() for l in lines if l.strip() and not l.startswith("#")]
+
+
+def packets(data: 'np.ndarray') -> 'np.ndarray':
+    """
+    Return the TS packets of data as an (n, 188) array, starting at the
+    first sync byte and dropping a trailing partial packet
+    """
+    start = int(np.argmax(data[:TS_PACKET_SIZE] == TS_SYNC_BYTE))
+    n = (len(data) - start) // TS_PACKET_SIZE
+    p = data[start:start + n * TS_PACKET_SIZE].reshape(n, TS_PACKET_SIZE)
+    # Drop packets that lost sync
+    return p[p[:, 0] == TS_SYNC_BYTE]
+
+
+def continuity_errors(pid: 'np.ndarray', cc: 'np.ndarray', has_payload: 'np.ndarray') -> int:
+    """
+    Count the packets whose continuity counter doesn't follow the previous
+    packet of the same PID (duplicate packets are allowed)
+    """
+    pid, cc = pid[has_payload], cc[has_payload]
+    order = np.argsort(pid, kind="stable")
+    pid, cc = pid[order], cc[order]
+    same_pid = pid[1:] == pid[:-1]
+    step = (cc[1:].astype(np.int16) - cc[:-1]) % 16
+    return int(np.count_nonzero(same_pid & (step != 1) & (step != 0)))
+
+
+def pes_timestamps(p: 'np.ndarray', payload_offset: 'np.ndarray') -> tuple:
+    """
+    Return the row indices, stream ids and PTS of all packets starting a PES
+    packet with a PTS
+    """
+    pusi = (p[:, 1] & 0x40) != 0
+    rows = np.nonzero(pusi & (payload_offset + 14 <= TS_PACKET_SIZE))[0]
+    o = payload_offset[rows]
+    start_code = (p[rows, o] == 0) & (p[rows, o + 1] == 0) & (p[rows, o + 2] == 1)
+    has_pts = (p[rows, o + 7] & 0x80) != 0
+    rows, o = rows[start_code & has_pts], o[start_code & has_pts]
+    b = [p[rows, o + 9 + i].astype(np.int64) for i in range(5)]
+    pts = ((b[0] >> 1) & 7) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+    return rows, p[rows, o + 3], pts
+
+
+def analyze_segment(path: Path) -> Optional[dict]:
+    """
+    Analyze a single MPEG-TS segment, return None if it can't be read
+    """
+    try:
+        with open(str(path), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < TS_PACKET_SIZE:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        p = packets(np.frombuffer(mm, dtype=np.uint8))
+        pid = ((p[:, 1].astype(np.uint16) & 0x1f) << 8) | p[:, 2]
+        afc = (p[:, 3] >> 4) & 3
+        cc = p[:, 3] & 0x0f
+        has_adaptation = (afc & 2) != 0
+        adaptation_length = np.where(has_adaptation, p[:, 4].astype(np.int64) + 1, 0)
+        payload_offset = 4 + adaptation_length
+
+        errors = continuity_errors(pid, cc, (afc & 1) != 0)
+        rows, stream_id, pts = pes_timestamps(p, payload_offset)
+
+        # The video PES stream ids are 0xE0-0xEF, use the first video PID
+        video = (stream_id & 0xf0) == 0xe0
+        video_pid = int(pid[rows[video][0]]) if np.any(video) else None
+        video_rows, video_pts = rows[video], pts[video]
+        if video_pid is not None:
+            same_pid = pid[video_rows] == video_pid
+            video_rows, video_pts = video_rows[same_pid], video_pts[same_pid]
+
+        # Keyframes carry the random access indicator in the adaptation field
+        random_access = has_adaptation & (p[:, 4] > 0) & ((p[:, 5] & 0x40) != 0)
+        keyframe_pts = video_pts[random_access[video_rows]]
+
+        duration = None
+        if len(video_pts) > 1:
+            ordered = np.sort(video_pts)
+            # The last frame lasts as long as the frames before it
+            frame = float(np.median(np.diff(ordered)))
+            duration = float(ordered[-1] - ordered[0] + frame) / PTS_CLOCK
+
+        result = {
+            "size": size,
+            "packets": int(len(p)),
+            "continuity_errors": errors,
+            "duration": duration,
+            "bitrate": size * 8 / duration if duration else None,
+            "keyframes": [int(k) for k in keyframe_pts],
+        }
+        # Release the views on the mmap before closing it
+        del p, pid, afc, cc, has_adaptation, adaptation_length, payload_offset
+        del rows, stream_id, pts, video, video_rows, video_pts, random_access, keyframe_pts
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            pass
+    return result
+
+
+def summarize(segments: List[dict]) -> dict:
+    """
+    Combine the results of the newest segments of a stream into its health
+    """
+    durations = [s["duration"] for s in segments if s["duration"]]
+    total_duration = sum(durations)
+    keyframes = sorted(k for s in segments for k in s["keyframes"])
+    keyframe_interval = None
+    if len(keyframes) > 1:
+        keyframe_interval = float(np.median(np.diff(keyframes))) / PTS_CLOCK
+    return {
+        "segments": len(segments),
+        "bitrate": sum(s["size"] for s in segments if s["duration"]) * 8 / total_duration if total_duration else None,
+        "segment_duration": total_duration / len(durations) if durations else None,
+        "keyframe_interval": keyframe_interval,
+        "continuity_errors": sum(s["continuity_errors"] for s in segments),
+    }
+
+
+def changed(old: Optional[dict], new: Optional[dict], tolerance: float=0.1) -> bool:
+    """
+    Return True if the health changed enough to be published. The measured
+    rates and durations vary slightly as the segments rotate, so they only
+    count if they changed by more than the tolerance (like the ingest metrics
+    in rtmpstat), the counts have to match exactly
+    """
+    if old is None or new is None:
+        return old is not new
+    for name, value in new.items():
+        before = old.get(name)
+        if name in ("bitrate", "segment_duration", "keyframe_interval") and before and value is not None:
+            if abs(value - before) > before * tolerance:
+                return True
+        elif value != before:
+            return True
+    return False
+
+
+class SegmentAnalyzer():
+    """
+    Analyzes the newest segments of all active streams. Results are cached per
+    segment, so every segment is only read once. A run stops analyzing new
+    segments when its CPU budget is used up and continues on the next run.
+
+    The analysis of a segment holds the CPU, so the analyzer yields to the
+    event loop after every segment and every stream.
+
+    This uses a builder pattern like Stream and StreamList:
+    analyzer = SegmentAnalyzer(socketio, logger, "/data/hls").set_interval(10).start(streamlist)
+    """
+    def __init__(self, socketio, logger, hls_path: str):
+        self.socketio = socketio
+        self.logger = logger
+        self.hls_path = Path(hls_path)
+        self.interval = 10.0
+        self.segments_per_stream = 3
+        self.budget = 0.5
+        self.cache = {}
+
+    def set_interval(self, seconds: float) -> 'SegmentAnalyzer':
+        """
+        Set the seconds between the end of a run and the start of the next
+        """
+        self.interval = float(seconds)
+        return self
+
+    def set_segments_per_stream(self, n: int) -> 'SegmentAnalyzer':
+        """
+        Set how many of the newest segments of a stream are analyzed
+        """
+        self.segments_per_stream = max(1, int(n))
+        return self
+
+    def set_budget(self, seconds: float) -> 'SegmentAnalyzer':
+        """
+        Set the CPU seconds a single run may spend analyzing new segments
+        """
+        self.budget = float(seconds)
+        return self
+
+    def segment(self, path: Path, analyze: bool=True) -> Optional[dict]:
+        """
+        Return the cached result for a segment. If the segment is new or
+        changed it is analyzed, unless analyze is False
+        """
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self.cache.get(str(path))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        if not analyze:
+            return None
+        result = analyze_segment(path)
+        self.cache[str(path)] = (version, result)
+        self.socketio.sleep(0)
+        return result
+
+    def start(self, streamlist) -> 'SegmentAnalyzer':
+        self.socketio.start_background_task(self.run, streamlist)
+        return self
+
+    def run(self, streamlist):
+        while True:
+            self.analyze(streamlist)
+            self.socketio.sleep(self.interval)
+
+    def analyze(self, streamlist) -> int:
+        """
+        Analyze the newest segments of all active streams and attach the
+        health to each stream whose health changed. Returns the number of
+        analyzed streams
+        """
+        deadline = time.process_time() + self.budget
+        seen = set()
+        health = {}
+        updates = {}
+        for stream in streamlist.active_streams():
+            paths = playlist_segments(self.hls_path / "{}.m3u8".format(stream.key))[-self.segments_per_stream:]
+            seen.update(str(p) for p in paths)
+            # Over budget only already cached segments are used
+            within_budget = time.process_time() < deadline
+            results = [self.segment(p, analyze=within_budget) for p in paths]
+            results = [r for r in results if r is not None]
+            if results:
+                health[stream.key] = summarize(results)
+                if changed(stream.health, health[stream.key]):
+                    updates[stream.key] = health[stream.key]
+            self.socketio.sleep(0)
+
+        # Publish the changed health of all streams as a single change
+        streamlist.update_health(updates)
+
+        # Forget segments that rotated out of the playlists
+        self.cache = {k: v for k, v in self.cache.items() if k in seen}
+        if time.process_time() > deadline:
+            self.logger.info("Segment analyzer ran out of its budget of %s CPU seconds", self.budget)
+        return len(health)
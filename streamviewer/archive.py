@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Archive of ended streams
+
+When a stream ends, nginx-rtmp keeps its last HLS segments around for a while
+before it rotates them away. The Archiver hardlinks these segments into
+<archive_path>/<key>/<session>/ and writes a VOD playlist next to them, so the
+stream page can play the recording once the stream is inactive.
+
+Segment data is never read by streamviewer: a hardlink only adds a name to
+the existing file. If the archive is on another filesystem the segment is
+reflinked (copy on write clone) and only if that isn't supported either it
+is copied by the kernel.
+"""
+import os
+import re
+import time
+import errno
+import shutil
+from pathlib import Path
+from typing import Optional, List, Tuple
+
+from .logs import original_module
+
+# ioctl that clones a file on filesystems with copy on write (btrfs, xfs)
+FICLONE = 0x40049409
+
+EXTINF = re.compile(r"#EXTINF:([0-9.]+)")
+
+
+def is_file_name(name: str) -> bool:
+    """
+    Return True if name can be used as the name of a file in a directory
+    (with room for the extension of a playlist), without leaving it
+    """
+    if not name or "/" in name or "\0" in name or name.startswith("."):
+        return False
+    try:
+        return len(os.fsencode(name)) <= 240
+    except UnicodeError:
+        return False
+
+
+def playlist_entries(playlist: Path) -> List[Tuple[float, str]]:
+    """
+    Return the (duration, segment file name) of the segments of a HLS
+    playlist, an empty list if the playlist doesn't exist
+    """
+    try:
+        # Lines that aren't UTF-8 don't name a segment that exists
+        lines = playlist.read_text(errors="replace").splitlines()
+    except OSError:
+        return []
+    entries = []
+    duration = 0.0
+    for line in lines:
+        line = line.strip()
+        match = EXTINF.match(line)
+        if match is not None:
+            duration = float(match.group(1))
+        elif line and not line.startswith("#"):
+            entries.append((duration, line))
+    return entries
+
+
+def vod_playlist(entries: List[Tuple[float, str]]) -> str:
+    """
+    Return a VOD playlist of the segments
+    """
+    target = max([int(d + 0.999) for d, _ in entries] + [1])
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-PLAYLIST-TYPE:VOD",
+             "#EXT-X-TARGETDURATION:{}".format(target), "#EXT-X-MEDIA-SEQUENCE:0"]
+    for duration, name in entries:
+        lines += ["#EXTINF:{:.3f},".format(duration), name]
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def reflink(source: Path, target: Path):
+    """
+    Clone source to target, raises OSError if the filesystem can't
+    """
+    import fcntl
+    with open(source, "rb") as s, open(target, "wb") as t:
+        try:
+            fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
+        except OSError:
+            t.close()
+            os.unlink(target)
+            raise
+
+
+def link_segment(source: Path, target: Path) -> str:
+    """
+    Hardlink source to target, fall back to a reflink and then to a copy.
+    Returns how it was done
+    """
+    try:
+        os.link(source, target)
+        return "link"
+    except FileExistsError:
+        return "link"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    try:
+        reflink(source, target)
+        return "reflink"
+    except (OSError, ImportError):
+        pass
+    # copyfile uses sendfile, so the data doesn't pass through Python either
+    shutil.copyfile(source, target)
+    return "copy"
+
+
+class Archiver():
+    """
+    Archives ended streams in a pool of real background threads, so the
+    filesystem work never blocks the event loop. At most workers archives are
+    written at the same time, further ones wait in a queue.
+
+    This uses a builder pattern, like the StreamList:
+    archiver = Archiver(logger, "/data/hls", "/data/archive").set_workers(2).start()
+    """
+    def __init__(self, logger, hls_path: str, archive_path: str, url: str="/archive"):
+        self.logger = logger
+        self.hls_path = Path(hls_path)
+        self.archive_path = Path(archive_path)
+        self.url = url.rstrip("/")
+        self.workers = 2
+        self.delay = 2.0
+        self.queue = original_module("queue").Queue()
+        self.archives = {}
+        self.archived = 0
+        self.failed = 0
+
+    def set_workers(self, n: int) -> 'Archiver':
+        """
+        Set the number of archives written at the same time
+        """
+        self.workers = max(1, int(n))
+        return self
+
+    def set_delay(self, seconds: float) -> 'Archiver':
+        """
+        Set the seconds to wait after a stream ended, so nginx can finish
+        writing its last segment
+        """
+        self.delay = float(seconds)
+        return self
+
+    def start(self) -> 'Archiver':
+        """
+        Find the existing archives and start the worker threads
+        """
+        self.load()
+        threading = original_module("threading")
+        for _ in range(self.workers):
+            worker = threading.Thread(target=self.run)
+            worker.daemon = True
+            worker.start()
+        return self
+
+    def load(self):
+        """
+        Remember the newest archive of every stream in the archive_path
+        """
+        try:
+            keys = [e for e in os.scandir(self.archive_path) if e.is_dir()]
+        except OSError:
+            return
+        for key in keys:
+            sessions = sorted(e.name for e in os.scandir(key.path) if e.is_dir() and (Path(e.path) / "{}.m3u8".format(key.name)).exists())
+            if sessions:
+                self.archives[key.name] = sessions[-1]
+
+    def archive(self, key: str):
+        """
+        Queue the archiving of the stream with the key, returns immediately
+        """
+        self.queue.put((key, time.time()))
+
+    def run(self):
+        sleep = original_module("time").sleep
+        while True:
+            key, ended = self.queue.get()
+            sleep(max(0.0, ended + self.delay - time.time()))
+            self.try_write(key, ended)
+
+    def try_write(self, key: str, ended: float) -> Optional[Path]:
+        """
+        Like write(), but errors are logged instead of raised, so no stream can
+        end a worker thread
+        """
+        try:
+            return self.write(key, ended)
+        except OSError as e:
+            self.logger.warning("Couldn't archive the stream %s: %s", key, e)
+        except Exception:
+            self.logger.exception("Failed to archive the stream %r", key)
+        self.failed += 1
+        return None
+
+    def write(self, key: str, ended: float) -> Optional[Path]:
+        """
+        Link the segments of the stream into a new session directory and write
+        the VOD playlist. Returns the playlist, None if there was nothing to
+        archive
+        """
+        if not is_file_name(key):
+            self.logger.warning("Didn't archive the stream %r, its key can't be a directory name", key)
+            return None
+        entries = playlist_entries(self.hls_path / "{}.m3u8".format(key))
+        # Segments nginx already rotated away are skipped
+        entries = [(d, name) for d, name in entries if is_file_name(name) and (self.hls_path / name).exists()]
+        if not entries:
+            self.logger.info("Nothing to archive for the stream %s", key)
+            return None
+
+        session = time.strftime("%Y%m%d-%H%M%S", time.gmtime(ended))
+        directory = self.archive_path / key / session
+        directory.mkdir(parents=True, exist_ok=True)
+        methods = [link_segment(self.hls_path / name, directory / name) for _, name in entries]
+
+        playlist = directory / "{}.m3u8".format(key)
+        temporary = directory / ".{}.m3u8".format(key)
+        temporary.write_text(vod_playlist(entries))
+        os.replace(temporary, playlist)
+
+        self.archives[key] = session
+        self.archived += 1
+        self.logger.info("Archived %s segments of the stream %s (%s)", len(entries), key,
+                         ", ".join("{} {}".format(methods.count(m), m) for m in sorted(set(methods))))
+        return playlist
+
+    def latest(self, key: str) -> Optional[str]:
+        """
+        Return the URL of the directory with the newest archive of the stream,
+        None if there is none
+        """
+        session = self.archives.get(key)
+        if session is None:
+            return None
+        return "{}/{}/{}".format(self.url, key, session)
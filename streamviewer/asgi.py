@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+ASGI entry point, an alternative to the eventlet worker:
+
+uvicorn --workers 1 streamviewer.asgi:app
+
+socket.io is served by an asyncio python-socketio server, the Flask routes run
+in a pool of threads. Both share the stream list, broadcaster and everything
+else built by streamviewer.server, so there is still only one process with
+one stream list. The server-sent events of /events/streams are served on the
+event loop as well, an open event stream would hold a thread of the pool for
+as long as the browser stays.
+
+Needs the asgi extra: poetry install -E asgi
+"""
+import os
+import asyncio
+
+# streamviewer.server builds its socket.io server for this engine
+os.environ["STREAMVIEWER_ENGINE"] = "asgi"
+
+import socketio
+from a2wsgi import WSGIMiddleware
+
+from . import server
+from .events import KEEPALIVE
+
+
+class EventStreams():
+    """
+    Serves the server-sent events of an EventBuffer to any number of clients
+    on the event loop, like EventBuffer.subscribe does for a WSGI response.
+    Waiting clients are woken up by a listener of the buffer
+    """
+    def __init__(self, events: 'EventBuffer', snapshot, retry, headers: dict, keepalive: float=15):
+        self.events = events
+        self.snapshot = snapshot
+        self.retry = retry
+        self.headers = [(b"content-type", b"text/event-stream; charset=utf-8")]
+        self.headers += [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+        self.keepalive = keepalive
+        self.loop = None
+        self.changed = None
+        events.add_listener(self.published)
+
+    def published(self):
+        # Called from the thread of the broadcaster
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def __call__(self, scope, receive, send):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.changed = asyncio.Event()
+        headers = dict(scope["headers"])
+        last_event_id = headers.get(b"last-event-id")
+        last_id = self.events.parse_id(last_event_id.decode("latin-1") if last_event_id is not None else None)
+
+        disconnected = asyncio.ensure_future(self.disconnected(receive))
+        try:
+            await send({"type": "http.response.start", "status": 200, "headers": self.headers})
+            await self.send(send, self.events.retry_message(self.retry()))
+            last_id, messages = self.events.catch_up(last_id, self.snapshot)
+            for message in messages:
+                await self.send(send, message)
+
+            while not disconnected.done():
+                if not self.events.has_news(last_id):
+                    changed = asyncio.ensure_future(self.changed.wait())
+                    await asyncio.wait([changed, disconnected], timeout=self.keepalive, return_when=asyncio.FIRST_COMPLETED)
+                    changed.cancel()
+                    if disconnected.done():
+                        break
+                    if not self.events.has_news(last_id):
+                        await self.send(send, KEEPALIVE)
+                        continue
+                last_id, messages = self.events.catch_up(last_id, self.snapshot)
+                for message in messages:
+                    await self.send(send, message)
+        finally:
+            disconnected.cancel()
+
+    async def send(self, send, message: bytes):
+        await send({"type": "http.response.body", "body": message, "more_body": True})
+
+    async def disconnected(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+events_streams = EventStreams(server.event_buffer, server.events_snapshot, server.admission.reconnect_hint, server.EVENTS_HEADERS)
+routes = WSGIMiddleware(server.app, workers=server.config["application"]["asgi_threads"])
+
+
+async def http(scope, receive, send):
+    server.socketio.attach()
+    if scope["type"] == "http" and scope["path"] == "/events/streams" and scope["method"] == "GET":
+        return await events_streams(scope, receive, send)
+    return await routes(scope, receive, send)
+
+
+app = socketio.ASGIApp(server.socketio.server, other_asgi_app=http)
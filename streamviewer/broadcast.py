@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import time
+import threading
+from typing import List, Iterable
+
+
+class Broadcaster():
+    """
+    Sends stream list updates to all socket.io clients from a background task,
+    so the nginx callbacks can return before the fanout starts.
+
+    Changes arriving within the coalesce window are combined into a single
+    streams_changed message carrying the list at the time of sending. If a key
+    changes more than once within the window only its latest change is sent.
+    Changed viewcounts are published to the StreamList with the message, so
+    joins and leaves result in at most one new version per window.
+    Clients which still have more than max_backlog messages waiting to be sent
+    are skipped, they get the complete list with the next update anyway. Not
+    skipped are the pages of streams that were added or removed, they only
+    learn about it from this message.
+
+    Changes may be queued from any thread (e.g. the routes served in a pool of
+    threads under ASGI), the queue is only touched under a lock.
+
+    This uses a builder pattern, like the StreamList:
+    broadcaster = Broadcaster(socketio, streamlist, logger).set_window(0.1)
+    """
+    def __init__(self, socketio, streamlist, logger):
+        self.socketio = socketio
+        self.streamlist = streamlist
+        self.logger = logger
+        self.window = 0.1
+        self.max_backlog = 50
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.oldest = None
+        self.scheduled = False
+        self.dispatched = 0
+        self.skipped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.events = None
+
+    def set_window(self, seconds: float) -> 'Broadcaster':
+        """
+        Set the time in seconds during which changes are combined
+        """
+        self.window = max(0.0, float(seconds))
+        return self
+
+    def set_max_backlog(self, n: int) -> 'Broadcaster':
+        """
+        Set the number of unsent messages after which a client is skipped
+        """
+        self.max_backlog = int(n)
+        return self
+
+    def set_event_buffer(self, events: 'EventBuffer') -> 'Broadcaster':
+        """
+        Also publish every update to this buffer of server-sent events
+        """
+        self.events = events
+        return self
+
+    def stream_added(self, key: str):
+        self.enqueue(key, "added")
+
+    def stream_removed(self, key: str):
+        self.enqueue(key, "removed")
+
+    def viewcount_changed(self, key: str):
+        self.enqueue(key, "viewcount")
+
+    def enqueue(self, key: str, change: str):
+        """
+        Queue a change of the stream with the key and make sure a flush is
+        scheduled. Returns immediately
+        """
+        with self.lock:
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            # Re-insert, so the order of the changes is kept. A new viewcount
+            # doesn't hide that the stream was added or removed
+            if change != "viewcount" or key not in self.pending:
+                self.pending.pop(key, None)
+                self.pending[key] = change
+            schedule = not self.scheduled
+            self.scheduled = True
+        if schedule:
+            self.socketio.start_background_task(self.flush_later)
+
+    def flush_later(self):
+        self.socketio.sleep(self.window)
+        self.flush()
+
+    def flush(self):
+        """
+        Send all pending changes with the current list in a single message
+        """
+        with self.lock:
+            changes, self.pending = self.pending, {}
+            oldest, self.oldest = self.oldest, None
+            self.scheduled = False
+        if not changes:
+            return
+
+        viewcounts = self.streamlist.publish_viewcounts()
+        if not viewcounts and all(c == "viewcount" for c in changes.values()):
+            # Viewers came and went again
+            return
+        message = {
+            "version": self.streamlist.version,
+            "added": [k for k, c in changes.items() if c == "added"],
+            "removed": [k for k, c in changes.items() if c == "removed"],
+            "list": self.streamlist.wire_list(),
+        }
+        skip = self.slow_clients(k for k, c in changes.items() if c != "viewcount")
+        self.socketio.emit("streams_changed", message, skip_sid=skip or None)
+        if self.events is not None:
+            self.events.publish(self.streamlist.version, "streams", message)
+
+        self.dispatched += 1
+        self.skipped += len(skip)
+        self.last_lag = time.monotonic() - oldest
+        self.max_lag = max(self.max_lag, self.last_lag)
+        self.logger.debug("Sent %s changes to the clients after %.3f s (skipped %s slow clients)", len(changes), self.last_lag, len(skip))
+
+    def slow_clients(self, keys: Iterable[str]=()) -> List[str]:
+        """
+        Return the socket.io session ids of clients with more than max_backlog
+        unsent messages, except the ones in the room of one of the keys
+        (relies on the internals of python-socketio 5)
+        """
+        server = self.socketio.server
+        slow = []
+        try:
+            participants = list(server.manager.get_participants("/", None))
+        except KeyError:
+            # Nobody connected yet
+            return slow
+        watching = set()
+        for key in keys:
+            try:
+                watching.update(sid for sid, _ in server.manager.get_participants("/", key))
+            except KeyError:
+                # Nobody on the page of this stream
+                continue
+        for sid, eio_sid in participants:
+            if sid in watching:
+                continue
+            socket = server.eio.sockets.get(eio_sid)
+            if socket is not None and socket.queue.qsize() > self.max_backlog:
+                slow.append(sid)
+        return slow
+
+    def stats(self) -> dict:
+        """
+        Return the queue depth, dispatch lag and counters
+        """
+        return {
+            "depth": len(self.pending),
+            "lag": time.monotonic() - self.oldest if self.oldest is not None else 0.0,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "dispatched": self.dispatched,
+            "skipped_clients": self.skipped,
+        }
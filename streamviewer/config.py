@@ -6,7 +6,7 @@ import toml
 from pathlib import Path
 import logging
 from logging.config import dictConfig
-from typing import List
+from typing import List, Optional
 import collections.abc
 
 
@@ -51,6 +51,189 @@ password_protection_period = 2880
 # If this option is active, only streams listed below are usable
 free_choice = true
 
+# Only every n-th log message of frequent socket.io events (join, leave,
+# stream_list, stream_info) gets logged. Set to 1 to log all of them
+log_sample_rate = 10
+
+# /readyz reports the service as not ready if the event loop lags behind by
+# more than this many seconds
+readiness_max_lag = 0.5
+
+# Stream list updates within this many seconds are sent to the clients as one
+broadcast_window = 0.1
+
+# Clients with more unsent messages than this are skipped by list updates,
+# they catch up with the next one
+broadcast_max_backlog = 50
+
+# Analyze the newest HLS segments of each active stream for bitrate, segment
+# duration, keyframe interval and continuity errors (needs numpy, install the
+# analyzer extra). The results are part of the stream info
+analyze_segments = false
+
+# Seconds between two runs of the segment analyzer
+analyzer_interval = 10
+
+# CPU seconds a single run may spend reading new segments, streams that didn't
+# fit in get analyzed on the next run
+analyzer_budget = 0.5
+
+# Number of the newest segments analyzed per stream
+analyzer_segments = 3
+
+# Poll the rtmp_stat page of nginx-rtmp for the ingest bitrate, resolution and
+# codecs of each stream (see examples/streamviewer.conf), e.g.
+# "http://127.0.0.1/stat". Leave empty to not poll it
+rtmp_stat_url = ""
+
+# Seconds between two polls of the rtmp_stat page
+rtmp_stat_interval = 5
+
+# Seconds after which a poll of the rtmp_stat page is given up
+rtmp_stat_timeout = 1
+
+# Periodically remove playlists and segments of streams that are not active
+# from the hls_path (e.g. left behind after a crash). Only enable this if all
+# streams in the hls_path are registered with streamviewer via on_publish
+hls_sweeper = false
+
+# Seconds between two sweeps of the hls_path
+hls_sweeper_interval = 300
+
+# Files are only removed if they weren't modified for this many seconds
+hls_sweeper_grace = 3600
+
+# File operations per second a sweep may use
+hls_sweeper_io_budget = 500
+
+# Keep the HLS segments of ended streams in the archive_path (hardlinked, so
+# this costs no disk space until nginx rotates them away). The stream page
+# plays the newest archive while the stream is inactive, nginx has to serve
+# the archive_path under archive_url (see examples/streamviewer.conf)
+archive = false
+archive_path = "/data/archive"
+archive_url = "/archive"
+
+# Number of archives written at the same time
+archive_workers = 2
+
+# Which streams need a signed, expiring viewing token to fetch their HLS files:
+# "off", "unlisted" or "all". The stream page hands out the token as a cookie,
+# nginx checks it with /auth/hls (see the auth_request in
+# examples/streamviewer.conf)
+hls_tokens = "off"
+
+# Secret the viewing tokens are signed with. If empty a random one is used,
+# so tokens become invalid with every restart
+hls_token_secret = ""
+
+# Seconds a viewing token is valid
+hls_token_lifetime = 3600
+
+# Fraction of the players that report their distance to the live edge and
+# their stalls (see /metrics and the stream info), 0 to turn reports off
+latency_report_rate = 0.25
+
+# Seconds between two reports of a player
+latency_report_interval = 30
+
+# Latency reports are aggregated over the last one to two windows of this
+# many seconds
+latency_window = 300
+
+# Profile a fraction of the requests and socket.io events with cProfile and log
+# the stack whenever something blocks the event loop
+profiling = false
+
+# Allows switching profiling on and off at runtime with a POST to
+# /profiling?enabled=true from localhost, sent with this secret in the
+# X-Profiling-Secret header. If empty profiling can't be switched at runtime
+profiling_secret = ""
+
+# Fraction of the requests and socket.io events that get profiled
+profiling_sample_rate = 0.01
+
+# Seconds between two logs of the collected profile
+profiling_dump_interval = 60
+
+# File the collected profile is written to as well (e.g. for snakeviz), an
+# empty string only logs it
+profiling_dump_path = ""
+
+# Log the stack of code that blocks the event loop longer than this many
+# milliseconds (only while profiling)
+profiling_block_threshold = 100
+
+# New socket.io sessions admitted per second (0 for no limit) and how many are
+# admitted at once before that. After a restart every open page reconnects at
+# the same time, refused ones are told when to try again
+session_admission_rate = 50
+session_admission_burst = 200
+
+# Seconds before a page reconnects after it lost the connection (randomized)
+# and the maximum its backoff grows to
+reconnect_delay = 1
+reconnect_delay_max = 30
+
+# Threads serving the HTTP routes under the ASGI entry point (streamviewer.asgi),
+# /events/streams and socket.io are served on the event loop without them
+asgi_threads = 20
+
+[federation]
+# List the streams of other streamviewer instances (e.g. on other RTMP ingest
+# hosts) as well. Their stream lists are pulled from their /api/streams
+enabled = false
+
+# Seconds between two pulls of an origin
+interval = 5
+
+# Streams of an origin that couldn't be reached for this many seconds are no
+# longer listed
+max_staleness = 30
+
+# Each origin has to have a name and a url, hls_url is where browsers can
+# fetch its HLS playlists (defaults to url + "/hls"). Replace the empty list
+# below with [[federation.origin]] entries like the commented one
+origin = []
+
+#    [[federation.origin]]
+#    name = "ingest-1"
+#    url = "http://ingest-1.example.com"
+#    hls_url = "https://ingest-1.example.com/hls"
+
+[webhooks]
+# POST stream.started and stream.stopped events as {"events": [...]} to the
+# endpoints below. Delivery happens in the background and at least once, use
+# the id of an event to skip duplicates
+enabled = false
+
+# Seconds during which events are collected into one POST, and the maximum
+# number of events in one POST
+batch_window = 1
+max_batch = 100
+
+# Failed deliveries are retried after 1, 2, 4, ... seconds, at most this many
+max_backoff = 300
+
+# While an endpoint is down its events are written to a file in this directory
+# and delivered after a restart as well. Leave empty to keep them in memory
+spill_path = ""
+
+# Events kept in memory per endpoint, without a spill_path the oldest ones are
+# dropped beyond this
+max_queue = 10000
+
+# Each endpoint has to have a url. events limits which events it receives, with
+# a secret the body is signed as HMAC-SHA256 in the X-Streamviewer-Signature
+# header. Replace the empty list below with [[webhooks.endpoint]] entries like
+# the commented one
+endpoint = []
+
+#    [[webhooks.endpoint]]
+#    url = "http://hooks.example.com/streams"
+#    events = ["stream.started", "stream.stopped"]
+#    secret = "change-me"
+
 [stream]
 # Stream keys listed here will persist. If you want to allow _only_ these streams
 # set free_choice to false above.
@@ -66,23 +249,29 @@ free_choice = true
     password = "1234"
     unlisted = true
     description = "## The best stream Something truly private, unless you guess the stream key"
+
+    # A name ending in * reserves all keys starting with it. The streams are
+    # only created when they get published, quota limits the number of them
+    # that can be active at the same time (optional)
+    # [[stream.key]]
+    # name = "team-a-*"
+    # password = "1234"
+    # quota = 5
 """
 
 # Config for the logger, there should be no need to make
-# manual changes here
+# manual changes here. Records are handed to a queue and written to the wsgi
+# error stream by a background thread (see logs.py)
 dictConfig({
     'version': 1,
-    'formatters': {'default': {
-        'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
-    }},
-    'handlers': {'wsgi': {
-        'class': 'logging.StreamHandler',
+    'handlers': {'queue': {
+        '()': 'streamviewer.logs.queue_handler',
         'stream': 'ext://flask.logging.wsgi_errors_stream',
-        'formatter': 'default'
+        'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
     }},
     'root': {
         'level': 'INFO',
-        'handlers': ['wsgi']
+        'handlers': ['queue']
     }
 })
 
@@ -186,9 +375,12 @@ def merge(this: dict, that: dict) -> dict:
     return this
 
 
-def initialize_config(logger=None) -> dict:
+def initialize_config(logger=None, errors: Optional[List[str]]=None) -> dict:
     """
     Initialize a configuration. If none exists, create a default one
+
+    If a list is passed as errors, config files that can't be read are
+    skipped and their errors are appended to it, instead of raising
     """
     config = toml.loads(DEFAULT_CONFIG)
 
@@ -209,7 +401,17 @@ def initialize_config(logger=None) -> dict:
 
     # Read all existing configs in order and merge/override the default one
     for i, p in enumerate(get_existing_config_file_paths()):
-        next_config = read_config(p)
+        try:
+            next_config = read_config(p)
+        except (OSError, ValueError) as e:
+            if errors is None:
+                raise
+            errors.append("{}: {}".format(p, e))
+            if logger is not None:
+                logger.error("Config [{}]: {} can't be read, skipping it: {}".format(i+2, p, e))
+            else:
+                print("Config [{}]: {} can't be read, skipping it: {}".format(i+2, p, e))
+            continue
         config = merge(config, next_config)
         if logger is not None:
             logger.info("Config [{}]: {} (overrides previous configs)".format(i+2, p))
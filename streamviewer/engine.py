@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import time
+import asyncio
+import threading
+
+import flask
+import socketio
+
+
+class AsyncSocketIO():
+    """
+    Stands in for the parts of Flask-SocketIO that streamviewer uses, but
+    serves socket.io with an asyncio python-socketio AsyncServer (see
+    streamviewer.asgi).
+
+    The socket.io handlers of streamviewer.server stay synchronous. They run
+    on the event loop within a Flask request context, like under Flask-SocketIO,
+    so request.sid, join_room and leave_room work unchanged. Background tasks
+    (broadcaster, health monitor, federation, ...) run in real threads, their
+    emits are handed over to the event loop. As their sleeps don't say
+    anything about the event loop, the health monitor and the profiler
+    measure its lag with callbacks passed to run_on_loop().
+    """
+    def __init__(self, app):
+        self.app = app
+        self.server = socketio.AsyncServer(async_mode="asgi")
+        self.loop = None
+        self.loop_thread = None
+        self.environs = {}
+        self.connect_handler = None
+        # join_room and leave_room of flask_socketio look the server up here
+        app.extensions["socketio"] = self
+        self.server.on("connect", self.connect)
+        self.server.on("disconnect", self.disconnect)
+
+    def attach(self):
+        """
+        Remember the running event loop, called on the event loop by every
+        request
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+            self.loop_thread = threading.get_ident()
+
+    async def connect(self, sid, environ):
+        self.attach()
+        environ = dict(environ)
+        environ.setdefault("wsgi.url_scheme", "http")
+        self.environs[sid] = environ
+        if self.connect_handler is not None:
+            try:
+                # Raises ConnectionRefusedError to refuse the session
+                return self.call(self.connect_handler, sid, ())
+            except socketio.exceptions.ConnectionRefusedError:
+                del self.environs[sid]
+                raise
+
+    async def disconnect(self, sid):
+        self.environs.pop(sid, None)
+
+    def on(self, event: str):
+        """
+        Decorator registering a synchronous handler for a socket.io event
+        """
+        def decorator(handler):
+            if event == "connect":
+                # Called by connect(), with no arguments like in Flask-SocketIO
+                self.connect_handler = handler
+                return handler
+            async def dispatch(sid, *args):
+                return self.call(handler, sid, args)
+            self.server.on(event, dispatch)
+            return handler
+        return decorator
+
+    def call(self, handler, sid: str, args: tuple):
+        with self.app.request_context(self.environs[sid]):
+            flask.request.sid = sid
+            flask.request.namespace = "/"
+            return handler(*args)
+
+    def emit(self, event: str, data=None, room=None, to=None, skip_sid=None, namespace="/"):
+        """
+        Send an event to all clients (or the ones in room), from the event loop
+        as well as from any other thread. Returns immediately
+        """
+        if self.loop is None:
+            # Nobody connected yet
+            return
+        coroutine = self.server.emit(event, data, to=to or room, skip_sid=skip_sid, namespace=namespace)
+        if threading.get_ident() == self.loop_thread:
+            self.loop.create_task(coroutine)
+        else:
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run_on_loop(self, callback) -> bool:
+        """
+        Call callback on the event loop as soon as it gets to it, from any
+        thread. Returns False if there is no event loop yet
+        """
+        if self.loop is None:
+            return False
+        self.loop.call_soon_threadsafe(callback)
+        return True
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def start_background_task(self, target, *args, **kwargs) -> threading.Thread:
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs)
+        thread.daemon = True
+        thread.start()
+        return thread
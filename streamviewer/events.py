@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import json
+import threading
+import collections
+from typing import Optional, List, Tuple, Callable, Iterator
+
+
+# A comment, sent to idle subscribers so proxies keep the connection open
+KEEPALIVE = b": keepalive\n\n"
+
+
+class EventBuffer():
+    """
+    A shared buffer of the last server-sent events. Every event is serialized
+    once when it is published and then written to all subscribers as is, so a
+    change costs the same no matter how many clients are listening.
+
+    Event ids are the StreamList versions, prefixed with the epoch (e.g.
+    "3f2a9c1e-42"), as the versions start over with the process. A client that
+    reconnects with the id of the last event it saw (Last-Event-ID) gets the
+    events it missed if they are still buffered, otherwise it starts over with
+    the current state.
+    """
+    def __init__(self, size: int=64, epoch: str=""):
+        self.events = collections.deque(maxlen=size)
+        # The id of the newest event that fell out of the buffer
+        self.dropped_id = None
+        self.condition = threading.Condition()
+        self.epoch = epoch
+        self.listeners = []
+
+    @property
+    def latest_id(self) -> Optional[int]:
+        return self.events[-1][0] if self.events else None
+
+    def encode(self, event_id: int, event: str, data) -> bytes:
+        """
+        Serialize an event without buffering it, e.g. the current state for a
+        single subscriber
+        """
+        return "id: {}\nevent: {}\ndata: {}\n\n".format(self.format_id(event_id), event, json.dumps(data, separators=(",", ":"))).encode("utf-8")
+
+    def format_id(self, event_id: int) -> str:
+        return "{}-{}".format(self.epoch, event_id) if self.epoch else str(event_id)
+
+    def parse_id(self, last_event_id: Optional[str]) -> Optional[int]:
+        """
+        Return the event id of a Last-Event-ID header, None if there is none
+        or it is from another epoch
+        """
+        if last_event_id is None:
+            return None
+        epoch, _, event_id = last_event_id.rpartition("-")
+        if epoch != self.epoch:
+            return None
+        try:
+            return int(event_id)
+        except ValueError:
+            return None
+
+    def publish(self, event_id: int, event: str, data) -> bytes:
+        """
+        Serialize an event, buffer it and wake up all subscribers
+        """
+        message = self.encode(event_id, event, data)
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                self.dropped_id = self.events[0][0]
+            self.events.append((event_id, message))
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+        return message
+
+    def add_listener(self, listener: Callable):
+        """
+        Call listener() after every publish, from the publishing thread (for
+        subscribers that don't wait on the condition, see streamviewer.asgi)
+        """
+        self.listeners.append(listener)
+
+    def after(self, event_id: int) -> Optional[List[tuple]]:
+        """
+        Return the buffered events following event_id, None if some of them
+        fell out of the buffer already. The id of the current state sent to a
+        client (see subscribe) doesn't need to be buffered itself, not every
+        version is published as an event
+        """
+        with self.condition:
+            if self.dropped_id is not None and event_id < self.dropped_id:
+                return None
+            return [(i, message) for i, message in self.events if i > event_id]
+
+    def has_news(self, last_id: int) -> bool:
+        """
+        Return True if there are events following last_id
+        """
+        latest_id = self.latest_id
+        return latest_id is not None and latest_id > last_id
+
+    def catch_up(self, last_id: Optional[int], snapshot: Callable) -> Tuple[int, List[bytes]]:
+        """
+        Return the messages for a client that saw last_id and the id it saw
+        after them: the events following last_id, or the current state from
+        snapshot() (which returns its id and message) if they are not all
+        buffered
+        """
+        events = self.after(last_id) if last_id is not None else None
+        if events is None:
+            last_id, message = snapshot()
+            return last_id, [message]
+        if events:
+            last_id = events[-1][0]
+        return last_id, [message for _, message in events]
+
+    def retry_message(self, retry: float) -> bytes:
+        """
+        Tell the browser to reconnect retry seconds after it lost the
+        connection
+        """
+        return "retry: {}\n\n".format(int(retry * 1000)).encode("utf-8")
+
+    def subscribe(self, last_id: Optional[int], snapshot: Callable, keepalive: float=15, retry: float=2) -> Iterator[bytes]:
+        """
+        Yield the messages for a single client: the missed events or the
+        current state (see catch_up), then every new event. Comments are sent
+        as keepalive when idle
+        """
+        yield self.retry_message(retry)
+        last_id, messages = self.catch_up(last_id, snapshot)
+        yield from messages
+
+        while True:
+            with self.condition:
+                news = self.condition.wait_for(lambda: self.has_news(last_id), timeout=keepalive)
+            if not news:
+                yield KEEPALIVE
+                continue
+            last_id, messages = self.catch_up(last_id, snapshot)
+            yield from messages
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Federation of several streamviewer instances
+
+Each ingest host runs its own nginx-rtmp and streamviewer. One streamviewer
+with a [federation] section in its config periodically pulls the stream lists
+of the others (the origins) from their /api/streams and lists their streams
+as well. Viewers are sent to a page that plays the HLS playlist from the
+origin that receives the stream.
+"""
+import json
+import time
+import http.client
+import urllib.parse
+from typing import List, Optional
+
+
+class Origin():
+    """
+    Another streamviewer instance whose streams are listed here. Pulls reuse
+    one keep-alive connection and send the ETag of the last response, so an
+    unchanged list costs the origin a 304 without a body.
+    """
+    def __init__(self, logger, name: str, url: str, hls_url: Optional[str]=None, timeout: float=2):
+        self.logger = logger
+        self.name = name
+        self.url = url.rstrip("/")
+        self.hls_url = (hls_url or "{}/hls".format(self.url)).rstrip("/")
+        self.timeout = timeout
+        parts = urllib.parse.urlsplit(self.url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path
+        self.connection = None
+        self.etag = None
+        self.streams = []
+        self.changes = 0
+        self.fetched = None
+        self.error = None
+
+    def __str__(self) -> str:
+        return "{} ({})".format(self.name, self.url)
+
+    def connect(self) -> http.client.HTTPConnection:
+        if self.connection is None:
+            if self.scheme == "https":
+                self.connection = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                self.connection = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get(self, path: str, headers: dict) -> tuple:
+        """
+        GET path on the origin, return the status, the response headers and the
+        body. A reused connection that was closed by the origin is reopened once
+        """
+        for attempt in range(2):
+            connection = self.connect()
+            try:
+                connection.request("GET", self.path + path, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt == 1:
+                    raise
+
+    def pull(self) -> bool:
+        """
+        Pull the stream list of the origin. Returns True if it changed since the
+        last pull, raises OSError, http.client.HTTPException or ValueError if
+        the origin couldn't be reached or sent garbage
+        """
+        headers = {"Accept": "application/json"}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        status, response_headers, body = self.get("/api/streams?limit=100", headers)
+        if status == 304:
+            self.fetched = time.monotonic()
+            return False
+        if status != 200:
+            raise ValueError("{} answered with status {}".format(self, status))
+
+        page = json.loads(body.decode("utf-8"))
+        streams = page["streams"]
+        # Further pages are not version gated, they only exist for big lists
+        while page.get("cursor") is not None:
+            status, _, body = self.get("/api/streams?limit=100&cursor={}".format(urllib.parse.quote(page["cursor"])), {"Accept": "application/json"})
+            if status != 200:
+                raise ValueError("{} answered with status {}".format(self, status))
+            page = json.loads(body.decode("utf-8"))
+            streams += page["streams"]
+
+        self.etag = response_headers.get("ETag")
+        self.streams = streams
+        self.changes += 1
+        self.fetched = time.monotonic()
+        return True
+
+    def is_stale(self, max_staleness: float) -> bool:
+        """
+        Return True if the last successful pull is older than max_staleness
+        """
+        return self.fetched is None or time.monotonic() - self.fetched > max_staleness
+
+
+class Federation():
+    """
+    Pulls the stream lists of all origins, each in its own background task so
+    a slow origin doesn't hold up the others. Streams of an origin that could
+    not be reached for longer than max_staleness are no longer listed.
+
+    This uses a builder pattern, like the StreamList:
+    federation = Federation(socketio, logger).set_interval(5).add_origin(origin)
+    """
+    def __init__(self, socketio, logger):
+        self.socketio = socketio
+        self.logger = logger
+        self.origins = {}
+        self.interval = 5
+        self.max_staleness = 30
+
+    def set_interval(self, seconds: float) -> 'Federation':
+        """
+        Set the seconds between two pulls of an origin
+        """
+        self.interval = float(seconds)
+        return self
+
+    def set_max_staleness(self, seconds: float) -> 'Federation':
+        """
+        Set the seconds after which the streams of an unreachable origin are
+        no longer listed
+        """
+        self.max_staleness = float(seconds)
+        return self
+
+    def add_origin(self, origin: 'Origin') -> 'Federation':
+        self.origins[origin.name] = origin
+        return self
+
+    def add_origins_from_config(self, config) -> 'Federation':
+        """
+        Add all origins from the [[federation.origin]] entries of the config
+        """
+        for o in config["federation"]["origin"]:
+            if "name" not in o or "url" not in o:
+                self.logger.warning("Found an origin in the configuration without \"name\" or \"url\"!")
+                continue
+            self.add_origin(Origin(self.logger, o["name"], o["url"], o.get("hls_url")))
+        return self
+
+    def start(self) -> 'Federation':
+        for origin in self.origins.values():
+            self.socketio.start_background_task(self.run, origin)
+        return self
+
+    def run(self, origin: 'Origin'):
+        while True:
+            self.pull(origin)
+            self.socketio.sleep(self.interval)
+
+    def pull(self, origin: 'Origin') -> bool:
+        """
+        Pull a single origin, log when it goes down or comes back
+        """
+        try:
+            changed = origin.pull()
+        except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+            if origin.error is None:
+                self.logger.warning("Origin %s is unreachable: %s", origin, e)
+            origin.error = str(e)
+            return False
+        if origin.error is not None:
+            self.logger.info("Origin %s is reachable again", origin)
+            origin.error = None
+        return changed
+
+    def get_origin(self, name: str) -> Optional['Origin']:
+        return self.origins.get(name)
+
+    def listed_streams(self) -> List[dict]:
+        """
+        Return the streams of all origins that are not stale, each with the
+        name and HLS url of its origin
+        """
+        streams = []
+        for origin in self.origins.values():
+            if origin.is_stale(self.max_staleness):
+                continue
+            for stream in origin.streams:
+                streams.append(dict(stream, origin=origin.name, hls_url=origin.hls_url))
+        return streams
+
+    def state(self) -> tuple:
+        """
+        Return a summary of the origins that changes whenever status() or
+        listed_streams() would, without building either
+        """
+        return tuple((o.name, o.changes, o.is_stale(self.max_staleness), o.error) for o in self.origins.values())
+
+    def status(self) -> List[dict]:
+        """
+        Return the state of all origins
+        """
+        return [{
+            "name": o.name,
+            "url": o.url,
+            "streams": len(o.streams),
+            "stale": o.is_stale(self.max_staleness),
+            "error": o.error,
+        } for o in self.origins.values()]
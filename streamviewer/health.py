@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import os
+import time
+import logging
+import threading
+from typing import List
+
+
+class HealthMonitor():
+    """
+    Keeps the state needed by /healthz and /readyz up to date, so answering
+    them costs nothing but a few comparisons.
+
+    A background task wakes up every interval seconds, measures by how much it
+    overslept (the event loop lag) and checks whether the hls_path is writable.
+    Under ASGI the task is a real thread, it measures how long a callback
+    waits for the event loop instead (see AsyncSocketIO.run_on_loop).
+
+    This uses a builder pattern, like the StreamList:
+    monitor = HealthMonitor(socketio, "/data/hls").set_max_lag(0.5)
+    """
+    def __init__(self, socketio, hls_path: str):
+        self.socketio = socketio
+        self.hls_path = hls_path
+        self.interval = 1.0
+        self.max_lag = 0.5
+        self.config_loaded = False
+        self.streamlist_ready = False
+        self.hls_path_writable = False
+        self.loop_lag = 0.0
+        self.last_beat = None
+
+    def set_interval(self, seconds: float) -> 'HealthMonitor':
+        """
+        Set the seconds between two checks
+        """
+        self.interval = float(seconds)
+        return self
+
+    def set_max_lag(self, seconds: float) -> 'HealthMonitor':
+        """
+        Set the event loop lag in seconds above which the service is not ready
+        """
+        self.max_lag = float(seconds)
+        return self
+
+    def set_config_loaded(self, loaded: bool=True) -> 'HealthMonitor':
+        self.config_loaded = loaded
+        return self
+
+    def set_streamlist_ready(self, ready: bool=True) -> 'HealthMonitor':
+        self.streamlist_ready = ready
+        return self
+
+    def start(self) -> 'HealthMonitor':
+        """
+        Start the background task
+        """
+        self.check()
+        self.socketio.start_background_task(self.run)
+        return self
+
+    def run(self):
+        run_on_loop = getattr(self.socketio, "run_on_loop", None)
+        while True:
+            before = time.monotonic()
+            self.socketio.sleep(self.interval)
+            if run_on_loop is None:
+                self.loop_lag = max(0.0, time.monotonic() - before - self.interval)
+            else:
+                self.loop_lag = self.measure_loop_lag(run_on_loop)
+            self.check()
+
+    def measure_loop_lag(self, run_on_loop) -> float:
+        """
+        Return the seconds a callback waited for the event loop (interval if
+        it didn't get to it within that time)
+        """
+        called = threading.Event()
+        scheduled = time.monotonic()
+        if not run_on_loop(called.set):
+            # No event loop yet
+            return 0.0
+        if not called.wait(self.interval):
+            return self.interval
+        return time.monotonic() - scheduled
+
+    def check(self):
+        self.hls_path_writable = os.access(self.hls_path, os.W_OK)
+        self.last_beat = time.monotonic()
+
+    def current_lag(self) -> float:
+        """
+        Return the event loop lag, if the background task is overdue the time
+        it is overdue counts as lag as well
+        """
+        if self.last_beat is None:
+            return 0.0
+        overdue = time.monotonic() - self.last_beat - self.interval
+        return max(self.loop_lag, overdue)
+
+    def failed_checks(self) -> List[str]:
+        """
+        Return the names of the readiness checks that failed
+        """
+        failed = []
+        if not self.config_loaded:
+            failed.append("config")
+        if not self.streamlist_ready:
+            failed.append("streamlist")
+        if not self.hls_path_writable:
+            failed.append("hls_path")
+        if self.current_lag() > self.max_lag:
+            failed.append("loop_lag")
+        return failed
+
+
+class PathFilter(logging.Filter):
+    """
+    Drops access log records of requests to the given paths (e.g. health
+    checks polled by load balancers)
+    """
+    def __init__(self, paths: List[str]):
+        super().__init__()
+        self.paths = [" {} ".format(p) for p in paths] + [" {}?".format(p) for p in paths]
+
+    def filter(self, record) -> bool:
+        message = record.getMessage()
+        return not any(p in message for p in self.paths)
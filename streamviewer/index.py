@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import json
+import base64
+import bisect
+from typing import Optional, List, Tuple
+
+# The orders in which listed streams can be paginated. Each maps a stream to
+# its sort value, ties are broken by the stream key
+SORTS = {
+    # Oldest first, like the list on / or /streams
+    "started": lambda stream: stream.creation_time.timestamp(),
+    # Most viewers first
+    "viewcount": lambda stream: -stream.viewcount,
+}
+
+
+def encode_cursor(item: tuple) -> str:
+    """
+    Encode the (sort value, key) of the last stream on a page as a cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(item)).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Decode a cursor created by encode_cursor, raises ValueError if invalid
+    """
+    try:
+        value, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("Invalid cursor \"{}\"".format(cursor)) from e
+    if not isinstance(value, (int, float)) or not isinstance(key, str):
+        raise ValueError("Invalid cursor \"{}\"".format(cursor))
+    return value, key
+
+
+class SortedIndex():
+    """
+    A list of (sort value, key) tuples which is kept in order. Lookups are
+    binary searches, so a page costs O(log n + limit)
+    """
+    def __init__(self):
+        self.items = []
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def copy(self) -> 'SortedIndex':
+        clone = SortedIndex()
+        clone.items = list(self.items)
+        return clone
+
+    def add(self, item: tuple):
+        bisect.insort(self.items, item)
+
+    def remove(self, item: tuple):
+        i = bisect.bisect_left(self.items, item)
+        if i < len(self.items) and self.items[i] == item:
+            del self.items[i]
+
+    def after(self, item: Optional[tuple], limit: int) -> List[tuple]:
+        """
+        Return up to limit items following item (from the start if None)
+        """
+        i = 0 if item is None else bisect.bisect_right(self.items, item)
+        return self.items[i:i + limit]
+
+    def prefixed(self, prefix: str) -> List[tuple]:
+        """
+        Return all items whose key starts with prefix (for indexes sorted by key)
+        """
+        i = bisect.bisect_left(self.items, (prefix,))
+        matches = []
+        while i < len(self.items) and self.items[i][0].startswith(prefix):
+            matches.append(self.items[i])
+            i += 1
+        return matches
+
+
+class StreamIndex():
+    """
+    Keeps the listed streams (active and not unlisted) in sorted indexes, one
+    per order in SORTS plus one on the keys for prefix searches. StreamList
+    calls update() or discard() whenever a stream changes.
+    """
+    def __init__(self):
+        self.sorted = {name: SortedIndex() for name in SORTS.keys()}
+        self.keys = SortedIndex()
+        self.entries = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def copy(self) -> 'StreamIndex':
+        """
+        Return an independent copy (StreamList changes copies, never the
+        index of a published snapshot)
+        """
+        clone = StreamIndex()
+        clone.sorted = {name: index.copy() for name, index in self.sorted.items()}
+        clone.keys = self.keys.copy()
+        clone.entries = dict(self.entries)
+        return clone
+
+    def update(self, stream: 'Stream'):
+        """
+        (Re-)index a stream after it was added or changed. Only the orders
+        whose sort value changed are touched
+        """
+        if stream.key is None or not stream.active or stream.unlisted:
+            self.discard(stream.key)
+            return
+        items = {name: (sort(stream), stream.key) for name, sort in SORTS.items()}
+        entry = self.entries.get(stream.key)
+        if entry is None:
+            for name, item in items.items():
+                self.sorted[name].add(item)
+            self.keys.add((stream.key,))
+        else:
+            for name, item in items.items():
+                if entry[1][name] != item:
+                    self.sorted[name].remove(entry[1][name])
+                    self.sorted[name].add(item)
+        self.entries[stream.key] = (stream, items)
+
+    def discard(self, key: str):
+        """
+        Remove a stream from the index if it is in there
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        stream, items = entry
+        for name, item in items.items():
+            self.sorted[name].remove(item)
+        self.keys.remove((key,))
+
+    def page(self, sort: str, prefix: Optional[str]=None, cursor: Optional[str]=None, limit: int=50) -> Tuple[List['Stream'], Optional[str]]:
+        """
+        Return a page of up to limit streams in the given order, following the
+        cursor of the previous page, and the cursor of the next page (None if
+        this was the last page). Raises ValueError on an invalid sort or cursor.
+
+        Without a prefix this costs O(log n + limit). With a prefix the m
+        matching streams are looked up in the key index and sorted, which costs
+        O(log n + m log m)
+        """
+        if sort not in self.sorted:
+            raise ValueError("Invalid sort \"{}\", use one of: {}".format(sort, ", ".join(self.sorted.keys())))
+        after = decode_cursor(cursor) if cursor else None
+
+        if prefix:
+            items = sorted(self.entries[key][1][sort] for key, in self.keys.prefixed(prefix))
+            i = 0 if after is None else bisect.bisect_right(items, after)
+            items = items[i:i + limit + 1]
+        else:
+            items = self.sorted[sort].after(after, limit + 1)
+
+        # One item more than needed tells whether there is a next page
+        next_cursor = encode_cursor(items[limit - 1]) if len(items) > limit else None
+        return [self.entries[key][0] for _, key in items[:limit]], next_cursor
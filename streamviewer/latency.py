@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import math
+import time
+from collections import Counter
+from typing import Optional, List
+
+
+class QuantileSketch():
+    """
+    Streaming quantiles in bounded memory. Values are counted in buckets whose
+    bounds grow exponentially, so every quantile is accurate to within the
+    relative accuracy (2% by default) and values between min_value and
+    max_value never need more than a few hundred buckets
+    """
+    def __init__(self, accuracy: float=0.02, min_value: float=0.01, max_value: float=3600):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.max_value = max_value
+        self.buckets = Counter()
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, value: float):
+        value = min(max(float(value), self.min_value), self.max_value)
+        self.buckets[math.ceil(math.log(value) / self.log_gamma)] += 1
+        self.count += 1
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """
+        Return a new sketch with the values of both
+        """
+        merged = QuantileSketch(self.accuracy, self.min_value, self.max_value)
+        merged.buckets = self.buckets + other.buckets
+        merged.count = self.count + other.count
+        return merged
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Return the q-quantile (e.g. 0.95), None if no values were added
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for i in sorted(self.buckets.keys()):
+            seen += self.buckets[i]
+            if seen > rank:
+                break
+        # The middle of the bucket, relative to its bounds
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+
+class LatencyWindow():
+    """
+    The reports of one stream within a time window
+    """
+    def __init__(self):
+        self.latency = QuantileSketch()
+        self.first_frame = QuantileSketch()
+        self.stalls = 0
+        self.seconds = 0.0
+        self.reports = 0
+
+
+class LatencyStats():
+    """
+    Aggregates the live latency (distance of the player to the live edge) and
+    stalls reported by the players of each stream. Reports are kept in two
+    windows per stream, the current and the previous one, so the numbers cover
+    the last one to two windows and the memory per stream stays bounded.
+
+    This uses a builder pattern, like the StreamList:
+    latency = LatencyStats().set_window(300)
+    """
+    def __init__(self):
+        self.window = 300.0
+        self.max_samples = 30
+        self.streams = {}
+
+    def set_window(self, seconds: float) -> 'LatencyStats':
+        """
+        Set the seconds after which reports are rotated out
+        """
+        self.window = float(seconds)
+        return self
+
+    def set_max_samples(self, n: int) -> 'LatencyStats':
+        """
+        Set the number of latency samples taken from a single report
+        """
+        self.max_samples = int(n)
+        return self
+
+    def windows(self, key: str, now: float) -> tuple:
+        """
+        Return the (start, current, previous) windows of the stream, rotated
+        if the current window is over
+        """
+        start, current, previous = self.streams.get(key, (now, LatencyWindow(), LatencyWindow()))
+        if now - start >= 2 * self.window:
+            start, current, previous = now, LatencyWindow(), LatencyWindow()
+        elif now - start >= self.window:
+            start, current, previous = start + self.window, LatencyWindow(), current
+        self.streams[key] = (start, current, previous)
+        return self.streams[key]
+
+    def report(self, key: str, samples: List[float], stalls: int, seconds: float):
+        """
+        Add a report of a player: latency samples in seconds, the number of
+        stalls and the seconds it was playing since the last report
+        """
+        _, current, _ = self.windows(key, time.monotonic())
+        for sample in samples[:self.max_samples]:
+            current.latency.add(sample)
+        current.stalls += max(0, int(stalls))
+        current.seconds += max(0.0, float(seconds))
+        current.reports += 1
+
+    def report_first_frame(self, key: str, seconds: float):
+        """
+        Add the seconds a player needed from the page load to the first frame
+        """
+        _, current, _ = self.windows(key, time.monotonic())
+        current.first_frame.add(seconds)
+
+    def forget(self, key: str):
+        self.streams.pop(key, None)
+
+    def summary(self, key: str) -> Optional[dict]:
+        """
+        Return p50 and p95 of the latency and of the time to the first frame
+        and the stalls per minute of playback of a stream, None if there are
+        no reports
+        """
+        if key not in self.streams:
+            return None
+        _, current, previous = self.windows(key, time.monotonic())
+        latency = current.latency.merge(previous.latency)
+        seconds = current.seconds + previous.seconds
+        reports = current.reports + previous.reports
+        first_frame = current.first_frame.merge(previous.first_frame)
+        if reports == 0 and len(first_frame) == 0:
+            return None
+        return {
+            "p50": latency.quantile(0.5),
+            "p95": latency.quantile(0.95),
+            "stalls_per_minute": (current.stalls + previous.stalls) * 60 / seconds if seconds > 0 else None,
+            "reports": reports,
+            "first_frame_p50": first_frame.quantile(0.5),
+            "first_frame_p95": first_frame.quantile(0.95),
+        }
+
+    def summaries(self) -> dict:
+        """
+        Return the summaries of all streams with reports, streams without
+        recent reports are forgotten
+        """
+        summaries = {}
+        for key in list(self.streams.keys()):
+            summary = self.summary(key)
+            if summary is None:
+                # Nothing reported for two windows
+                self.forget(key)
+            else:
+                summaries[key] = summary
+        return summaries
@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Headless load generator for streamviewer
+
+Starts streamviewer in a single eventlet gunicorn worker (like in
+examples/streamviewer.service) or under uvicorn (--engine asgi), replaces
+nginx-rtmp by a stand-in that writes fake HLS playlists and POSTs
+/on_publish and /on_publish_done, and attaches
+a growing number of viewers which speak the same protocol as
+static/sync-stream.js (socket.io) and static/sync-streamlist.js (server-sent
+events from /events/streams, /api/streams while they are down).
+
+For every step it reports the latency from the nginx callback until the
+clients received the update as well as the CPU usage and RSS of the worker.
+
+Needs the loadtest extra: poetry install -E loadtest
+"""
+import os, sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.error
+import urllib.request
+import urllib.parse
+from pathlib import Path
+from typing import List, Optional
+
+
+# The config used for the server under test
+LOADTEST_CONFIG = """
+[application]
+loglevel = "Warning"
+hls_path = "{hls_path}"
+max_streams = {max_streams}
+free_choice = true
+hls_tokens = "all"
+hls_token_secret = "{secret}"
+
+[stream]
+key = []
+"""
+
+
+# Secret of the viewing tokens of the server under test
+TOKEN_SECRET = "loadtest"
+
+
+def write_config(directory: Path, hls_path: Path, max_streams: int) -> Path:
+    """
+    Write the config for the server under test and return its path
+    """
+    config_path = directory / "loadtest.toml"
+    config_path.write_text(LOADTEST_CONFIG.format(hls_path=hls_path, max_streams=max_streams, secret=TOKEN_SECRET))
+    return config_path
+
+
+def start_server(config_path: Path, port: int, engine: str="eventlet") -> subprocess.Popen:
+    """
+    Start streamviewer the same way the systemd service does, in a single
+    eventlet gunicorn worker or (with the engine "asgi") under uvicorn
+    """
+    env = dict(os.environ)
+    env["STREAMVIEWER_CONFIG_PATH"] = str(config_path)
+    if engine == "asgi":
+        return subprocess.Popen([sys.executable, "-m", "uvicorn", "--workers", "1",
+                                 "--host", "127.0.0.1", "--port", str(port),
+                                 "--log-level", "warning",
+                                 "streamviewer.asgi:app"], env=env)
+    return subprocess.Popen([sys.executable, "-m", "gunicorn",
+                             "--worker-class", "eventlet", "-w", "1",
+                             "-b", "127.0.0.1:{}".format(port),
+                             "streamviewer.server:app"], env=env)
+
+
+def wait_for_server(base_url: str, timeout: float=30) -> bool:
+    """
+    Poll the server until it answers or the timeout is reached
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + "/", timeout=1)
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def worker_pid(pid: int) -> int:
+    """
+    Return the pid of the first child of pid (the gunicorn worker),
+    or pid itself if it has no children
+    """
+    for stat in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            return int(stat.parent.name)
+    return pid
+
+
+def process_usage(pid: int) -> Optional[tuple]:
+    """
+    Return the consumed CPU seconds and the RSS in bytes of a process
+    (None if /proc is not available)
+    """
+    try:
+        fields = Path("/proc/{}/stat".format(pid)).read_text().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+    return cpu_seconds, rss
+
+
+class FakeNginx():
+    """
+    Stands in for the nginx rtmp module: writes HLS playlists and segments to
+    the hls_path and notifies streamviewer via its callbacks
+    """
+    def __init__(self, base_url: str, hls_path: Path, fragment: float=3, playlist_length: float=30):
+        self.base_url = base_url
+        self.hls_path = hls_path
+        self.fragment = fragment
+        self.playlist_length = playlist_length
+        self.sent = {}
+
+    def callback(self, path: str, key: str) -> int:
+        """
+        POST to a callback the way nginx-rtmp does it, return the status code
+        """
+        data = urllib.parse.urlencode({"call": path.strip("/"), "app": "live", "name": key}).encode()
+        # The callbacks are only accepted from localhost
+        req = urllib.request.Request(self.base_url + path, data=data, headers={"Host": "localhost"})
+        try:
+            with urllib.request.urlopen(req, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def write_playlist(self, key: str, sequence: int):
+        """
+        Write a live playlist with the segments that would exist right now
+        """
+        segments = max(1, int(self.playlist_length / self.fragment))
+        first = max(0, sequence - segments + 1)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-MEDIA-SEQUENCE:{}".format(first),
+                 "#EXT-X-TARGETDURATION:{}".format(int(self.fragment))]
+        for n in range(first, sequence + 1):
+            (self.hls_path / "{}-{}.ts".format(key, n)).write_bytes(b"\x47" + b"\xff" * 187)
+            lines += ["#EXTINF:{:.3f},".format(self.fragment), "{}-{}.ts".format(key, n)]
+        (self.hls_path / "{}.m3u8".format(key)).write_text("\n".join(lines) + "\n")
+
+    def publish(self, key: str) -> int:
+        self.write_playlist(key, 0)
+        self.sent[("stream_added", key)] = time.monotonic()
+        return self.callback("/on_publish", key)
+
+    def publish_done(self, key: str) -> int:
+        self.sent[("stream_removed", key)] = time.monotonic()
+        status = self.callback("/on_publish_done", key)
+        for p in self.hls_path.glob("{}*".format(key)):
+            p.unlink()
+        return status
+
+
+class Viewer():
+    """
+    A client replaying sync-streamlist.js (kind "list", server-sent events) or
+    sync-stream.js (kind "stream", socket.io)
+    """
+    def __init__(self, base_url: str, kind: str, key: Optional[str]=None):
+        self.base_url = base_url
+        self.kind = kind
+        self.key = key
+        self.received = {}
+        self.client = None
+        self.events = None
+        self.last_id = None
+        self.retry = 2.0
+        self.closed = False
+        if kind == "list":
+            import eventlet
+            self.connect_events()
+            self.reader = eventlet.spawn(self.read_events)
+        else:
+            import socketio
+            self.client = socketio.Client(reconnection=False)
+            self.client.on("connect", self.on_connect)
+            self.client.on("streams_changed", self.on_streams_changed)
+            self.client.connect(base_url)
+
+    def on_connect(self):
+        self.client.emit("join", {"key": self.key})
+        self.client.emit("stream_info", {"key": self.key})
+
+    def connect_events(self):
+        """
+        Open /events/streams like an EventSource, reconnects send the id of
+        the last event so only the missed ones are sent again
+        """
+        headers = {"Accept": "text/event-stream"}
+        if self.last_id is not None:
+            headers["Last-Event-ID"] = self.last_id
+        request = urllib.request.Request(self.base_url + "/events/streams", headers=headers)
+        # The server sends a keepalive at least every 15 seconds
+        self.events = urllib.request.urlopen(request, timeout=30)
+
+    def read_events(self):
+        import eventlet
+        while not self.closed:
+            try:
+                if self.events is None:
+                    self.connect_events()
+                self.dispatch(self.events)
+            except (OSError, ValueError):
+                pass
+            self.events = None
+            if not self.closed:
+                eventlet.sleep(self.retry)
+
+    def dispatch(self, lines):
+        """
+        Parse the event stream line by line and handle the streams events
+        """
+        event, data = "message", []
+        for line in lines:
+            line = line.decode("utf-8").rstrip("\r\n")
+            if not line:
+                if event == "streams" and data:
+                    self.on_streams_changed(json.loads("\n".join(data)))
+                event, data = "message", []
+                continue
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "id":
+                self.last_id = value
+            elif field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+            elif field == "retry" and value.isdigit():
+                self.retry = int(value) / 1000
+
+    def on_streams_changed(self, data):
+        now = time.monotonic()
+        for key in data["added"]:
+            self.received[("stream_added", key)] = now
+        for key in data["removed"]:
+            self.received[("stream_removed", key)] = now
+
+    def poll(self):
+        """
+        sync-streamlist.js fetches the list page by page every four seconds
+        while its events are not connected
+        """
+        if self.kind == "list" and self.events is None:
+            self.fetch_list()
+
+    def fetch_list(self):
+        cursor = None
+        while True:
+            url = self.base_url + "/api/streams?sort=started&limit=100&projection=list"
+            if cursor is not None:
+                url += "&cursor=" + urllib.parse.quote(cursor)
+            try:
+                with urllib.request.urlopen(url, timeout=10) as response:
+                    cursor = json.loads(response.read().decode("utf-8"))["cursor"]
+            except (OSError, ValueError, KeyError):
+                return
+            if cursor is None:
+                return
+
+    def close(self):
+        if self.kind == "list":
+            self.closed = True
+            self.reader.kill()
+            if self.events is not None:
+                self.events.close()
+            return
+        self.client.emit("leave", {"key": self.key})
+        self.client.disconnect()
+
+
+def latencies(nginx: 'FakeNginx', viewers: List['Viewer']) -> List[float]:
+    """
+    Return the propagation latencies (in seconds) of all events sent by nginx
+    and received by the viewers
+    """
+    return [v.received[event] - sent
+            for event, sent in nginx.sent.items()
+            for v in viewers if event in v.received]
+
+
+def run_step(nginx: 'FakeNginx', viewers: List['Viewer'], cycles: int, pid: int) -> dict:
+    """
+    Publish and end cycles streams with nginx-like timing while the viewers are
+    attached and return the measurements of this step
+    """
+    import eventlet
+    nginx.sent.clear()
+    for v in viewers:
+        v.received.clear()
+
+    before = process_usage(pid)
+    started = time.monotonic()
+    keys = ["load-{}".format(i) for i in range(cycles)]
+    for key in keys:
+        nginx.publish(key)
+        # Publishers don't all connect at the same time
+        eventlet.sleep(random.uniform(0.05, 0.3))
+    for i, key in enumerate(keys):
+        if i % 10 == 0:
+            for v in viewers:
+                v.poll()
+        nginx.write_playlist(key, 1)
+        nginx.publish_done(key)
+        eventlet.sleep(random.uniform(0.05, 0.3))
+    # Give the last events some time to arrive
+    eventlet.sleep(2)
+    elapsed = time.monotonic() - started
+    after = process_usage(pid)
+
+    values = sorted(latencies(nginx, viewers))
+    # Both kinds of viewers receive the broadcasts
+    expected = len(nginx.sent) * len(viewers)
+    result = {"viewers": len(viewers), "events": len(values), "expected": expected}
+    if values:
+        result["p50"] = statistics.median(values) * 1000
+        result["p95"] = values[int(len(values) * 0.95) - 1] * 1000
+        result["max"] = values[-1] * 1000
+    if before is not None and after is not None:
+        result["cpu"] = (after[0] - before[0]) / elapsed * 100
+        result["rss"] = after[1] / 1024 / 1024
+    return result
+
+
+def auth_benchmark(base_url: str, key: str, rate: int, seconds: float, connections: int) -> dict:
+    """
+    Send nginx-like /auth/hls requests for the segments of a stream with a
+    valid viewing token at the given rate (requests per second) over
+    keep-alive connections and return the achieved rate and latencies
+    """
+    import eventlet
+    import http.client
+    from .tokens import ViewingTokens, token_cookie
+
+    token = ViewingTokens(TOKEN_SECRET).issue(key)
+    netloc = urllib.parse.urlsplit(base_url).netloc
+    times = []
+    denied = [0]
+    interval = connections / rate
+    deadline = time.monotonic() + seconds
+
+    def client(n: int):
+        connection = http.client.HTTPConnection(netloc, timeout=5)
+        next_request = time.monotonic() + random.uniform(0, interval)
+        i = 0
+        while next_request < deadline:
+            eventlet.sleep(max(0, next_request - time.monotonic()))
+            headers = {"Host": "localhost",
+                       "X-Original-URI": "/hls/{}-{}.ts".format(key, (n + i) % 10),
+                       "Cookie": "{}={}".format(token_cookie(key), token)}
+            start = time.monotonic()
+            connection.request("GET", "/auth/hls", headers=headers)
+            response = connection.getresponse()
+            response.read()
+            times.append(time.monotonic() - start)
+            if response.status != 204:
+                denied[0] += 1
+            next_request += interval
+            i += 1
+        connection.close()
+
+    started = time.monotonic()
+    pool = eventlet.GreenPool(connections)
+    for n in range(connections):
+        pool.spawn(client, n)
+    pool.waitall()
+    elapsed = time.monotonic() - started
+
+    values = sorted(times)
+    return {
+        "requests": len(values),
+        "denied": denied[0],
+        "rate": len(values) / elapsed,
+        "p50": statistics.median(values) * 1000 if values else float("nan"),
+        "p99": values[int(len(values) * 0.99) - 1] * 1000 if values else float("nan"),
+    }
+
+
+def print_result(result: dict):
+    print("{viewers:>8} viewers  {events:>8}/{expected:<8} events  "
+          "p50 {p50:8.1f} ms  p95 {p95:8.1f} ms  max {max:8.1f} ms  "
+          "cpu {cpu:6.1f} %  rss {rss:7.1f} MiB".format(**dict(
+              {"p50": float("nan"), "p95": float("nan"), "max": float("nan"),
+               "cpu": float("nan"), "rss": float("nan")}, **result)), flush=True)
+
+
+def main():
+    """
+    Entry point for streamviewer-loadtest
+    """
+    parser = argparse.ArgumentParser(description="Load test streamviewer with fake nginx-rtmp callbacks and simulated viewers")
+    parser.add_argument("--viewers", type=int, nargs="+", default=[10, 100, 500, 1000, 2000],
+                        help="number of concurrent viewers for each step")
+    parser.add_argument("--stream-viewers", type=float, default=0.5,
+                        help="fraction of viewers that watch a stream instead of the list")
+    parser.add_argument("--cycles", type=int, default=20,
+                        help="number of streams published and ended per step")
+    parser.add_argument("--auth-rate", type=int, default=None,
+                        help="benchmark /auth/hls at this many requests per second instead")
+    parser.add_argument("--auth-seconds", type=float, default=10)
+    parser.add_argument("--engine", choices=["eventlet", "asgi"], default="eventlet",
+                        help="serve with the eventlet worker or the ASGI entry point under uvicorn")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", default=None,
+                        help="test an already running server instead of starting one")
+    args = parser.parse_args()
+
+    import eventlet
+    eventlet.monkey_patch()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        hls_path = tmp / "hls"
+        hls_path.mkdir()
+
+        server = None
+        if args.url is None:
+            base_url = "http://127.0.0.1:{}".format(args.port)
+            server = start_server(write_config(tmp, hls_path, args.cycles + 10), args.port, args.engine)
+        else:
+            base_url = args.url.rstrip("/")
+
+        try:
+            if not wait_for_server(base_url):
+                print("Server at {} did not come up".format(base_url), file=sys.stderr)
+                exit(1)
+            pid = worker_pid(server.pid) if server is not None else None
+            nginx = FakeNginx(base_url, hls_path)
+
+            # A stream the stream viewers can join
+            nginx.publish("watched")
+
+            if args.auth_rate is not None:
+                result = auth_benchmark(base_url, "watched", args.auth_rate, args.auth_seconds, connections=50)
+                print("{requests:>8} auth requests  {rate:8.0f}/s  {denied} denied  "
+                      "p50 {p50:6.2f} ms  p99 {p99:6.2f} ms".format(**result), flush=True)
+                return
+
+            viewers = []
+            for n in sorted(args.viewers):
+                pool = eventlet.GreenPool(200)
+                missing = n - len(viewers)
+                kinds = ["stream" if random.random() < args.stream_viewers else "list" for _ in range(missing)]
+                viewers += list(pool.imap(lambda kind: Viewer(base_url, kind, "watched"), kinds))
+                result = run_step(nginx, viewers, args.cycles, pid)
+                print_result(result)
+
+            for v in viewers:
+                v.close()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
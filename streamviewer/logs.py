@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import copy
+import atexit
+import importlib
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from collections import Counter
+
+
+def original_module(name: str):
+    """
+    Return the unpatched standard library module with the given name. Under the
+    eventlet worker threading and queue are monkey patched, so a "thread" would
+    just be another greenlet sharing the hub with the request handlers
+    """
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return importlib.import_module(name)
+    return patcher.original(name)
+
+
+# Log records are put on this queue by the request handlers and written out by
+# a real background thread, so a slow error stream never blocks the event loop
+LOG_QUEUE = original_module("queue").Queue(-1)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that merges the message with its arguments (and renders the
+    traceback) in the calling thread, like the default QueueHandler, but leaves
+    the formatting of the log line to the listener thread.
+
+    The arguments must not travel on the queue: they could be changed by the
+    caller before the listener gets to them, or hold on to large objects.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class BackgroundQueueListener(QueueListener):
+    """
+    A QueueListener that runs its monitor in a real OS thread even if eventlet
+    monkey patched the threading module
+    """
+    def start(self):
+        threading = original_module("threading")
+        self._thread = t = threading.Thread(target=self._monitor)
+        t.daemon = True
+        t.start()
+
+
+class EventSampler(logging.Filter):
+    """
+    Lets only every n-th record of a high frequency event through. Records are
+    tagged with an event via the extra argument, e.g.:
+    logger.info("Client joined %s", key, extra={"event": "join"})
+    Records without an event, or with an event that has no rate, always pass.
+    """
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self.counters = Counter()
+
+    def filter(self, record) -> bool:
+        event = getattr(record, "event", None)
+        rate = self.rates.get(event)
+        if rate is None or rate <= 1:
+            return True
+        self.counters[event] += 1
+        return self.counters[event] % rate == 1
+
+
+def queue_handler(stream, format: str) -> 'NonBlockingQueueHandler':
+    """
+    Factory used by the dictConfig in config.py. Starts a listener which writes
+    the records from LOG_QUEUE to the given stream and returns the handler that
+    feeds the queue
+    """
+    target = logging.StreamHandler(stream)
+    target.setFormatter(logging.Formatter(format))
+    listener = BackgroundQueueListener(LOG_QUEUE, target, respect_handler_level=True)
+    listener.start()
+    # Flush the remaining records on shutdown
+    atexit.register(listener.stop)
+    return NonBlockingQueueHandler(LOG_QUEUE)
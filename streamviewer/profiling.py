@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import io
+import sys
+import time
+import random
+import pstats
+import cProfile
+import functools
+import traceback
+from typing import Optional, Callable
+
+from .logs import original_module
+
+
+class Profiler():
+    """
+    Opt-in profiling of the single eventlet worker.
+
+    A fraction of the HTTP requests and socket.io events (sample_rate) runs
+    under cProfile. The stats of all samples are added up and logged (and
+    dumped to dump_path if set) every dump_interval seconds.
+
+    While profiling is enabled a watchdog thread also checks that the event
+    loop keeps turning: a greenlet updates a heartbeat every few milliseconds,
+    if it is older than block_threshold the loop is blocked and the stack of
+    whatever holds it gets logged (once per stall). The heartbeat stops while
+    profiling is disabled. Under ASGI background tasks are threads, the beats
+    are run on the event loop then (see AsyncSocketIO.run_on_loop).
+
+    This uses a builder pattern, like the StreamList:
+    profiler = Profiler(socketio, logger).set_sample_rate(0.01).set_enabled()
+    """
+    def __init__(self, socketio, logger):
+        self.socketio = socketio
+        self.logger = logger
+        self.enabled = False
+        self.sample_rate = 0.01
+        self.dump_interval = 60.0
+        self.dump_path = None
+        self.block_threshold = 0.1
+        self.stats = None
+        self.samples = 0
+        self.active = False
+        self.blocked = 0
+        self.beat = time.monotonic()
+        self.beating = False
+        self.started = False
+        self.thread_id = None
+
+    def set_enabled(self, enabled: bool=True) -> 'Profiler':
+        """
+        Enable or disable profiling, the background tasks are started the
+        first time it gets enabled
+        """
+        self.enabled = enabled
+        if enabled and not self.started:
+            self.start()
+        elif enabled and not self.beating:
+            self.start_heartbeat()
+        self.logger.info("Profiling %s", "enabled" if enabled else "disabled")
+        return self
+
+    def set_sample_rate(self, rate: float) -> 'Profiler':
+        """
+        Set the fraction (0.0 to 1.0) of requests and events that get profiled
+        """
+        self.sample_rate = min(max(float(rate), 0.0), 1.0)
+        return self
+
+    def set_dump_interval(self, seconds: float) -> 'Profiler':
+        """
+        Set the seconds between two dumps of the collected stats
+        """
+        self.dump_interval = float(seconds)
+        return self
+
+    def set_dump_path(self, path: Optional[str]) -> 'Profiler':
+        """
+        Set the file the stats get dumped to (readable with pstats or
+        snakeviz), None or "" only logs them
+        """
+        self.dump_path = path or None
+        return self
+
+    def set_block_threshold(self, milliseconds: float) -> 'Profiler':
+        """
+        Set the milliseconds after which a blocked event loop gets logged
+        """
+        self.block_threshold = float(milliseconds) / 1000
+        return self
+
+    def start(self):
+        self.started = True
+        self.thread_id = original_module("threading").get_ident()
+        self.start_heartbeat()
+        self.socketio.start_background_task(self.run)
+        watchdog = original_module("threading").Thread(target=self.watchdog)
+        watchdog.daemon = True
+        watchdog.start()
+
+    def should_sample(self) -> bool:
+        # cProfile profiles the whole OS thread, so only one sample at a time
+        return self.enabled and not self.active and random.random() < self.sample_rate
+
+    def call(self, function: Callable, *args, **kwargs):
+        """
+        Call the function, profile the call if it is sampled
+        """
+        if not self.should_sample():
+            return function(*args, **kwargs)
+        self.active = True
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            self.active = False
+            self.add(profile)
+
+    def add(self, profile: cProfile.Profile):
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+        self.samples += 1
+
+    def profiled(self, function: Callable) -> Callable:
+        """
+        Decorator for socket.io event handlers
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.call(function, *args, **kwargs)
+        return wrapper
+
+    def middleware(self, wsgi_app: Callable, skip=("/socket.io", "/events")) -> Callable:
+        """
+        Wrap a WSGI app so its requests get sampled. Long-lived requests under
+        the skipped paths are left alone, only the time until the response
+        starts is profiled anyway
+        """
+        def app(environ, start_response):
+            if environ.get("PATH_INFO", "").startswith(skip):
+                return wsgi_app(environ, start_response)
+            return self.call(wsgi_app, environ, start_response)
+        return app
+
+    def run(self):
+        while True:
+            self.socketio.sleep(self.dump_interval)
+            self.dump()
+
+    def dump(self, limit: int=25):
+        """
+        Log the functions with the highest cumulative time of all samples
+        since the last dump, then start over
+        """
+        stats, self.stats = self.stats, None
+        samples, self.samples = self.samples, 0
+        if stats is None:
+            return
+        if self.dump_path is not None:
+            stats.dump_stats(self.dump_path)
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(limit)
+        self.logger.info("Profile of %s sampled requests and events:\n%s", samples, out.getvalue())
+
+    def start_heartbeat(self):
+        # The last beat is from before it stopped, the watchdog would take
+        # that for a blocked loop
+        self.beat = time.monotonic()
+        self.beating = True
+        self.socketio.start_background_task(self.heartbeat)
+
+    def heartbeat(self):
+        run_on_loop = getattr(self.socketio, "run_on_loop", None)
+        while self.enabled:
+            if run_on_loop is None or not run_on_loop(self.beat_on_loop):
+                self.beat = time.monotonic()
+            self.socketio.sleep(self.block_threshold / 4)
+        self.beating = False
+
+    def beat_on_loop(self):
+        # The stack of this thread gets logged when the loop is blocked
+        self.thread_id = original_module("threading").get_ident()
+        self.beat = time.monotonic()
+
+    def watchdog(self):
+        """
+        Runs in a real OS thread, so it keeps running while the loop is blocked
+        """
+        sleep = original_module("time").sleep
+        reported = None
+        while True:
+            sleep(self.block_threshold / 2)
+            beat = self.beat
+            if not self.enabled or time.monotonic() - beat < self.block_threshold or reported == beat:
+                continue
+            reported = beat
+            self.blocked += 1
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no stack)"
+            self.logger.warning("Event loop blocked for more than %.0f ms in:\n%s", self.block_threshold * 1000, stack)
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "samples": self.samples,
+            "blocked": self.blocked,
+        }
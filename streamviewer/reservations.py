@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+from typing import Optional
+
+
+class Reservation():
+    """
+    Reserves all stream keys starting with a prefix, e.g. the config entry
+    name = "team-a-*" reserves "team-a-foo", "team-a-bar" and so on. Streams
+    under a reservation are created when their key is published for the
+    first time, not when the config is read.
+    """
+    def __init__(self, pattern: str, password: Optional[str]=None, description: Optional[str]=None, unlisted: bool=False, quota: Optional[int]=None):
+        self.pattern = pattern
+        self.prefix = pattern.rstrip("*")
+        self.password = password
+        self.description = description
+        self.unlisted = unlisted
+        self.quota = quota
+
+    def __str__(self) -> str:
+        return self.pattern
+
+    def is_valid_password(self, password) -> bool:
+        return self.password is None or password == self.password
+
+
+class ReservationTrie():
+    """
+    A prefix trie of reservations. Resolving a key walks it once character by
+    character, so it costs O(length of the key) no matter how many patterns
+    there are. The longest matching prefix wins.
+    """
+    def __init__(self):
+        self.root = {}
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, reservation: 'Reservation'):
+        node = self.root
+        for c in reservation.prefix:
+            node = node.setdefault(c, {})
+        if None not in node:
+            self.count += 1
+        # The reservation is stored under None, which is never a character
+        node[None] = reservation
+
+    def match(self, key: str) -> Optional['Reservation']:
+        """
+        Return the reservation with the longest prefix of key, None if there
+        is none
+        """
+        node = self.root
+        match = node.get(None)
+        for c in key:
+            node = node.get(c)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
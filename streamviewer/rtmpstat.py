@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Ingest metrics from the rtmp_stat page of nginx-rtmp
+
+The stat page is an XML document with one <stream> per published stream of
+each application, e.g.:
+
+<rtmp><server><application><name>live</name><live>
+    <stream>
+        <name>foo</name><time>61234</time><bw_in>2513024</bw_in>
+        <meta><video><width>1280</width><height>720</height>
+        <frame_rate>30</frame_rate><codec>H264</codec></video>
+        <audio><codec>AAC</codec></audio></meta>
+        <nclients>1</nclients><publishing/><active/>
+    </stream>
+</live></application></server></rtmp>
+"""
+import time
+import http.client
+import urllib.parse
+import xml.etree.ElementTree as ET
+from typing import Optional
+
+
+def int_or_none(text: Optional[str]) -> Optional[int]:
+    try:
+        return int(float(text))
+    except (TypeError, ValueError):
+        return None
+
+
+def stream_metrics(stream: ET.Element, now: float) -> dict:
+    """
+    Return the ingest metrics of a <stream> element
+    """
+    bw_in = int_or_none(stream.findtext("bw_in"))
+    uptime = int_or_none(stream.findtext("time"))
+    return {
+        "bitrate": bw_in // 1000 if bw_in is not None else None,
+        "width": int_or_none(stream.findtext("meta/video/width")),
+        "height": int_or_none(stream.findtext("meta/video/height")),
+        "fps": int_or_none(stream.findtext("meta/video/frame_rate")),
+        "video_codec": stream.findtext("meta/video/codec"),
+        "audio_codec": stream.findtext("meta/audio/codec"),
+        "clients": int_or_none(stream.findtext("nclients")),
+        # <time> are the milliseconds since publishing started
+        "publishing_since": round(now - uptime / 1000) if uptime is not None else None,
+    }
+
+
+def parse_stat(source, application: str) -> dict:
+    """
+    Parse the stat XML from a file-like object and return the metrics of the
+    published streams of the application by key. The document is parsed while
+    it is read and every <stream> is dropped once it was handled, so big stat
+    pages don't pile up in memory
+    """
+    now = time.time()
+    streams = {}
+    path = []
+    current_application = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            path.append(elem.tag)
+            continue
+        path.pop()
+        if elem.tag == "name" and path and path[-1] == "application":
+            current_application = elem.text
+        elif elem.tag == "stream":
+            key = elem.findtext("name")
+            if current_application == application and key and elem.find("publishing") is not None:
+                streams[key] = stream_metrics(elem, now)
+            elem.clear()
+        elif elem.tag == "application":
+            current_application = None
+            elem.clear()
+    return streams
+
+
+def changed(old: Optional[dict], new: Optional[dict], tolerance: float=0.1) -> bool:
+    """
+    Return True if the metrics changed enough to be published. The bitrate
+    jitters from poll to poll, so it only counts if it changed by more than the
+    tolerance, and publishing_since by more than a rounding error
+    """
+    if old is None or new is None:
+        return old is not new
+    for name, value in new.items():
+        before = old.get(name)
+        if name == "bitrate" and before and value is not None:
+            if abs(value - before) > before * tolerance:
+                return True
+        elif name == "publishing_since" and before is not None and value is not None:
+            if abs(value - before) > 2:
+                return True
+        elif value != before:
+            return True
+    return False
+
+
+class RTMPStat():
+    """
+    Polls the rtmp_stat page of nginx-rtmp in a background task and attaches
+    the ingest metrics (bitrate, resolution, codecs, publishing start) to the
+    streams. Requests only ever see the metrics of the last poll, a slow stat
+    page delays the next update but never a request.
+
+    This uses a builder pattern, like the StreamList:
+    stat = RTMPStat(socketio, logger, "http://127.0.0.1/stat").set_interval(5)
+    """
+    def __init__(self, socketio, logger, url: str, application: str="live"):
+        self.socketio = socketio
+        self.logger = logger
+        self.url = url
+        self.application = application
+        self.interval = 5.0
+        self.timeout = 1.0
+        self.metrics = {}
+        self.polled = None
+        self.error = None
+
+    def set_interval(self, seconds: float) -> 'RTMPStat':
+        """
+        Set the seconds between two polls
+        """
+        self.interval = float(seconds)
+        return self
+
+    def set_timeout(self, seconds: float) -> 'RTMPStat':
+        """
+        Set the seconds after which a poll of the stat page is given up
+        """
+        self.timeout = float(seconds)
+        return self
+
+    def start(self, streamlist) -> 'RTMPStat':
+        self.socketio.start_background_task(self.run, streamlist)
+        return self
+
+    def run(self, streamlist):
+        while True:
+            self.update(streamlist)
+            self.socketio.sleep(self.interval)
+
+    def fetch(self) -> dict:
+        """
+        Fetch and parse the stat page, raises OSError, http.client.HTTPException
+        or ET.ParseError if it couldn't be read
+        """
+        parts = urllib.parse.urlsplit(self.url)
+        if parts.scheme == "https":
+            connection = http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+        try:
+            connection.request("GET", parts.path or "/")
+            response = connection.getresponse()
+            if response.status != 200:
+                raise http.client.HTTPException("{} answered with status {}".format(self.url, response.status))
+            return parse_stat(response, self.application)
+        finally:
+            connection.close()
+
+    def update(self, streamlist) -> int:
+        """
+        Poll the stat page and publish the metrics that changed as a single
+        change of the streamlist. Returns the number of changed streams
+        """
+        try:
+            metrics = self.fetch()
+        except (OSError, http.client.HTTPException, ET.ParseError) as e:
+            if self.error is None:
+                self.logger.warning("Couldn't read the rtmp stat page %s: %s", self.url, e)
+            self.error = str(e)
+            return 0
+        if self.error is not None:
+            self.logger.info("Read the rtmp stat page %s again", self.url)
+            self.error = None
+
+        # Diff against what the streams carry, streams that were (re-)added
+        # since the last poll get their metrics as well
+        changes = {}
+        published = {s.key: s.ingest for s in streamlist.streams if s.ingest is not None}
+        for key in set(metrics.keys()) | set(published.keys()):
+            if streamlist.get_stream(key) is None:
+                continue
+            if changed(published.get(key), metrics.get(key)):
+                changes[key] = metrics.get(key)
+
+        streamlist.update_ingest(changes)
+        self.metrics = metrics
+        self.polled = time.monotonic()
+        return len(changes)
+
+    def status(self) -> dict:
+        return {
+            "url": self.url,
+            "streams": len(self.metrics),
+            "age": time.monotonic() - self.polled if self.polled is not None else None,
+            "error": self.error,
+        }
@@ -1,33 +1,73 @@
 #!/usr/bin/env python 
 #-*- coding: utf-8 -*-
 import re, os
+import json
+import hmac
+import math
+import uuid
+import zlib
+import logging
 from pathlib import Path
 import datetime as dt
 import subprocess
+from typing import Optional
 import humanize
-from flask import Flask, request, render_template, send_from_directory
+from flask import Flask, Response, request, render_template, send_from_directory, make_response
 from flaskext.markdown import Markdown
-from flask_socketio import SocketIO, join_room, leave_room
+from flask_socketio import SocketIO, ConnectionRefusedError, join_room, leave_room
 
 from .config import initialize_config, APPLICATION_NAME, DEFAULT_CONFIG
-from .streams import Stream, StreamList, value_to_flag, key_if_not_None
+from .logs import EventSampler
+from .broadcast import Broadcaster
+from .health import HealthMonitor, PathFilter
+from .federation import Federation
+from .events import EventBuffer
+from .profiling import Profiler
+from .rtmpstat import RTMPStat
+from .latency import LatencyStats
+from .archive import Archiver
+from .sweeper import Sweeper
+from .webhooks import WebhookDispatcher
+from .admission import SessionAdmission
+from .tokens import ViewingTokens, TOKEN_MODES, token_cookie, hls_stream_key, archive_stream_key, uri_token
+from .streams import Stream, StreamList, PROJECTIONS, wire_list, value_to_flag, key_if_not_None
 
 
 # Initialization
 app = Flask(APPLICATION_NAME, template_folder='../templates', static_folder="../static")
 Markdown(app)
 app.config["SECRET_KEY"] = "b6e8d852-80fb-473d-9437-7e6a65e84875"
-socketio = SocketIO(app)
+# Under uvicorn (streamviewer.asgi) socket.io is served by an asyncio server
+# instead of Flask-SocketIO
+if os.environ.get("STREAMVIEWER_ENGINE") == "asgi":
+    from .engine import AsyncSocketIO
+    socketio = AsyncSocketIO(app)
+else:
+    socketio = SocketIO(app)
 
 # Get some strings
 SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
 HOSTNAME  = subprocess.check_output('hostname').decode('utf8')
-
-# Initialize the configuration (create a default one if needed)
-config = initialize_config(app.logger)
+# The StreamList version starts over with every start of the process, ETags
+# and event ids carry this id as well so they don't match the ones from before
+BOOT_ID = uuid.uuid4().hex[:8]
+
+# Initialize the configuration (create a default one if needed). Config files
+# that can't be read are skipped, the service then runs but isn't ready and
+# refuses all streams: the protected keys and their passwords are unknown
+config_errors = []
+config = initialize_config(app.logger, errors=config_errors)
+if config_errors:
+    app.logger.error("No streams are accepted until the configuration can be read: %s", "; ".join(config_errors))
 config["application"]["hls_path"] = config["application"]["hls_path"].rstrip("/")
 
-    
+# Maximum number of streams on a page of /api/streams
+API_PAGE_LIMIT = 100
+
+# Frequent socket.io events only get logged every n-th time
+SAMPLED_EVENTS = ["connect", "join", "leave", "stream_list", "stream_info", "latency_report"]
+app.logger.addFilter(EventSampler({e: config["application"]["log_sample_rate"] for e in SAMPLED_EVENTS}))
+
 
 # Read the description.md from the static folder
 with open(os.path.join(SCRIPTDIR, "../static/description.md")) as f:
@@ -38,14 +78,123 @@ with open(os.path.join(SCRIPTDIR, "../static/description.md")) as f:
     description = description.replace("[[[RTMP-APP-NAME]]]", config["application"]["rtmp-app-name"])
     description = description.replace("[[[PROTECTIONPERIOD]]]", humanize.naturaldelta(dt.timedelta(minutes=config["application"]["password_protection_period"])))
 
-app.logger.info("{} is ready to take requests: {}".format(APPLICATION_NAME, HOSTNAME))
+app.logger.info("%s is ready to take requests: %s", APPLICATION_NAME, HOSTNAME)
 
 # Create a streamlist
 streamlist = StreamList(app.logger).set_max_streams(config["application"]["max_streams"])\
                                    .set_free_choice(config["application"]["free_choice"])\
-                                   .set_password_protection_period(config["application"]["password_protection_period"])\
-                                   .add_streams_from_config(config)
-
+                                   .set_password_protection_period(config["application"]["password_protection_period"])
+
+# The stream list is ready once it has the protected streams of a configuration
+# that could be read completely
+streamlist_ready = False
+try:
+    streamlist.add_streams_from_config(config)
+    streamlist_ready = not config_errors
+except (KeyError, TypeError, ValueError, AttributeError) as e:
+    app.logger.error("Couldn't add the streams of the configuration, no streams are accepted: %r", e)
+
+# Archive the segments of ended streams
+archiver = None
+if config["application"]["archive"]:
+    archiver = Archiver(app.logger, config["application"]["hls_path"], config["application"]["archive_path"], config["application"]["archive_url"])\
+                    .set_workers(config["application"]["archive_workers"])\
+                    .start()
+    streamlist.set_archiver(archiver)
+
+# Health checks answer from the state kept by the monitor
+monitor = HealthMonitor(socketio, config["application"]["hls_path"])\
+                    .set_max_lag(config["application"]["readiness_max_lag"])\
+                    .set_config_loaded(not config_errors)\
+                    .set_streamlist_ready(streamlist_ready)\
+                    .start()
+
+# Load balancers poll the health checks every second and nginx checks every
+# HLS request with /auth/hls, keep them out of the log
+for name in ["werkzeug", "gunicorn.access"]:
+    logging.getLogger(name).addFilter(PathFilter(["/healthz", "/readyz", "/auth/hls"]))
+
+# Pace new socket.io sessions and spread reconnects after a restart
+admission = SessionAdmission().set_rate(config["application"]["session_admission_rate"])\
+                    .set_burst(config["application"]["session_admission_burst"])\
+                    .set_reconnect_delay(config["application"]["reconnect_delay"], config["application"]["reconnect_delay_max"])
+
+# Stream list updates are sent to the clients in the background, via
+# socket.io and as server-sent events
+event_buffer = EventBuffer(epoch=BOOT_ID)
+broadcaster = Broadcaster(socketio, streamlist, app.logger)\
+                    .set_window(config["application"]["broadcast_window"])\
+                    .set_max_backlog(config["application"]["broadcast_max_backlog"])\
+                    .set_event_buffer(event_buffer)
+
+# Pull and list the streams of other streamviewer instances
+federation = None
+if config["federation"]["enabled"]:
+    federation = Federation(socketio, app.logger)\
+                    .set_interval(config["federation"]["interval"])\
+                    .set_max_staleness(config["federation"]["max_staleness"])\
+                    .add_origins_from_config(config)\
+                    .start()
+
+# Tell other services about streams starting and stopping
+webhooks = None
+if config["webhooks"]["enabled"]:
+    webhooks = WebhookDispatcher(socketio, app.logger)\
+                    .set_batch_window(config["webhooks"]["batch_window"])\
+                    .set_max_batch(config["webhooks"]["max_batch"])\
+                    .set_max_backoff(config["webhooks"]["max_backoff"])\
+                    .add_endpoints_from_config(config)\
+                    .start()
+
+
+# Live latency and stalls reported by the players
+latency = LatencyStats().set_window(config["application"]["latency_window"])
+
+# Remove the files of streams that are gone from the hls_path
+sweeper = None
+if config["application"]["hls_sweeper"]:
+    sweeper = Sweeper(app.logger, config["application"]["hls_path"])\
+                    .set_interval(config["application"]["hls_sweeper_interval"])\
+                    .set_grace(config["application"]["hls_sweeper_grace"])\
+                    .set_io_budget(config["application"]["hls_sweeper_io_budget"])\
+                    .start(streamlist)
+
+# Signed viewing tokens for the HLS files, checked by nginx via /auth/hls
+hls_tokens = config["application"]["hls_tokens"]
+if hls_tokens not in TOKEN_MODES:
+    app.logger.warning("Invalid hls_tokens \"%s\" in the config, use one of: %s. Using \"all\"", hls_tokens, ", ".join(TOKEN_MODES))
+    hls_tokens = "all"
+viewing_tokens = ViewingTokens(config["application"]["hls_token_secret"])\
+                    .set_lifetime(config["application"]["hls_token_lifetime"])
+
+# Attach the ingest metrics reported by nginx-rtmp to the streams
+rtmp_stat = None
+if config["application"]["rtmp_stat_url"]:
+    rtmp_stat = RTMPStat(socketio, app.logger, config["application"]["rtmp_stat_url"], config["application"]["rtmp-app-name"])\
+                    .set_interval(config["application"]["rtmp_stat_interval"])\
+                    .set_timeout(config["application"]["rtmp_stat_timeout"])\
+                    .start(streamlist)
+
+# Opt-in profiling, requests and socket.io events are always wrapped so it can
+# be switched on at runtime
+profiler = Profiler(socketio, app.logger)\
+                    .set_sample_rate(config["application"]["profiling_sample_rate"])\
+                    .set_dump_interval(config["application"]["profiling_dump_interval"])\
+                    .set_dump_path(config["application"]["profiling_dump_path"])\
+                    .set_block_threshold(config["application"]["profiling_block_threshold"])
+if config["application"]["profiling"]:
+    profiler.set_enabled()
+app.wsgi_app = profiler.middleware(app.wsgi_app)
+
+
+# Periodically analyze the newest HLS segments of the active streams
+if config["application"]["analyze_segments"]:
+    from .analyzer import SegmentAnalyzer
+    analyzer = SegmentAnalyzer(socketio, app.logger, config["application"]["hls_path"])\
+                    .set_interval(config["application"]["analyzer_interval"])\
+                    .set_segments_per_stream(config["application"]["analyzer_segments"])\
+                    .set_budget(config["application"]["analyzer_budget"])\
+                    .start(streamlist)
 
 
 @app.errorhandler(404)
@@ -62,12 +211,16 @@ def stream(streamkey):
     """
     If there is a stream, display it, otherwise display a missing message
     """
-    app.logger.info('200, Access to /{}'.format(streamkey))
+    app.logger.info('200, Access to /%s', streamkey)
 
     # Strip potential trailing slashes
     streamkey = streamkey.rstrip("/")
+    version = streamlist.version
     stream = streamlist.get_stream(streamkey)
     streamkey = key_if_not_None(stream, "key", that=streamkey)
+    # The page starts from this state instead of asking for the stream info,
+    # updates older than its version are ignored
+    initial_state = {"version": version, "stream": stream.to_wire_dict() if stream is not None else None}
     description = key_if_not_None(stream, "description")
 
     # Render a different Template if the stream is missing
@@ -75,18 +228,46 @@ def stream(streamkey):
         existed = False
         # Stream was Missing, log warning
         running_since = None
-        app.logger.info("Client {} looked for non-existent stream {}".format(request.remote_addr, streamkey))
+        app.logger.info("Client %s looked for non-existent stream %s", request.remote_addr, streamkey)
     elif stream.active_since() is not None:
         existed = True
-        app.logger.debug("Client requests stream {} ({}/{}.m3u8)".format(streamkey, config["application"]["hls_path"],  streamkey))
+        app.logger.debug("Client requests stream %s (%s/%s.m3u8)", streamkey, config["application"]["hls_path"], streamkey)
         running_since = humanize.naturaldelta(dt.timedelta(seconds=stream.active_since()))
         # Everything ok, return Stream
     else:
         # stream is broken in a different way, also server the not found/not started page
         running_since = None
         existed = False
-        app.logger.info("Client {} looked for non-existent stream {}".format(request.remote_addr, streamkey))
-    return render_template('stream.html', application_name=APPLICATION_NAME, page_title=config["application"]["page_title"], hls_path=config["application"]["hls_path"], streamkey=streamkey, description=description, running_since=running_since, existed=existed)
+        app.logger.info("Client %s looked for non-existent stream %s", request.remote_addr, streamkey)
+
+    # Streams that are not live play their newest archive if there is one
+    archive_url = archiver.latest(streamkey) if archiver is not None and not existed else None
+
+    response = make_response(render_template('stream.html', application_name=APPLICATION_NAME, page_title=config["application"]["page_title"], hls_path=config["application"]["hls_path"], hls_url="/hls", origin=None, streamkey=streamkey, description=description, running_since=running_since, existed=existed, archive_url=archive_url, initial_state=initial_state, latency_report_rate=config["application"]["latency_report_rate"], latency_report_interval=config["application"]["latency_report_interval"], reconnect_delay=admission.reconnect_delay, reconnect_delay_max=admission.reconnect_delay_max))
+    # The player sends the viewing token with every HLS request as a cookie
+    # (also if the stream didn't start yet, it may be unlisted once it does)
+    if hls_tokens != "off":
+        token = viewing_tokens.issue(streamkey)
+        response.set_cookie(token_cookie(streamkey), token, max_age=viewing_tokens.lifetime, path="/hls", httponly=True, samesite="Lax")
+        if archiver is not None:
+            response.set_cookie(token_cookie(streamkey), token, max_age=viewing_tokens.lifetime, path=config["application"]["archive_url"], httponly=True, samesite="Lax")
+    return response
+
+
+@app.route('/origins/<origin>/streams/<streamkey>', methods = ['GET'])
+def remote_stream(origin, streamkey):
+    """
+    Display a stream received by another streamviewer instance (federation),
+    the player loads the HLS playlist from that origin
+    """
+    if federation is None or federation.get_origin(origin) is None:
+        return page_not_found(None)
+    streamkey = streamkey.rstrip("/")
+    matches = [s for s in federation.listed_streams() if s["origin"] == origin and s["key"] == streamkey]
+    stream = matches[0] if matches else None
+    existed = stream is not None and stream.get("active", False)
+    description = key_if_not_None(stream, "description")
+    return render_template('stream.html', application_name=APPLICATION_NAME, page_title=config["application"]["page_title"], hls_path=config["application"]["hls_path"], hls_url=federation.get_origin(origin).hls_url, origin=origin, streamkey=streamkey, description=description, running_since=None, existed=existed, archive_url=None, initial_state=None, latency_report_rate=0, latency_report_interval=config["application"]["latency_report_interval"], reconnect_delay=admission.reconnect_delay, reconnect_delay_max=admission.reconnect_delay_max)
 
 
 @app.route('/', methods = ['GET'])
@@ -97,10 +278,205 @@ def streams():
     """
     # Get a list of active streams and log it
     active_streams = streamlist.listed_streams()
-    app.logger.info('Listing active streams: {}'.format(", ".join([str(s) for s in active_streams])))
+    # Only join the list if it actually gets logged
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info('Listing active streams: %s', ", ".join([str(s) for s in active_streams]))
+
+    # Streams received by the other instances of a federation
+    remote_streams = federation.listed_streams() if federation is not None else []
 
     # Return the template
-    return render_template('streams.html', application_name=APPLICATION_NAME, page_title=config["application"]["page_title"], active_streams=active_streams, description=description, display_description=config["application"]["display_description"], list_streams=config["application"]["list_streams"])
+    return render_template('streams.html', application_name=APPLICATION_NAME, page_title=config["application"]["page_title"], active_streams=active_streams, remote_streams=remote_streams, federated=federation is not None, description=description, display_description=config["application"]["display_description"], list_streams=config["application"]["list_streams"])
+
+
+@app.route('/healthz', methods = ['GET'])
+def healthz():
+    """
+    Liveness check: answers as long as the process handles requests
+    """
+    return "ok", 200, {"Content-Type": "text/plain"}
+
+
+@app.route('/readyz', methods = ['GET'])
+def readyz():
+    """
+    Readiness check: config loaded, streamlist ready, hls_path writable and
+    the event loop lag below readiness_max_lag
+    """
+    failed = monitor.failed_checks()
+    if failed:
+        return "not ready: {}".format(", ".join(failed)), 503, {"Content-Type": "text/plain"}
+    return "ok", 200, {"Content-Type": "text/plain"}
+
+
+def api_etag() -> str:
+    """
+    The API responses only change with the version of the StreamList, so it
+    makes a strong ETag for all of them (together with the BOOT_ID, as the
+    version starts over after a restart)
+    """
+    return '"{}-{}"'.format(BOOT_ID, streamlist.version)
+
+
+def api_response(body: str, status: int=200, etag: Optional[str]=None):
+    """
+    Return a JSON response of the API, nginx and browsers may cache it for a
+    second (see the proxy_cache in examples/streamviewer.conf)
+    """
+    headers = {"Content-Type": "application/json", "Cache-Control": "max-age=1"}
+    if etag is not None:
+        headers["ETag"] = etag
+    return body, status, headers
+
+
+def api_not_modified(etag: str):
+    """
+    Return a 304 if the client sent the current ETag, checked before anything
+    is serialized
+    """
+    if etag in [e.strip() for e in request.headers.get("If-None-Match", "").split(",")]:
+        return "", 304, {"ETag": etag, "Cache-Control": "max-age=1"}
+    return None
+
+
+def api_page(snapshot, sort: str, prefix: Optional[str], cursor: Optional[str], limit: int, projection: str) -> str:
+    """
+    Serialize a page of the listed streams of a snapshot with the fields of
+    the projection, raises ValueError on an invalid sort or cursor
+    """
+    page, next_cursor = snapshot.index.page(sort, prefix=prefix, cursor=cursor, limit=limit)
+    return json.dumps({"streams": [s.to_wire_dict(projection) for s in page], "cursor": next_cursor})
+
+
+@app.route('/api/streams', methods = ['GET'])
+def api_streams():
+    """
+    Return a page of listed streams as JSON, e.g.:
+    /api/streams?sort=viewcount&prefix=foo&limit=20&cursor=...
+    The cursor for the next page is part of the response (null on the last page).
+    Streams have the fields of the detail projection (timestamps in seconds
+    since the epoch), with ?projection=list only the fields of that projection
+    """
+    etag = api_etag()
+    not_modified = api_not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+
+    sort = request.args.get("sort", "started")
+    prefix = request.args.get("prefix")
+    cursor = request.args.get("cursor")
+    projection = request.args.get("projection", "detail")
+    if projection not in PROJECTIONS:
+        return api_response(json.dumps({"error": "Unknown projection \"{}\"".format(projection)}), 400)
+    try:
+        limit = min(max(int(request.args.get("limit", API_PAGE_LIMIT)), 1), API_PAGE_LIMIT)
+        build = lambda snapshot: api_page(snapshot, sort, prefix, cursor, limit, projection)
+        if prefix or cursor:
+            body = build(streamlist.snapshot)
+        else:
+            # The first pages are what the list pages and the other origins
+            # poll, they are serialized once per version. Pages depending on
+            # a prefix or cursor sent by a client are not kept
+            body = streamlist.cached(("api_streams", sort, limit, projection), build)
+    except ValueError as e:
+        return api_response(json.dumps({"error": str(e)}), 400)
+    return api_response(body, etag=etag)
+
+
+@app.route('/api/streams/<streamkey>', methods = ['GET'])
+def api_stream(streamkey):
+    """
+    Return a single active stream as JSON (the fields of the detail
+    projection). Like /streams/<key> this also works for unlisted streams if
+    the key is known
+    """
+    etag = api_etag()
+    not_modified = api_not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+
+    detail = streamlist.detail(streamkey.rstrip("/"))
+    if detail is None or not detail["active"]:
+        return api_response(json.dumps({"error": "No active stream \"{}\"".format(streamkey)}), 404, etag=etag)
+    return api_response(json.dumps(detail), etag=etag)
+
+
+def events_snapshot() -> tuple:
+    """
+    Return the id and the message of the current stream list for a client of
+    /events/streams. It is only sent to that client, but serialized once per
+    version and shared by all clients connecting meanwhile
+    """
+    return streamlist.cached("events_snapshot", lambda s: (s.version, event_buffer.encode(s.version, "streams", {
+        "added": [],
+        "removed": [],
+        "list": wire_list(s.streams),
+    })))
+
+
+# X-Accel-Buffering tells nginx to pass the events on right away
+EVENTS_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@app.route('/events/streams', methods = ['GET'])
+def events_streams():
+    """
+    Server-sent events with the stream list: the current list first, then a
+    new one whenever streams are added or removed. Reconnecting browsers send
+    the Last-Event-ID and only get what they missed. Under the ASGI entry
+    point this is served by streamviewer.asgi instead
+    """
+    last_id = event_buffer.parse_id(request.headers.get("Last-Event-ID"))
+    return Response(event_buffer.subscribe(last_id, events_snapshot, retry=admission.reconnect_hint()), mimetype="text/event-stream",
+                    headers=EVENTS_HEADERS)
+
+
+@app.route('/auth/hls', methods = ['GET'])
+def auth_hls():
+    """
+    Called by nginx (auth_request) for every HLS playlist and segment fetch
+    (live or archived) with the requested URI in X-Original-URI. Answers 204
+    if the file may be fetched, 403 if not. Nothing is logged on success, as
+    this runs for every segment of every viewer
+    """
+    if not request.host == "localhost":
+        return "Only allowed from localhost", 403
+    if hls_tokens == "off":
+        return "", 204
+    uri = request.headers.get("X-Original-URI", "")
+    key = archive_stream_key(uri, config["application"]["archive_url"])
+    archived = key is not None
+    if not archived:
+        key = hls_stream_key(uri)
+    stream = streamlist.get_stream(key) if key is not None else None
+    # The stream of an archive may be gone, and with it whether it was
+    # unlisted, its archive always needs a token then
+    if stream is None and not archived:
+        return "", 403
+    if hls_tokens == "unlisted" and stream is not None and not stream.unlisted:
+        return "", 204
+    token = request.cookies.get(token_cookie(key)) or uri_token(uri)
+    if viewing_tokens.verify(key, token):
+        return "", 204
+    app.logger.info("Denied HLS request for %s without a valid viewing token", uri)
+    return "", 403
+
+
+@app.route('/api/origins', methods = ['GET'])
+def api_origins():
+    """
+    Return the state of the federation origins and their listed streams as JSON
+    """
+    state = federation.state() if federation is not None else ()
+    etag = '"{}-origins-{:x}"'.format(BOOT_ID, zlib.crc32(repr(state).encode("utf-8")))
+    not_modified = api_not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    if federation is None:
+        body = json.dumps({"origins": [], "streams": []})
+    else:
+        body = json.dumps({"origins": federation.status(), "streams": federation.listed_streams()})
+    return api_response(body, etag=etag)
 
 
 @app.route('/on_publish', methods = ['POST'])
@@ -116,14 +492,20 @@ def on_publish():
     if not request.host == "localhost":
         return "Only allowed from localhost", 403
 
+    # Without the configuration anybody could take the protected keys
+    if not monitor.streamlist_ready:
+        app.logger.warning('Refused the RTMP stream \"%s\", the streams of the configuration are not loaded', request.values.get("name"))
+        return "Configuration couldn't be loaded", 403
+
     # Extract some information from the POST data (None if none)
     streamingkey = request.values.get("name")
     password = request.values.get("password")
     description = request.values.get("description")
     unlisted = value_to_flag(request.values.get("unlisted"))
     
-    app.logger.debug('\"{}\" came with values \"{}\"'.format(streamingkey, request.values.to_dict(flat=True)))
-    app.logger.info('A new RTMP stream connected to the key \"{}\"'.format(streamingkey))
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug('\"%s\" came with values \"%s\"', streamingkey, request.values.to_dict(flat=True))
+    app.logger.info('A new RTMP stream connected to the key \"%s\"', streamingkey)
     # Create a stream
     stream = Stream().set_key(streamingkey)\
                      .set_password(password)\
@@ -132,15 +514,19 @@ def on_publish():
 
     # Try to add the stream to the streamlist
     if streamlist.add_stream(stream):
-        # Only emit a socket.io message if the stream was listed
+        # Reports of an earlier stream with the same key don't count anymore
+        latency.forget(stream.key)
+        # Only queued here, delivered in the background
+        if webhooks is not None:
+            webhooks.stream_started(stream)
+        # Only notify the clients if the stream was listed, this is sent by the
+        # broadcaster in the background, so nginx doesn't wait for it
         if not stream.unlisted:
-            json_list = streamlist.json_list()
-            app.logger.debug('Sending JSON list {}'.format(json_list))
-            socketio.emit('stream_added', {'key': stream.key, 'list': json_list}, broadcast=True)
+            broadcaster.stream_added(stream.key)
         # 201 Created
         return "Created", 201
     else:
-        app.logger.info('Stream \"{}\" got denied by Streamlist'.format(streamingkey))
+        app.logger.info('Stream \"%s\" got denied by Streamlist', streamingkey)
         return "Not Created", 409
 
 
@@ -156,62 +542,200 @@ def on_publish_done():
     if not request.host == "localhost":
         return "Only allowed from localhost", 403
     streamingkey = request.values.get("name")
-    app.logger.info('Existing RTMP stream \"{}\" ended'.format(streamingkey))
+    app.logger.info('Existing RTMP stream \"%s\" ended', streamingkey)
     stream = streamlist.get_stream(streamingkey)
     streamlist.remove_stream(streamingkey)
-    # Only emit a socket.io message if the stream was listed
-    if not stream.unlisted:
-        json_list = streamlist.json_list()
-        app.logger.debug('Sending JSON list {}'.format(json_list))
-        socketio.emit('stream_removed', {'key': streamingkey, 'list': json_list}, broadcast=True)
+    # Only notify the clients if the stream was listed
+    if stream is not None and not stream.unlisted:
+        broadcaster.stream_removed(streamingkey)
+    if stream is not None and webhooks is not None:
+        webhooks.stream_stopped(streamingkey)
 
     return "Ok", 200
 
 
 
+@app.route('/metrics', methods = ['GET'])
+def metrics():
+    """
+    Internal metrics as JSON (only allowed from localhost)
+    """
+    if not request.host == "localhost":
+        return "Only allowed from localhost", 403
+    body = json.dumps({
+        "streams": len(streamlist.streams),
+        "listed_streams": len(streamlist.index),
+        "version": streamlist.version,
+        "broadcast": broadcaster.stats(),
+        "loop_lag": monitor.current_lag(),
+        "profiling": profiler.status(),
+        "latency": latency.summaries(),
+        "hls_tokens": viewing_tokens.stats(),
+        "hls_sweeper": sweeper.stats() if sweeper is not None else None,
+        "rtmp_stat": rtmp_stat.status() if rtmp_stat is not None else None,
+        "webhooks": webhooks.stats() if webhooks is not None else None,
+        "admission": admission.stats(),
+        "builds": {"built": streamlist.builds, "joined": streamlist.joined_builds},
+    })
+    return body, 200, {"Content-Type": "application/json"}
+
+
+@app.route('/profiling', methods = ['GET', 'POST'])
+def profiling():
+    """
+    Show the profiling state, a POST with ?enabled=true or ?enabled=false
+    switches profiling on or off (only allowed from localhost and with the
+    profiling_secret in the X-Profiling-Secret header)
+    """
+    if not request.host == "localhost":
+        return "Only allowed from localhost", 403
+    if request.method == "POST":
+        secret = config["application"]["profiling_secret"]
+        if not secret:
+            return "Switching profiling at runtime is disabled, set a profiling_secret in the config", 403
+        if not hmac.compare_digest(request.headers.get("X-Profiling-Secret", ""), secret):
+            return "Invalid profiling secret", 403
+        if "sample_rate" in request.args:
+            try:
+                profiler.set_sample_rate(request.args["sample_rate"])
+            except ValueError:
+                return json.dumps({"error": "Invalid sample_rate"}), 400, {"Content-Type": "application/json"}
+        if "enabled" in request.args:
+            profiler.set_enabled(value_to_flag(request.args["enabled"]))
+    return json.dumps(profiler.status()), 200, {"Content-Type": "application/json"}
+
+
+@socketio.on('connect')
+def on_connect():
+    """
+    Refuse new sessions beyond the admission rate, the client is told when to
+    try again
+    """
+    retry_after = admission.admit()
+    if retry_after is not None:
+        app.logger.debug('Refused a socket.io session, retry after %.1f s', retry_after, extra={'event': 'connect'})
+        # The client gets {"message": "busy", "data": {"retry_after": ...}},
+        # socket.io hands data to connect_error as error.data
+        raise ConnectionRefusedError("busy", {"retry_after": retry_after})
+
+
 @socketio.on('connect_list')
+@profiler.profiled
 def client_list_connected():
     app.logger.info('Client connected via socket.io')
-    json_list = streamlist.json_list()
-    app.logger.debug('Sending JSON list {}'.format(json_list))
-    socketio.emit('stream_list', {'list': json_list})
+    streams = streamlist.wire_list()
+    app.logger.debug('Sending list %s', streams)
+    socketio.emit('stream_list', {'list': streams}, room=request.sid)
 
 
 @socketio.on('stream_list')
+@profiler.profiled
 def send_streamlist():
-    json_list = streamlist.json_list()
-    socketio.emit('stream_list', {'list': json_list})
+    app.logger.debug('Client requested the stream list', extra={'event': 'stream_list'})
+    socketio.emit('stream_list', {'list': streamlist.wire_list()}, room=request.sid)
 
 
 @socketio.on('stream_info')
+@profiler.profiled
 def send_streaminfo(data):
     if type(data) is dict and "key" in data.keys():
-        app.logger.info('Client wants info about stream {}'.format(data['key']))
+        app.logger.info('Client wants info about stream %s', data['key'], extra={'event': 'stream_info'})
         key = data["key"]
-        stream = streamlist.get_stream(key)
-        if stream is not None:
-            json = stream.to_json()
-            app.logger.debug('Sending Stream info\n{}'.format(json))
-            socketio.emit('stream_info', json)
+        info = stream_info(key)
+        if info is not None:
+            app.logger.debug('Sending Stream info %s', info)
+            socketio.emit('stream_info', info, room=request.sid)
         else:
-            app.logger.warning('Client {} asked for info on non-existing stream {}'.format(request.remote_addr, data['key']))
+            app.logger.warning('Client %s asked for info on non-existing stream %s', request.remote_addr, data['key'])
+
+
+def stream_info(key) -> Optional[dict]:
+    """
+    Return the detail of the stream with its latency and the version of the
+    stream list it is from (at least), None if there is no such stream
+    """
+    version = streamlist.version
+    detail = streamlist.detail(key)
+    if detail is None:
+        return None
+    # The cached detail is shared, so extend a copy
+    return dict(detail, latency=latency.summary(key), version=version)
+
+
+@socketio.on('latency_report')
+@profiler.profiled
+def on_latency_report(data):
+    """
+    A player reports its distance to the live edge (a few samples in seconds),
+    how often it stalled and how many seconds it played since its last report
+    """
+    # Only the samples a report has are converted, the rest of an oversized
+    # list is never looked at
+    try:
+        key = data["key"]
+        samples = [float(s) for s in data["samples"][:latency.max_samples]]
+        stalls = int(data["stalls"])
+        seconds = float(data["seconds"])
+    except (TypeError, KeyError, ValueError, OverflowError):
+        app.logger.debug('Client %s sent an invalid latency report', request.remote_addr)
+        return
+    app.logger.debug('Client reported latency for stream %s', key, extra={'event': 'latency_report'})
+    stream = streamlist.get_stream(key)
+    if stream is None or not stream.active or not math.isfinite(seconds):
+        return
+    # A report can't cover more playback than the time between two reports,
+    # and a player can't stall more than once a second within it
+    max_seconds = 2 * config["application"]["latency_report_interval"]
+    seconds = min(max(seconds, 0.0), max_seconds)
+    stalls = min(max(stalls, 0), math.ceil(max_seconds))
+    latency.report(key, [s for s in samples if math.isfinite(s)], stalls, seconds)
+
+
+@socketio.on('first_frame')
+@profiler.profiled
+def on_first_frame(data):
+    """
+    A player reports the seconds from the start of the page load until it
+    showed the first frame
+    """
+    try:
+        key = data["key"]
+        seconds = float(data["seconds"])
+    except (TypeError, KeyError, ValueError):
+        app.logger.debug('Client %s sent an invalid first frame report', request.remote_addr)
+        return
+    stream = streamlist.get_stream(key)
+    if stream is None or not stream.active or not math.isfinite(seconds):
+        return
+    latency.report_first_frame(key, seconds)
 
 
 @socketio.on('join')
+@profiler.profiled
 def on_join(data):
-    app.logger.info('Client connected to stream {}'.format(data['key']))
+    app.logger.info('Client connected to stream %s', data['key'], extra={'event': 'join'})
     key = data['key']
     join_room(key)
     count = streamlist.add_viewer(key)
+    # The list pages get the new count with the next update of the broadcaster
+    broadcaster.viewcount_changed(key)
     socketio.emit('viewercount', {'count': count, 'direction': 'up'}, room=key)
+    # Pages on a different version of the stream list than the one they know
+    # (changed or restarted since) may have missed updates of the stream
+    if data.get('version') != streamlist.version:
+        info = stream_info(key)
+        if info is not None:
+            socketio.emit('stream_info', info, room=request.sid)
 
 
 @socketio.on('leave')
+@profiler.profiled
 def on_leave(data):
-    app.logger.info('Client left to stream {}'.format(data['key']))
+    app.logger.info('Client left to stream %s', data['key'], extra={'event': 'leave'})
     key = data['key']
     leave_room(key)
     count = streamlist.remove_viewer(key)
+    broadcaster.viewcount_changed(key)
     socketio.emit('viewercount', {'count': count, 'direction': 'down'}, room=key)
 
 
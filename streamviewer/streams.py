@@ -2,11 +2,30 @@
 #-*- coding: utf-8 -*-
 import json
 import copy
-from typing import Optional, NewType, List, Any
+import threading
+import collections
+from contextlib import contextmanager
+from typing import Optional, NewType, List, Any, Tuple, Sequence, Dict
 import datetime as dt
 
+from .index import StreamIndex
+from .reservations import Reservation, ReservationTrie
+
 Seconds = NewType('Seconds', int)
 
+# Order of the fields of a Stream on the socket.io wire. Lists are sent as
+# {"fields": WIRE_FIELDS, "streams": [[...], ...]} so the field names are
+# only sent once, timestamps are seconds since the epoch
+WIRE_FIELDS = ["key", "active", "viewcount", "started", "ended", "description", "health", "ingest"]
+
+# Named subsets of WIRE_FIELDS. The stream list is sent to every client with
+# every change, so it only carries what the list needs. Stream pages fetch the
+# detail of their stream via stream_info
+PROJECTIONS = {
+    "list": ["key", "viewcount", "started"],
+    "detail": WIRE_FIELDS,
+}
+
 
 def str_if_not_None(value, this, that="") -> str:
     """
@@ -58,6 +77,26 @@ def key_if_not_None(o, key: str, that=None):
             return that
 
 
+def timestamp_if_datetime(value) -> Optional[float]:
+    """
+    Return the seconds since the epoch if value is a datetime, otherwise None
+    """
+    if isinstance(value, dt.datetime):
+        return round(value.timestamp(), 3)
+    return None
+
+
+def wire_list(streams: Sequence['Stream'], projection: str="list") -> dict:
+    """
+    Return the listed streams (active and not unlisted) in the compact form
+    sent via socket.io, with the fields of the projection
+    """
+    return {
+        "fields": PROJECTIONS[projection],
+        "streams": [s.to_wire(projection) for s in streams if s.active and not s.unlisted],
+    }
+
+
 def value_to_flag(value) -> bool:
     """
     Return False if the value was None, otherwise return wether it was in the list
@@ -91,6 +130,8 @@ class Stream():
         self.unlisted = None
         self.protected = None
         self.viewcount = 0
+        self.health = None
+        self.ingest = None
 
     def __repr__(self):
         """
@@ -129,6 +170,25 @@ class Stream():
         return json.dumps(self.to_dict(), default=jsonconverter, 
             sort_keys=True, indent=4)
 
+    def to_wire(self, projection: str="detail") -> list:
+        """
+        Return the fields of the projection in the order of PROJECTIONS
+        """
+        if projection == "detail":
+            return [self.key, self.active, self.viewcount,
+                    timestamp_if_datetime(self.creation_time),
+                    timestamp_if_datetime(self.deactivation_time),
+                    self.description, self.health, self.ingest]
+        values = dict(zip(WIRE_FIELDS, self.to_wire()))
+        return [values[field] for field in PROJECTIONS[projection]]
+
+    def to_wire_dict(self, projection: str="detail") -> dict:
+        """
+        Return the fields of the projection with numeric timestamps, as sent
+        via socket.io
+        """
+        return dict(zip(PROJECTIONS[projection], self.to_wire(projection)))
+
     @property
     def inactive(self) -> bool:
         return not self.active
@@ -169,6 +229,22 @@ class Stream():
         self.protected = protected
         return self
     
+    def set_health(self, health: Optional[dict]) -> 'Stream':
+        """
+        Set the health of the stream as found by the segment analyzer
+        (bitrate, segment duration, keyframe interval, continuity errors)
+        """
+        self.health = health
+        return self
+
+    def set_ingest(self, ingest: Optional[dict]) -> 'Stream':
+        """
+        Set the ingest metrics of the stream as reported by nginx-rtmp
+        (bitrate, resolution, codecs, start of publishing)
+        """
+        self.ingest = ingest
+        return self
+
     def is_valid_password(self, password) -> bool:
         """
         Returns true if the provided password matches this streams password
@@ -225,25 +301,216 @@ class Stream():
         return delta.total_seconds()
 
 
+class Snapshot():
+    """
+    An immutable, versioned state of a StreamList. Readers take the current
+    snapshot and work with it without locking. Writers never change a published
+    snapshot (or the streams in it), they publish a new one instead.
+    """
+    def __init__(self, version: int, streams: Sequence['Stream'], index: 'StreamIndex'):
+        self.version = version
+        self.streams = tuple(streams)
+        self.index = index
+        self.by_key = {}
+        for stream in self.streams:
+            self.by_key.setdefault(stream.key, stream)
+        # Serializations of this snapshot and the ones being built, see
+        # StreamList.cached()
+        self.cache = {}
+        self.building = {}
+
+
 class StreamList():
     """
     The StreamList handles all List related duties.
+
+    The streams are kept in a Snapshot which is replaced as a whole on every
+    change (copy on write), so readers never see half applied changes. All
+    changes happen within changes(), which publishes them as one new snapshot.
     """
     def __init__(self, logger):
         self.logger = logger
-        self.streams = []
+        self.snapshot = Snapshot(0, [], StreamIndex())
+        self.lock = threading.RLock()
+        self.cache_lock = threading.Lock()
+        self.builds = 0
+        self.joined_builds = 0
+        self.writer = None
+        self.pending = None
+        self.pending_index = None
+        self.dirty = False
         self.max_streams = None
         self.password_protection_period = 0
         self.free_choice = False
+        self.reservations = ReservationTrie()
+        # The keys of the active streams under each reservation, for the quota
+        self.reserved_active = {}
+        # Keys of streams created under a reservation, and the ones of them
+        # that ended in the order they ended
+        self.materialized = set()
+        self.expiring = collections.deque()
+        # Viewers come and go too often for a new snapshot each time. Their
+        # counts by key are kept here and copied into the snapshot in batches,
+        # see publish_viewcounts()
+        self.viewers = {}
+        self.viewers_changed = set()
+        self.viewer_lock = threading.Lock()
+        self.archiver = None
         self.logger.debug("Created StreamList")
 
     def __iter__(self):
         """
-        Allows iteration over the 
+        Allows iteration over the streams of the current snapshot
         """
         for stream in self.streams:
             yield stream
 
+    @property
+    def streams(self) -> Sequence['Stream']:
+        """
+        The streams as seen by the caller: the pending changes for the writer
+        inside of changes(), the current snapshot for everybody else
+        """
+        if self.writer == threading.get_ident():
+            return self.pending
+        return self.snapshot.streams
+
+    @property
+    def index(self) -> 'StreamIndex':
+        """
+        The index of the listed streams, see streams
+        """
+        if self.writer == threading.get_ident():
+            return self.pending_index
+        return self.snapshot.index
+
+    @property
+    def version(self) -> int:
+        """
+        The version of the current snapshot, increases with every change
+        """
+        return self.snapshot.version
+
+    @contextmanager
+    def changes(self):
+        """
+        Collect all changes made within the block and publish them as a single
+        new snapshot when the outermost block ends. Nothing is published if the
+        block raises. Use it to batch changes:
+
+        with streamlist.changes():
+            streamlist.add_stream(a)
+            streamlist.add_stream(b)
+        """
+        with self.lock:
+            # Nested blocks join the outer one
+            if self.writer == threading.get_ident():
+                yield self.pending
+                return
+            self.pending = list(self.snapshot.streams)
+            self.pending_index = self.snapshot.index.copy()
+            self.dirty = False
+            self.writer = threading.get_ident()
+            try:
+                yield self.pending
+                if self.dirty:
+                    # Publishing is a single reference assignment
+                    self.snapshot = Snapshot(self.snapshot.version + 1, self.pending, self.pending_index)
+            except BaseException:
+                # The pending changes are thrown away, so are their counts
+                self._recount_reserved(self.snapshot.streams)
+                raise
+            finally:
+                self.writer = None
+                self.pending = None
+                self.pending_index = None
+
+    def _put(self, i: int, stream: 'Stream'):
+        """
+        Replace the pending stream at position i (only within changes())
+        """
+        self._track_reserved(self.pending[i], stream)
+        # Streams put here aren't published yet, the viewers of the key stay
+        stream.viewcount = self.viewers.get(stream.key, 0)
+        self.pending[i] = stream
+        self.pending_index.update(stream)
+        self.dirty = True
+
+    def _append(self, stream: 'Stream'):
+        """
+        Append a stream to the pending streams (only within changes())
+        """
+        self._track_reserved(None, stream)
+        stream.viewcount = self.viewers.get(stream.key, 0)
+        self.pending.append(stream)
+        self.pending_index.update(stream)
+        self.dirty = True
+
+    def _drop(self, key: str):
+        """
+        Remove all pending streams with the key (only within changes())
+        """
+        for stream in self.pending:
+            if stream.key == key:
+                self._track_reserved(stream, None)
+        self.pending[:] = [s for s in self.pending if s.key != key]
+        self.pending_index.discard(key)
+        with self.viewer_lock:
+            self.viewers.pop(key, None)
+            self.viewers_changed.discard(key)
+        self.dirty = True
+
+    def _track_reserved(self, old: Optional['Stream'], new: Optional['Stream']):
+        """
+        Update the active keys of the reservations when the pending stream old
+        gets replaced by new (either may be None)
+        """
+        if len(self.reservations) == 0:
+            return
+        for stream, active in [(old, False), (new, True)]:
+            if stream is None or not stream.active or stream.key is None:
+                continue
+            reservation = self.reservations.match(stream.key)
+            if reservation is None:
+                continue
+            keys = self.reserved_active.setdefault(reservation, set())
+            if active:
+                keys.add(stream.key)
+            else:
+                keys.discard(stream.key)
+
+    def _recount_reserved(self, streams: Sequence['Stream']):
+        self.reserved_active = {}
+        for stream in streams:
+            self._track_reserved(None, stream)
+
+    def _prune_reserved(self):
+        """
+        Drop the streams created under a reservation that ended longer than the
+        password protection period ago (only within changes()). The reservation
+        still protects their keys
+        """
+        while self.expiring:
+            stream = self.get_stream(self.expiring[0])
+            if stream is not None and stream.inactive and stream.has_password_protection(self.password_protection_period):
+                # The ones after it ended later
+                break
+            key = self.expiring.popleft()
+            # Streams that got published again meanwhile stay
+            if stream is not None and stream.inactive and key in self.materialized:
+                self._drop(key)
+                self.materialized.discard(key)
+                self.logger.info("Removed the stream %s created under a reservation, because its password protection period is over", stream)
+
+    def _replace(self, stream: 'Stream'):
+        """
+        Replace the first pending stream with the same key (only within changes())
+        """
+        for i, existing_stream in enumerate(self.pending):
+            if existing_stream.key == stream.key:
+                self._put(i, stream)
+                return
+
     def set_max_streams(self, n) -> 'StreamList':
         """
         Sets the maximum number of streams allowed.
@@ -251,7 +518,7 @@ class StreamList():
         """
         if n >= 0:
             self.max_streams = int(n)
-            self.logger.debug("Set max_streams to {}".format(self.max_streams))
+            self.logger.debug("Set max_streams to %s", self.max_streams)
         return self
 
     def set_free_choice(self, free: bool=False) -> 'StreamList':
@@ -261,9 +528,16 @@ class StreamList():
         """
         self.free_choice = free
         if self.free_choice:
-            self.logger.warning("Set free_choice to {} (this means everybody on the same net can stram to this service!)".format(self.free_choice))
+            self.logger.warning("Set free_choice to %s (this means everybody on the same net can stram to this service!)", self.free_choice)
         else:
-            self.logger.warning("Set free_choice to {} (this means only streams listed in the config can be used)".format(self.free_choice))
+            self.logger.warning("Set free_choice to %s (this means only streams listed in the config can be used)", self.free_choice)
+        return self
+
+    def set_archiver(self, archiver: 'Archiver') -> 'StreamList':
+        """
+        Archive the HLS segments of streams when they end (see archive.py)
+        """
+        self.archiver = archiver
         return self
 
     def set_password_protection_period(self, minutes: int) -> 'StreamList':
@@ -274,9 +548,9 @@ class StreamList():
         """
         if minutes>= 0:
             self.password_protection_period = minutes*60
-            self.logger.debug("Set password_protection_period to {} seconds".format(self.password_protection_period))
+            self.logger.debug("Set password_protection_period to %s seconds", self.password_protection_period)
         else:
-            self.logger.warning("Warning: the password_protection_period had a negative value and was ignored {}".format(minutes))
+            self.logger.warning("Warning: the password_protection_period had a negative value and was ignored %s", minutes)
         return self
 
     def active_streams(self) -> List['Stream']:
@@ -289,7 +563,7 @@ class StreamList():
         """
         Return a list of streams that should be listed (active and not unlisted)
         """
-        return [s for s in self.active_streams() if not s.unlisted]
+        return [s for s in self.streams if s.active and not s.unlisted]
 
     def protected_streams(self) -> List['Stream']:
         """
@@ -303,10 +577,80 @@ class StreamList():
         """
         return [s for s in self.streams if s.protected and s.inactive]
 
+    def page(self, sort: str="started", prefix: Optional[str]=None, cursor: Optional[str]=None, limit: int=50) -> Tuple[List['Stream'], Optional[str]]:
+        """
+        Return a page of listed streams and the cursor of the next page
+        (None on the last page), see StreamIndex.page()
+        """
+        return self.index.page(sort, prefix=prefix, cursor=cursor, limit=limit)
+
     def json_list(self) -> str:
         return json.dumps(self.listed_streams(), default=jsonconverter, 
             sort_keys=True, indent=4)
 
+    def cached(self, name, build):
+        """
+        Return build(snapshot) for the current snapshot. The result is kept with
+        the snapshot, so build is only called once per version and the result
+        must not be changed by the caller. Callers asking for a result that is
+        being built wait for that build instead of starting their own (single
+        flight). Within changes() build gets the pending state and nothing is
+        cached
+        """
+        if self.writer == threading.get_ident():
+            return build(Snapshot(self.snapshot.version, self.pending, self.pending_index))
+        snapshot = self.snapshot
+        if name in snapshot.cache:
+            return snapshot.cache[name]
+
+        with self.cache_lock:
+            if name in snapshot.cache:
+                return snapshot.cache[name]
+            done = snapshot.building.get(name)
+            builder = done is None
+            if builder:
+                done = snapshot.building[name] = threading.Event()
+                self.builds += 1
+            else:
+                self.joined_builds += 1
+        if not builder:
+            done.wait()
+            if name in snapshot.cache:
+                return snapshot.cache[name]
+            # The build failed, let this caller see why
+            return build(snapshot)
+
+        try:
+            snapshot.cache[name] = build(snapshot)
+        finally:
+            with self.cache_lock:
+                del snapshot.building[name]
+            done.set()
+        return snapshot.cache[name]
+
+    def wire_list(self, projection: str="list") -> dict:
+        """
+        Return the listed streams in the compact form sent via socket.io, with
+        the fields of the projection (see PROJECTIONS)
+        """
+        if projection not in PROJECTIONS:
+            raise ValueError("Unknown projection \"{}\"".format(projection))
+        return self.cached(("wire_list", projection), lambda snapshot: wire_list(snapshot.streams, projection))
+
+    def detail(self, key) -> Optional[dict]:
+        """
+        Return all public fields of the stream with the key (see
+        Stream.to_wire_dict), None if there is no such stream
+        """
+        def build(snapshot):
+            # Raises KeyError for a missing stream, a failed build isn't
+            # cached, so keys sent by clients don't pile up in the cache
+            return snapshot.by_key[key].to_wire_dict()
+        try:
+            return self.cached(("detail", key), build)
+        except KeyError:
+            return None
+
     def has_stream(self, stream) -> bool:
         """
         Return True if a stream of that name exists
@@ -336,75 +680,159 @@ class StreamList():
         Returns None if no matching stream was found, 
         otherwise the first matching stream is returned
         """
-        matches = [s for s in self.streams if s.key == key]
-        if len(matches) == 0:
+        if self.writer == threading.get_ident():
+            matches = [s for s in self.pending if s.key == key]
+            if len(matches) == 0:
+                return None
+            return matches[0]
+        return self.snapshot.by_key.get(key)
+
+    def add_viewer(self, key) -> Optional[int]:
+        """
+        Count a viewer of the stream with the key and return its viewcount
+        (None if there is no such stream). Costs O(1), the snapshot only gets
+        the new count with the next publish_viewcounts()
+        """
+        return self._count_viewer(key, 1)
+
+    def remove_viewer(self, key) -> Optional[int]:
+        """
+        Count a viewer less, see add_viewer
+        """
+        return self._count_viewer(key, -1)
+
+    def _count_viewer(self, key, change: int) -> Optional[int]:
+        if self.get_stream(key) is None:
             return None
-        return matches[0]
+        with self.viewer_lock:
+            count = max(0, self.viewers.get(key, 0) + change)
+            self.viewers[key] = count
+            self.viewers_changed.add(key)
+        return count
+
+    def viewcount(self, key) -> int:
+        """
+        Return the current viewcount of the stream with the key, which may be
+        newer than the one in the snapshot
+        """
+        return self.viewers.get(key, 0)
+
+    def publish_viewcounts(self) -> List[str]:
+        """
+        Copy the viewcounts that changed since the last call into a new
+        snapshot (one for all of them) and return the keys of the streams
+        whose viewcount changed
+        """
+        published = []
+        with self.changes():
+            with self.viewer_lock:
+                keys, self.viewers_changed = self.viewers_changed, set()
+            if not keys:
+                return published
+            for i, stream in enumerate(self.pending):
+                if stream.key in keys and stream.viewcount != self.viewers.get(stream.key, 0):
+                    # Published streams never change, so change a copy
+                    self._put(i, copy.copy(stream))
+                    published.append(stream.key)
+        return published
+
+    def set_health(self, key, health: Optional[dict]) -> 'StreamList':
+        """
+        Set the health of the stream with the given key (see Stream.set_health)
+        """
+        with self.changes():
+            stream = self.get_stream(key)
+            if stream is not None:
+                self._replace(copy.copy(stream).set_health(health))
+        return self
 
-    def add_viewer(self, key) -> int:
-        stream = self.get_stream(key)
-        if stream is not None:
-            stream.viewcount += 1
-            # Update the stream silently
-            for i, existing_stream in enumerate(self.streams):
-                if existing_stream.key == stream.key:
-                    self.streams[i] = stream
-            return stream.viewcount
-
-    def remove_viewer(self, key) -> int:
-        stream = self.get_stream(key)
-        if stream is not None:
-            stream.viewcount -= 1
-            if stream.viewcount <= 0:
-                stream.viewcount = 0
-            # Update the stream silently
-            for i, existing_stream in enumerate(self.streams):
-                if existing_stream.key == stream.key:
-                    self.streams[i] = stream
-            return stream.viewcount
+    def _update_each(self, values: Dict[str, Any], update):
+        """
+        Replace the first stream with each key of values by a copy changed by
+        update(stream, value), in a single pass over the list
+        """
+        if not values:
+            return
+        with self.changes():
+            done = set()
+            for i, stream in enumerate(self.pending):
+                if stream.key in values and stream.key not in done:
+                    self._put(i, update(copy.copy(stream), values[stream.key]))
+                    done.add(stream.key)
+
+    def update_health(self, health: Dict[str, Optional[dict]]) -> 'StreamList':
+        """
+        Set the health of many streams by key at once (see Stream.set_health)
+        """
+        self._update_each(health, Stream.set_health)
+        return self
+
+    def set_ingest(self, key, ingest: Optional[dict]) -> 'StreamList':
+        """
+        Set the ingest metrics of the stream with the given key (see
+        Stream.set_ingest)
+        """
+        with self.changes():
+            stream = self.get_stream(key)
+            if stream is not None:
+                self._replace(copy.copy(stream).set_ingest(ingest))
+        return self
+
+    def update_ingest(self, ingest: Dict[str, Optional[dict]]) -> 'StreamList':
+        """
+        Set the ingest metrics of many streams by key at once (see
+        Stream.set_ingest)
+        """
+        self._update_each(ingest, Stream.set_ingest)
+        return self
 
     def replace_matching_stream(self, stream: 'Stream') -> bool:
         """
         Replace the first matching stream if the password is valid or the
         password protection period has perished
         """
-        for i, existing_stream in enumerate(self.streams):
-            if existing_stream.key == stream.key:
-                if existing_stream.protected and existing_stream.password is None:
-                    existing_stream = stream.set_protected(True).activate()
-                    self.streams[i] = existing_stream
-                    self.logger.info("Replaced existing stream with {}, because the protected stream has no password set".format(existing_stream))
-                    return True
-                elif existing_stream.protected and existing_stream.is_valid_password(stream.password):
-                    existing_stream = stream.set_protected(True).activate()
-                    self.streams[i] = existing_stream
-                    self.logger.info("Replaced existing stream with {}, because a valid password was supplied".format(existing_stream))
-                    return True
-                elif existing_stream.protected and not existing_stream.is_valid_password(stream.password):
-                    self.logger.info("Didn't accept new stream {}, because the password doesn't match the existing protected stream".format(stream))
-                    return False
-                elif existing_stream.is_valid_password(stream.password):
-                    existing_stream = stream
-                    self.streams[i] = existing_stream
-                    self.logger.info("Replaced existing stream with {} because a valid password was supplied".format(existing_stream))
-                    return True
-                elif not existing_stream.has_password_protection(self.password_protection_period):
-                    self.logger.info("Replaced existing stream with {} because its password protection period is over ({}/{})".format(existing_stream, existing_stream.inactive_since(), self.password_protection_period))
-                    existing_stream = stream
-                    self.streams[i] = existing_stream
-                    return True
-        self.logger.info("Didn't accept new stream {}, because a existing stream is protected".format(stream))
+        with self.changes():
+            for i, existing_stream in enumerate(self.streams):
+                if existing_stream.key == stream.key:
+                    if existing_stream.protected and existing_stream.password is None:
+                        existing_stream = stream.set_protected(True).activate()
+                        self._put(i, existing_stream)
+                        self.logger.info("Replaced existing stream with %s, because the protected stream has no password set", existing_stream)
+                        return True
+                    elif existing_stream.protected and existing_stream.is_valid_password(stream.password):
+                        existing_stream = stream.set_protected(True).activate()
+                        self._put(i, existing_stream)
+                        self.logger.info("Replaced existing stream with %s, because a valid password was supplied", existing_stream)
+                        return True
+                    elif existing_stream.protected and not existing_stream.is_valid_password(stream.password):
+                        self.logger.info("Didn't accept new stream %s, because the password doesn't match the existing protected stream", stream)
+                        return False
+                    elif existing_stream.is_valid_password(stream.password):
+                        existing_stream = stream
+                        self._put(i, existing_stream)
+                        self.logger.info("Replaced existing stream with %s because a valid password was supplied", existing_stream)
+                        return True
+                    elif not existing_stream.has_password_protection(self.password_protection_period):
+                        self.logger.info("Replaced existing stream with %s because its password protection period is over (%s/%s)", existing_stream, existing_stream.inactive_since(), self.password_protection_period)
+                        existing_stream = stream
+                        self._put(i, existing_stream)
+                        return True
+        self.logger.info("Didn't accept new stream %s, because a existing stream is protected", stream)
         return False
 
     def deactivate_matching_stream(self, stream: 'Stream') -> 'StreamList':
         """
         Deactivate the first matching stream
         """
-        for existing_stream in self.streams:
-            if existing_stream == stream:
-                existing_stream = stream.deactivate()
-                self.logger.info("Deactivated existing stream {}".format(stream))
-                return self
+        with self.changes():
+            for i, existing_stream in enumerate(self.streams):
+                if existing_stream is stream:
+                    # Published streams never change, so deactivate a copy
+                    existing_stream = copy.copy(stream).deactivate()
+                    self._put(i, existing_stream)
+                    self.logger.info("Deactivated existing stream %s", existing_stream)
+                    return self
+        return self
 
     def add_stream(self, stream: 'Stream') -> bool:
         """
@@ -414,35 +842,78 @@ class StreamList():
 
         Returns True if the stream was added, False otherwise
         """
+        with self.changes():
+            self._prune_reserved()
+
+            # Check the number of active streams first (reserving space for the protected streams)
+            if len([s for s in self.streams if s.active]) - len(self.inactive_protected_streams()) >= self.max_streams:
+                self.logger.info("Not adding new stream \"%s\" because the maximum number of %s active streams is reached", stream, self.max_streams)
+                return False
+
+            # Initially add protected streams from config. Streams supplied by flask are
+            # always active initially so cannot be set this way
+            if stream.protected and not stream.active:
+                self._append(stream)
+                self.logger.info("Created new protected stream \"%s\" from config", stream)
+                return True
+
+            # Keys under a reserved prefix share the quota of the reservation
+            reservation = self.reservations.match(stream.key) if stream.active and stream.key is not None else None
+            if reservation is not None and not self.within_quota(stream.key, reservation):
+                self.logger.info("Not adding new stream \"%s\" because the quota of %s active streams of the reservation %s is reached", stream, reservation.quota, reservation)
+                return False
+
+            # If the stream already exist check the password (if there is one) and
+            # whether that password is still protective or not
+            if self.has_stream(stream) and stream.active:
+                self.logger.debug("The new stream \"%s\" already exists in list", stream)
+                return self.replace_matching_stream(stream)
+
+            # The first stream with a key under a reservation gets created now
+            if reservation is not None:
+                return self.add_reserved_stream(stream, reservation)
+
+            # If the stream wasn't replaced above, and free choice doesn't exist, deny
+            if not self.free_choice:
+                self.logger.warning("Didn't add stream \"%s\" because it was not listed in the config (free choice of stream keys is disabled)", stream)
+                return False
+
+            # If none of the above applies append the Stream to the list
+            self._append(stream)
+            self.logger.info("Added new stream \"%s\" to list", stream)
 
-        # Check the number of active streams first (reserving space for the protected streams)
-        if len([s for s in self.streams if s.active]) - len(self.inactive_protected_streams()) >= self.max_streams:
-            self.logger.info("Not adding new stream \"{}\" because the maximum number of {} active streams is reached".format(stream, self.max_streams))
-            return False
-
-        # Initially add protected streams from config. Streams supplied by flask are
-        # always active initially so cannot be set this way
-        if stream.protected and not stream.active:
-            self.streams.append(stream)
-            self.logger.info("Created new protected stream \"{}\" from config".format(stream))
             return True
 
-        # If the stream already exist check the password (if there is one) and
-        # whether that password is still protective or not
-        if self.has_stream(stream) and stream.active:
-            self.logger.debug("The new stream \"{}\" already exists in list".format(stream))
-            return self.replace_matching_stream(stream)
-
-        # If the stream wasn't replaced above, and free choice doesn't exist, deny
-        if not self.free_choice:
-            self.logger.warning("Didn't add stream \"{}\" because it was not listed in the config (free choice of stream keys is disabled)".format(stream))
-            return False
-
-        # If none of the above applies append the Stream to the list
-        self.streams.append(stream)
-        self.logger.info("Added new stream \"{}\" to list".format(stream))
-
-        return True
+    def within_quota(self, key: str, reservation: 'Reservation') -> bool:
+        """
+        Return True if another stream may become active under the reservation
+        (a stream replacing the active one with the same key doesn't count)
+        """
+        if reservation.quota is None:
+            return True
+        active = self.reserved_active.get(reservation, ())
+        return len(active) - (key in active) < reservation.quota
+
+    def add_reserved_stream(self, stream: 'Stream', reservation: 'Reservation') -> bool:
+        """
+        Add the first stream with a key under a reservation if the password of
+        the reservation matches. From then on the stream is protected like the
+        streams listed in the config, until it ended longer than the password
+        protection period ago
+        """
+        with self.changes():
+            if not reservation.is_valid_password(stream.password):
+                self.logger.info("Didn't accept new stream %s, because the password doesn't match the reservation %s", stream, reservation)
+                return False
+            if stream.description is None:
+                stream.set_description(reservation.description)
+            stream.set_unlisted(bool(stream.unlisted) or reservation.unlisted)\
+                  .set_password(reservation.password)\
+                  .set_protected(True)
+            self._append(stream)
+            self.materialized.add(stream.key)
+            self.logger.info("Added new stream \"%s\" reserved by %s to list", stream, reservation)
+            return True
 
     def remove_stream(self, key: str) -> 'StreamList':
         """
@@ -450,30 +921,38 @@ class StreamList():
         The stream is removed if it has no password, or the password protection
         period is over. Otherwise it is just deactivated
         """
-        existing_stream = self.get_stream(key)
+        with self.changes():
+            self._prune_reserved()
+            existing_stream = self.get_stream(key)
 
-        # Should there be no existing stream with that key, return
-        if existing_stream is None:
-            self.logger.debug("Tried to remove existing stream {}, but it was None? This should not happen.".format(key))
-            return self
+            # Should there be no existing stream with that key, return
+            if existing_stream is None:
+                self.logger.debug("Tried to remove existing stream %s, but it was None? This should not happen.", key)
+                return self
 
-        # If the existing stream is protected, deactivate it instead of removing it
-        if existing_stream.protected:
-            return self.deactivate_matching_stream(existing_stream)
+            # The segments on disk get archived in the background
+            if self.archiver is not None and existing_stream.active:
+                self.archiver.archive(key)
+
+            # If the existing stream is protected, deactivate it instead of removing it
+            if existing_stream.protected:
+                if key in self.materialized and existing_stream.active:
+                    self.expiring.append(key)
+                return self.deactivate_matching_stream(existing_stream)
 
-        # Should there be no password protection or the period is over, remove the stream
-        if existing_stream.password is None:
-            self.streams = [s for s in self.streams if s.key != key]
-            self.logger.info("Removed existing stream {} because it was not password protected".format(existing_stream))
-            return self
+            # Should there be no password protection or the period is over, remove the stream
+            if existing_stream.password is None:
+                self._drop(key)
+                self.logger.info("Removed existing stream %s because it was not password protected", existing_stream)
+                return self
 
-        if not existing_stream.has_password_protection(self.password_protection_period):
-            self.streams = [s for s in self.streams if s.key != key]
-            self.logger.info("Removed existing stream {} because its password protection period is over ({}/{})".format(existing_stream, existing_stream.inactive_since(), self.password_protection_period))
-            return self
+            if not existing_stream.has_password_protection(self.password_protection_period):
+                self._drop(key)
+                self.logger.info("Removed existing stream %s because its password protection period is over (%s/%s)", existing_stream, existing_stream.inactive_since(), self.password_protection_period)
+                return self
 
-        # otherwise deactivate it
-        return self.deactivate_matching_stream(existing_stream)
+            # otherwise deactivate it
+            return self.deactivate_matching_stream(existing_stream)
 
 
     def add_streams_from_config(self, config) -> 'Streamlist':
@@ -481,32 +960,46 @@ class StreamList():
         Adds all streams from the config as protected/deactivated streams
         This is a mechanism to permanently "reserve" certain stream keys
         """
-        for stream in config["stream"]["key"]:
-            # Parse the values from the configs
-            name        = none_if_no_key_value_otherwise(stream, key="name")
-            password    = none_if_no_key_value_otherwise(stream, key="password")
-            description = none_if_no_key_value_otherwise(stream, key="description")
-            unlisted    = none_if_no_key_value_otherwise(stream, key="name")
-            unlisted = value_to_flag(unlisted)
-
-            # The only field that needs to be present is "name"
-            if name is None:
-                self.logger.warning("Found a stream in the configuration with no \"name\" defined!")
-                continue
-
-            # Construct a protected but deactivated stream with all other values
-            # coming from the config
-            protected_stream = Stream().set_key(name)\
-                                       .set_password(password)\
-                                       .set_description(description)\
-                                       .set_unlisted(unlisted)\
-                                       .set_protected(True)\
-                                       .deactivate()
-
-            self.logger.debug("Stream looked like this: {}".format(protected_stream))
-
-            # Add the new protected stream to the streamlist
-            self.add_stream(protected_stream)
+        # All streams from the config get published in a single snapshot
+        with self.changes():
+            for stream in config["stream"]["key"]:
+                # Parse the values from the configs
+                name        = none_if_no_key_value_otherwise(stream, key="name")
+                password    = none_if_no_key_value_otherwise(stream, key="password")
+                description = none_if_no_key_value_otherwise(stream, key="description")
+                unlisted    = none_if_no_key_value_otherwise(stream, key="name")
+                unlisted = value_to_flag(unlisted)
+
+                # The only field that needs to be present is "name"
+                if name is None:
+                    self.logger.warning("Found a stream in the configuration with no \"name\" defined!")
+                    continue
+
+                # Names ending in * reserve a prefix, the streams under it are
+                # only created once they get published
+                if name.endswith("*"):
+                    if "*" in name.rstrip("*"):
+                        self.logger.warning("Ignored the stream \"%s\" in the configuration, * is only allowed at the end", name)
+                        continue
+                    self.reservations.add(Reservation(name, password=password, description=description,
+                                                      unlisted=stream.get("unlisted") is True,
+                                                      quota=stream.get("quota")))
+                    self.logger.debug("Reserved the keys %s", name)
+                    continue
+
+                # Construct a protected but deactivated stream with all other values
+                # coming from the config
+                protected_stream = Stream().set_key(name)\
+                                           .set_password(password)\
+                                           .set_description(description)\
+                                           .set_unlisted(unlisted)\
+                                           .set_protected(True)\
+                                           .deactivate()
+
+                self.logger.debug("Stream looked like this: %s", protected_stream)
+
+                # Add the new protected stream to the streamlist
+                self.add_stream(protected_stream)
 
         return self
 
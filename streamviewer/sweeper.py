@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import os
+import time
+from pathlib import Path
+
+from .logs import original_module
+from .tokens import hls_stream_key
+
+
+class Sweeper():
+    """
+    Removes HLS playlists and segments of streams that are no longer active
+    from the hls_path (e.g. left behind by a crash of nginx). Files are only
+    removed once they were not modified for the grace period.
+
+    The hls_path is walked with os.scandir in batches. After every batch the
+    sweeper sleeps long enough to stay within its IO budget (file operations
+    per second), so a big directory doesn't starve nginx. Sweeps run in a real
+    OS thread (like the Archiver), so the filesystem work never blocks the
+    event loop. A file that can't be removed is counted and skipped.
+
+    This uses a builder pattern, like the StreamList:
+    sweeper = Sweeper(logger, "/data/hls").set_grace(3600).start(streamlist)
+    """
+    def __init__(self, logger, hls_path: str):
+        self.logger = logger
+        self.hls_path = Path(hls_path)
+        self.interval = 300.0
+        self.grace = 3600.0
+        self.batch_size = 100
+        self.io_budget = 500.0
+        self.last_sweep = {}
+        self.reclaimed = 0
+        self.removed = 0
+        self.errors = 0
+
+    def set_interval(self, seconds: float) -> 'Sweeper':
+        """
+        Set the seconds between the end of a sweep and the start of the next
+        """
+        self.interval = float(seconds)
+        return self
+
+    def set_grace(self, seconds: float) -> 'Sweeper':
+        """
+        Set the seconds a file has to be unmodified before it may be removed
+        """
+        self.grace = float(seconds)
+        return self
+
+    def set_io_budget(self, operations: float) -> 'Sweeper':
+        """
+        Set the file operations (stat or unlink) per second a sweep may use
+        """
+        self.io_budget = max(1.0, float(operations))
+        return self
+
+    def start(self, streamlist) -> 'Sweeper':
+        worker = original_module("threading").Thread(target=self.run, args=(streamlist,))
+        worker.daemon = True
+        worker.start()
+        return self
+
+    def run(self, streamlist):
+        sleep = original_module("time").sleep
+        while True:
+            sleep(self.interval)
+            try:
+                self.sweep(streamlist)
+            except OSError as e:
+                self.logger.warning("Couldn't sweep %s: %s", self.hls_path, e)
+            except Exception:
+                self.logger.exception("Failed to sweep %s", self.hls_path)
+
+    def is_orphan(self, streamlist, name: str) -> bool:
+        """
+        Return True if the file belongs to a stream that is not active
+        """
+        key = hls_stream_key(name)
+        if key is None:
+            return False
+        stream = streamlist.get_stream(key)
+        return stream is None or not stream.active
+
+    def sweep(self, streamlist) -> dict:
+        """
+        Walk the hls_path once and remove the orphaned files older than the
+        grace period. Returns the numbers of this sweep
+        """
+        sleep = original_module("time").sleep
+        started = time.monotonic()
+        deadline = time.time() - self.grace
+        scanned = removed = reclaimed = errors = operations = 0
+        with os.scandir(self.hls_path) as entries:
+            for entry in entries:
+                scanned += 1
+                if scanned % self.batch_size == 0:
+                    sleep(operations / self.io_budget)
+                    operations = 0
+                # Only the name is needed for this check, no IO yet
+                if not self.is_orphan(streamlist, entry.name):
+                    continue
+                try:
+                    operations += 1
+                    stat = entry.stat(follow_symlinks=False)
+                    if not entry.is_file(follow_symlinks=False) or stat.st_mtime > deadline:
+                        continue
+                    operations += 1
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    # nginx was faster
+                    continue
+                except OSError as e:
+                    errors += 1
+                    self.logger.debug("Couldn't remove %s: %s", entry.path, e)
+                    continue
+                removed += 1
+                reclaimed += stat.st_size
+
+        self.removed += removed
+        self.reclaimed += reclaimed
+        self.errors += errors
+        self.last_sweep = {
+            "scanned": scanned,
+            "removed": removed,
+            "reclaimed": reclaimed,
+            "errors": errors,
+            "duration": time.monotonic() - started,
+        }
+        if removed:
+            self.logger.info("Removed %s orphaned HLS files (%s bytes) from %s in %.1f s", removed, reclaimed, self.hls_path, self.last_sweep["duration"])
+        if errors:
+            self.logger.warning("Couldn't remove %s orphaned HLS files from %s", errors, self.hls_path)
+        return self.last_sweep
+
+    def stats(self) -> dict:
+        return {
+            "last_sweep": self.last_sweep,
+            "removed": self.removed,
+            "reclaimed": self.reclaimed,
+            "errors": self.errors,
+        }
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import hmac
+import time
+import base64
+import hashlib
+import secrets
+import collections
+import urllib.parse
+from typing import Optional
+
+
+# Which streams need a signed viewing token to fetch their HLS files
+TOKEN_MODES = ["off", "unlisted", "all"]
+
+
+def token_cookie(key: str) -> str:
+    """
+    Return the name of the cookie holding the viewing token of a stream. The
+    key is hex encoded, as stream keys may contain characters which are not
+    allowed in cookie names
+    """
+    return "hls_" + key.encode("utf-8").hex()
+
+
+def hls_stream_key(uri: str) -> Optional[str]:
+    """
+    Return the stream key of an HLS playlist or segment URI, e.g. foo for
+    /hls/foo.m3u8 or /hls/foo-12.ts, None for anything else
+    """
+    name = urllib.parse.unquote(uri.partition("?")[0].rpartition("/")[2])
+    if name.endswith(".m3u8"):
+        return name[:-5] or None
+    if name.endswith(".ts"):
+        key, sep, _ = name[:-3].rpartition("-")
+        return key if sep else None
+    return None
+
+
+def archive_stream_key(uri: str, archive_url: str="/archive") -> Optional[str]:
+    """
+    Return the stream key of a file in an archive URI, e.g. foo for
+    /archive/foo/20210101-120000/foo-12.ts, None for anything else
+    """
+    prefix = archive_url.rstrip("/") + "/"
+    path = uri.partition("?")[0]
+    if not path.startswith(prefix):
+        return None
+    parts = path[len(prefix):].split("/")
+    if len(parts) != 3 or not all(parts):
+        return None
+    return urllib.parse.unquote(parts[0])
+
+
+def uri_token(uri: str) -> Optional[str]:
+    """
+    Return the token query parameter of a URI (for players without cookies)
+    """
+    values = urllib.parse.parse_qs(uri.partition("?")[2]).get("token")
+    return values[0] if values else None
+
+
+class ViewingTokens():
+    """
+    Issues and verifies HMAC signed, expiring tokens for watching a stream.
+
+    A token is "<expiry>.<signature>" where the signature covers the stream
+    key and the expiry. Expiries are rounded up to the next full granularity,
+    so everyone opening a stream within that time gets the same token, which
+    keeps the verification cache small and its hit rate high.
+
+    nginx asks for every playlist and segment fetch, so verify() is built to be
+    cheap: the HMAC state of the secret is computed once and copied, and
+    verified tokens are kept in an LRU cache.
+
+    This uses a builder pattern, like the StreamList:
+    tokens = ViewingTokens("secret").set_lifetime(3600)
+    """
+    def __init__(self, secret: Optional[str]=None):
+        # Without a secret tokens are only valid until the next restart
+        secret = secret or secrets.token_hex(32)
+        self.mac = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+        self.lifetime = 3600
+        self.granularity = 60
+        self.cache_size = 4096
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def set_lifetime(self, seconds: int) -> 'ViewingTokens':
+        """
+        Set the seconds a token is at least valid
+        """
+        self.lifetime = int(seconds)
+        return self
+
+    def set_cache_size(self, n: int) -> 'ViewingTokens':
+        """
+        Set the number of verified tokens that are cached
+        """
+        self.cache_size = int(n)
+        return self
+
+    def signature(self, key: str, expiry: int) -> str:
+        mac = self.mac.copy()
+        mac.update("{}\n{}".format(expiry, key).encode("utf-8"))
+        return base64.urlsafe_b64encode(mac.digest()[:18]).decode("ascii")
+
+    def issue(self, key: str, now: Optional[float]=None) -> str:
+        """
+        Return a token for watching the stream with the key
+        """
+        now = time.time() if now is None else now
+        expiry = int(now + self.lifetime)
+        expiry += -expiry % self.granularity
+        return "{}.{}".format(expiry, self.signature(key, expiry))
+
+    def verify(self, key: str, token: Optional[str], now: Optional[float]=None) -> bool:
+        """
+        Return True if the token is valid for the stream and not expired
+        """
+        if not token:
+            return False
+        now = time.time() if now is None else now
+        cached = self.cache.get((key, token))
+        if cached is not None:
+            self.hits += 1
+            self.cache.move_to_end((key, token))
+            return cached > now
+
+        self.misses += 1
+        expiry, _, signature = token.partition(".")
+        try:
+            expiry = int(expiry)
+        except ValueError:
+            return False
+        try:
+            if not hmac.compare_digest(signature, self.signature(key, expiry)):
+                return False
+        except TypeError:
+            # Not ASCII
+            return False
+        # Only valid tokens are cached, so garbage can't push them out
+        self.cache[(key, token)] = expiry
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return expiry > now
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Webhooks for stream lifecycle events
+
+The nginx callbacks only queue an event (e.g. stream.started) in memory and
+return. Each endpoint is served by its own background task, which collects the
+events of a short window into one POST of {"events": [...]} over a keep-alive
+connection. Failed deliveries are retried with exponential backoff. With a
+spill_path the background task writes the events of an endpoint that is down
+to disk, so they survive a restart. Delivery is at least once, events carry an
+id to detect duplicates.
+"""
+import hmac
+import json
+import time
+import uuid
+import random
+import hashlib
+import http.client
+import urllib.parse
+import collections
+from itertools import islice
+from pathlib import Path
+from typing import List, Optional
+
+
+class Endpoint():
+    """
+    A webhook receiver and the queue of events it didn't get yet. Events are
+    queued in memory, while the endpoint is down they are moved to its spill
+    file (if there is a spill_path) and read back from there in order. Only
+    the background task of the endpoint touches the spill file
+    """
+    def __init__(self, logger, url: str, events: Optional[List[str]]=None, secret: Optional[str]=None, timeout: float=2):
+        self.logger = logger
+        self.url = url
+        self.events = events
+        self.secret = secret
+        self.timeout = timeout
+        parts = urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += "?" + parts.query
+        self.connection = None
+        self.memory = collections.deque()
+        self.max_memory = 10000
+        self.spill_file = None
+        self.spilling = False
+        self.offset = 0
+        self.next_offset = 0
+        self.failures = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.corrupt = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.error = None
+
+    def __str__(self) -> str:
+        return self.url
+
+    def set_spill_path(self, path: Optional[str]) -> 'Endpoint':
+        """
+        Spill the events to a file in path while the endpoint is down, events
+        spilled before a restart are delivered first
+        """
+        if not path:
+            return self
+        Path(path).mkdir(parents=True, exist_ok=True)
+        name = hashlib.sha1(self.url.encode("utf-8")).hexdigest()[:16]
+        self.spill_file = Path(path) / "{}.jsonl".format(name)
+        self.spilling = self.spill_file.exists() and self.spill_file.stat().st_size > 0
+        if self.spilling:
+            # A write cut short by a crash would run into the next event
+            with open(self.spill_file, "rb+") as f:
+                f.seek(-1, 2)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+        return self
+
+    def wants(self, event: dict) -> bool:
+        return self.events is None or event["event"] in self.events
+
+    def push(self, event: dict):
+        """
+        Queue an event in memory, the oldest one is dropped if there are more
+        than max_memory. Never blocks on disk
+        """
+        self.memory.append(event)
+        if len(self.memory) > self.max_memory:
+            self.memory.popleft()
+            self.dropped += 1
+
+    def append_to_spill(self, events: List[dict]):
+        with open(self.spill_file, "a") as f:
+            f.write("".join(json.dumps(e, separators=(",", ":")) + "\n" for e in events))
+        self.spilling = True
+
+    def spill(self):
+        """
+        Move the events in memory to the spill file (if there is one)
+        """
+        if self.spill_file is not None and self.memory:
+            n = len(self.memory)
+            self.append_to_spill(list(islice(self.memory, n)))
+            # Events pushed meanwhile stay
+            for _ in range(n):
+                self.memory.popleft()
+
+    def has_pending(self) -> bool:
+        return self.spilling or bool(self.memory)
+
+    def peek(self, n: int) -> List[dict]:
+        """
+        Return up to n of the oldest events without removing them. Lines of
+        the spill file that can't be parsed are skipped (and removed with the
+        events of this peek)
+        """
+        if not self.spilling:
+            return list(islice(self.memory, n))
+        with open(self.spill_file, "rb") as f:
+            f.seek(self.offset)
+            lines = list(islice(f, n))
+        self.next_offset = self.offset + sum(len(line) for line in lines)
+        events = []
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                self.corrupt += 1
+                self.logger.warning("Skipped a corrupt line in the webhook spill file %s: %r", self.spill_file, line[:100])
+        return events
+
+    def pop(self, n: int):
+        """
+        Remove the n events returned by the last peek
+        """
+        if not self.spilling:
+            for _ in range(n):
+                self.memory.popleft()
+            return
+        self.offset = self.next_offset
+        if self.offset >= self.spill_file.stat().st_size:
+            # Everything spilled is delivered, back to memory
+            self.spill_file.unlink()
+            self.spilling = False
+            self.offset = 0
+
+    def connect(self) -> http.client.HTTPConnection:
+        if self.connection is None:
+            if self.scheme == "https":
+                self.connection = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                self.connection = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def post(self, events: List[dict]):
+        """
+        POST the events, raises OSError, http.client.HTTPException or
+        ValueError if they were not accepted. A reused connection that was
+        closed by the endpoint is reopened once
+        """
+        body = json.dumps({"events": events}, separators=(",", ":")).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers["X-Streamviewer-Signature"] = "sha256=" + hmac.new(self.secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        for attempt in range(2):
+            connection = self.connect()
+            try:
+                connection.request("POST", self.path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt == 1:
+                    raise
+        if not 200 <= response.status < 300:
+            raise ValueError("{} answered with status {}".format(self, response.status))
+
+    def backoff(self, max_backoff: float) -> float:
+        """
+        Return the seconds to wait before the next attempt, doubling with every
+        failure (with jitter, so endpoints coming back aren't hit all at once)
+        """
+        return min(max_backoff, 2 ** (self.failures - 1)) * random.uniform(0.5, 1.0)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "queued": len(self.memory),
+            "spilled": self.spill_file.stat().st_size - self.offset if self.spilling else 0,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "corrupt": self.corrupt,
+            "failures": self.failures,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "error": self.error,
+        }
+
+
+class WebhookDispatcher():
+    """
+    Queues stream lifecycle events and delivers them to all endpoints in the
+    background.
+
+    This uses a builder pattern, like the StreamList:
+    webhooks = WebhookDispatcher(socketio, logger).set_batch_window(1).add_endpoint(endpoint)
+    """
+    def __init__(self, socketio, logger):
+        self.socketio = socketio
+        self.logger = logger
+        self.endpoints = []
+        self.batch_window = 1.0
+        self.max_batch = 100
+        self.max_backoff = 300.0
+
+    def set_batch_window(self, seconds: float) -> 'WebhookDispatcher':
+        """
+        Set the seconds during which events are collected into one POST
+        """
+        self.batch_window = float(seconds)
+        return self
+
+    def set_max_batch(self, n: int) -> 'WebhookDispatcher':
+        """
+        Set the maximum number of events in one POST
+        """
+        self.max_batch = max(1, int(n))
+        return self
+
+    def set_max_backoff(self, seconds: float) -> 'WebhookDispatcher':
+        """
+        Set the maximum seconds between two attempts to reach an endpoint
+        """
+        self.max_backoff = float(seconds)
+        return self
+
+    def add_endpoint(self, endpoint: 'Endpoint') -> 'WebhookDispatcher':
+        self.endpoints.append(endpoint)
+        return self
+
+    def add_endpoints_from_config(self, config) -> 'WebhookDispatcher':
+        """
+        Add all endpoints from the [[webhooks.endpoint]] entries of the config
+        """
+        for e in config["webhooks"]["endpoint"]:
+            if "url" not in e:
+                self.logger.warning("Found a webhook endpoint in the configuration without \"url\"!")
+                continue
+            endpoint = Endpoint(self.logger, e["url"], events=e.get("events"), secret=e.get("secret"))\
+                            .set_spill_path(config["webhooks"]["spill_path"])
+            endpoint.max_memory = config["webhooks"]["max_queue"]
+            self.add_endpoint(endpoint)
+        return self
+
+    def start(self) -> 'WebhookDispatcher':
+        for endpoint in self.endpoints:
+            self.socketio.start_background_task(self.run, endpoint)
+        return self
+
+    def run(self, endpoint: 'Endpoint'):
+        while True:
+            # Wait for the first event, then give the others of the window a
+            # chance to join it
+            self.socketio.sleep(self.batch_window)
+            while endpoint.has_pending():
+                if not self.deliver(endpoint):
+                    self.wait(endpoint, endpoint.backoff(self.max_backoff))
+
+    def wait(self, endpoint: 'Endpoint', seconds: float):
+        """
+        Sleep until the next attempt, events queued meanwhile are spilled
+        after every batch window
+        """
+        until = time.monotonic() + seconds
+        while True:
+            left = until - time.monotonic()
+            if left <= 0:
+                return
+            self.socketio.sleep(min(left, self.batch_window))
+            self.spill(endpoint)
+
+    def spill(self, endpoint: 'Endpoint'):
+        try:
+            endpoint.spill()
+        except OSError as e:
+            # They stay in memory
+            self.logger.warning("Couldn't spill webhook events of %s to %s: %s", endpoint, endpoint.spill_file, e)
+
+    def enqueue(self, event: str, key: str, **data):
+        """
+        Queue an event for all endpoints that want it, returns immediately
+        """
+        event = dict(data, id=uuid.uuid4().hex, event=event, key=key, time=time.time())
+        for endpoint in self.endpoints:
+            if endpoint.wants(event):
+                endpoint.push(event)
+
+    def stream_started(self, stream: 'Stream'):
+        self.enqueue("stream.started", stream.key, description=stream.description, unlisted=bool(stream.unlisted))
+
+    def stream_stopped(self, key: str):
+        self.enqueue("stream.stopped", key)
+
+    def deliver(self, endpoint: 'Endpoint') -> bool:
+        """
+        Send the oldest events of the endpoint as one batch, returns True if
+        they were delivered (or there were none)
+        """
+        try:
+            events = endpoint.peek(self.max_batch)
+            if events:
+                endpoint.post(events)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            endpoint.failures += 1
+            if endpoint.error is None:
+                self.logger.warning("Couldn't deliver webhook events to %s: %s", endpoint, e)
+            endpoint.error = str(e)
+            self.spill(endpoint)
+            return False
+        # Also removes corrupt lines of the spill file that yielded no events
+        endpoint.pop(len(events))
+        if not events:
+            return True
+        if endpoint.error is not None:
+            self.logger.info("Delivered webhook events to %s again", endpoint)
+            endpoint.error = None
+        endpoint.failures = 0
+        endpoint.delivered += len(events)
+        endpoint.last_lag = time.time() - events[0]["time"]
+        endpoint.max_lag = max(endpoint.max_lag, endpoint.last_lag)
+        return True
+
+    def stats(self) -> List[dict]:
+        return [e.stats() for e in self.endpoints]
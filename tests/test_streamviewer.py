@@ -1,5 +1,1319 @@
+import pytest
+
 from streamviewer import __version__
 
 
+def import_keeping_loggers(name: str):
+    """
+    Import a streamviewer module that applies the logging dictConfig of
+    streamviewer.config, without disabling the loggers of the other tests
+    """
+    import logging
+    import importlib
+    enabled = [l for l in logging.root.manager.loggerDict.values() if isinstance(l, logging.Logger) and not l.disabled]
+    module = importlib.import_module(name)
+    for logger in enabled:
+        logger.disabled = False
+    return module
+
+
+@pytest.fixture(scope="module")
+def server():
+    """
+    streamviewer.server with the default config. It is imported in a daemon
+    thread: the background tasks it starts are daemon threads as well then,
+    and don't keep the test run from exiting
+    """
+    import threading
+    pytest.importorskip("flask_socketio")
+    imported = {}
+    def run():
+        try:
+            imported["server"] = import_keeping_loggers("streamviewer.server")
+        except Exception as e:
+            imported["error"] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join()
+    if "error" in imported:
+        raise imported["error"]
+    return imported["server"]
+
+
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_event_sampler():
+    import logging
+    from streamviewer.logs import EventSampler
+    sampler = EventSampler({"join": 3})
+    def record(event=None):
+        r = logging.LogRecord("test", logging.INFO, __file__, 0, "msg", None, None)
+        if event is not None:
+            r.event = event
+        return r
+    passed = [sampler.filter(record("join")) for _ in range(6)]
+    assert passed == [True, False, False, True, False, False]
+    assert sampler.filter(record("leave"))
+    assert sampler.filter(record())
+
+
+def test_queue_handler_prepare():
+    import sys
+    import queue
+    import logging
+    from streamviewer.logs import NonBlockingQueueHandler
+    handler = NonBlockingQueueHandler(queue.Queue())
+    args = ["foo"]
+    try:
+        raise ValueError("bar")
+    except ValueError:
+        record = logging.LogRecord("test", logging.ERROR, __file__, 0, "Stream %s failed", (args,), sys.exc_info())
+    prepared = handler.prepare(record)
+    args.append("baz")
+    # Merged with its arguments before the caller can change them
+    assert prepared.getMessage() == "Stream ['foo'] failed"
+    assert prepared.args is None and prepared.exc_info is None
+    assert "ValueError: bar" in logging.Formatter().format(prepared)
+
+
+def test_streamlist_pages():
+    import logging
+    from streamviewer.streams import Stream, StreamList
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(100).set_free_choice(True)
+    for key in ["foo", "bar", "foobar", "baz", "hidden"]:
+        streamlist.add_stream(Stream().set_key(key).set_unlisted(key == "hidden"))
+    for _ in range(3):
+        streamlist.add_viewer("baz")
+    streamlist.add_viewer("foobar")
+    streamlist.publish_viewcounts()
+
+    page, cursor = streamlist.page("viewcount", limit=2)
+    assert [s.key for s in page] == ["baz", "foobar"]
+    page, cursor = streamlist.page("viewcount", cursor=cursor, limit=2)
+    assert [s.key for s in page] == ["bar", "foo"] and cursor is None
+
+    page, cursor = streamlist.page("started", prefix="foo", limit=1)
+    assert [s.key for s in page] == ["foo"]
+    page, cursor = streamlist.page("started", prefix="foo", cursor=cursor, limit=1)
+    assert [s.key for s in page] == ["foobar"] and cursor is None
+
+    streamlist.remove_stream("foo")
+    assert [s.key for s in streamlist.page("started")[0]] == ["bar", "foobar", "baz"]
+
+
+def test_wire_list():
+    import json
+    import logging
+    from streamviewer.streams import Stream, StreamList, WIRE_FIELDS, PROJECTIONS
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(100).set_free_choice(True)
+    streamlist.add_stream(Stream().set_key("foo").set_description("# Foo"))
+    wire = streamlist.wire_list("detail")
+    assert wire["fields"] == WIRE_FIELDS
+    stream = dict(zip(wire["fields"], wire["streams"][0]))
+    assert stream["key"] == "foo" and stream["active"] and stream["description"] == "# Foo"
+    assert isinstance(stream["started"], float) and stream["ended"] is None
+    # Plain JSON without a custom converter
+    json.dumps(wire)
+
+    # The list projection leaves out the description, the detail has it
+    wire = streamlist.wire_list()
+    assert wire["fields"] == PROJECTIONS["list"] and "description" not in wire["fields"]
+    assert wire["streams"] == [["foo", 0, stream["started"]]]
+    assert streamlist.detail("foo") == stream and streamlist.detail("bar") is None
+    # Only streams that exist are cached
+    assert [name for name in streamlist.snapshot.cache if name[0] == "detail"] == [("detail", "foo")]
+
+    # Serializations are built once per version
+    assert streamlist.wire_list() is wire
+    streamlist.add_viewer("foo")
+    assert streamlist.wire_list() is wire
+    streamlist.publish_viewcounts()
+    assert streamlist.wire_list() is not wire and streamlist.wire_list()["streams"][0][1] == 1
+    assert streamlist.detail("foo")["viewcount"] == 1
+
+
+def test_segment_analyzer(tmp_path):
+    import logging
+    import pytest
+    pytest.importorskip("numpy")
+    from streamviewer.analyzer import SegmentAnalyzer, TS_PACKET_SIZE
+    from streamviewer.streams import Stream, StreamList
+
+    def ts_packet(pid, cc, payload, pusi=False, random_access=False):
+        header = bytes([0x47, (0x40 if pusi else 0) | pid >> 8, pid & 0xff, (0x30 if random_access else 0x10) | cc])
+        adaptation = bytes([1, 0x40]) if random_access else b""
+        packet = header + adaptation + payload
+        return packet + b"\xff" * (TS_PACKET_SIZE - len(packet))
+
+    def pes_header(pts):
+        return bytes([0, 0, 1, 0xe0, 0, 0, 0x80, 0x80, 5,
+                      0x21 | (pts >> 29) & 0x0e, (pts >> 22) & 0xff, (pts >> 14) & 0xfe | 1,
+                      (pts >> 7) & 0xff, (pts << 1) & 0xfe | 1])
+
+    # 30 frames at 30 fps on PID 0x100, a keyframe every 10 frames, every
+    # frame a PES packet starting with a PTS and one continuation packet
+    packets, cc = [], 0
+    for frame in range(30):
+        packets.append(ts_packet(0x100, cc % 16, pes_header(frame * 3000), pusi=True, random_access=frame % 10 == 0))
+        # One packet is lost
+        cc += 2 if frame == 20 else 1
+        packets.append(ts_packet(0x100, cc % 16, b"\x00" * 16))
+        cc += 1
+    (tmp_path / "foo-0.ts").write_bytes(b"".join(packets))
+    (tmp_path / "foo.m3u8").write_text("#EXTM3U\n#EXTINF:1.000,\nfoo-0.ts\n")
+
+    class FakeSocketIO():
+        sleeps = 0
+        def sleep(self, seconds):
+            self.sleeps += 1
+
+    socketio = FakeSocketIO()
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(100).set_free_choice(True)
+    streamlist.add_stream(Stream().set_key("foo"))
+    analyzer = SegmentAnalyzer(socketio, logging.getLogger("test"), str(tmp_path))
+    assert analyzer.analyze(streamlist) == 1
+    health = streamlist.get_stream("foo").health
+    assert health["segments"] == 1 and health["continuity_errors"] == 1
+    assert abs(health["segment_duration"] - 1.0) < 1e-9
+    assert abs(health["keyframe_interval"] - 10 / 30) < 1e-9
+    assert abs(health["bitrate"] - 60 * TS_PACKET_SIZE * 8) < 1e-6
+    # Yielded to the event loop after the segment and after the stream
+    assert socketio.sleeps == 2
+    # Cached segments are not read again, the unchanged health isn't published
+    version = streamlist.version
+    analyzer.analyze(streamlist)
+    assert socketio.sleeps == 3
+    assert streamlist.version == version and streamlist.get_stream("foo").health is health
+
+
+def test_streamlist_snapshots():
+    import logging
+    from streamviewer.streams import Stream, StreamList
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(100).set_free_choice(True)
+    streamlist.add_stream(Stream().set_key("foo"))
+    snapshot = streamlist.snapshot
+    # Viewers are counted without a new snapshot, until they are published
+    assert streamlist.add_viewer("foo") == 1
+    assert streamlist.add_viewer("foo") == 2 and streamlist.remove_viewer("foo") == 1
+    assert streamlist.viewcount("foo") == 1 and streamlist.version == snapshot.version
+    assert streamlist.publish_viewcounts() == ["foo"] and streamlist.publish_viewcounts() == []
+    # Published snapshots and their streams never change
+    assert snapshot.by_key["foo"].viewcount == 0
+    assert streamlist.get_stream("foo").viewcount == 1
+    assert streamlist.version == snapshot.version + 1
+    # Removed streams take their viewers with them
+    streamlist.remove_stream("foo")
+    streamlist.add_stream(Stream().set_key("foo"))
+    assert streamlist.viewcount("foo") == 0
+
+    # Batched changes result in a single new version
+    version = streamlist.version
+    with streamlist.changes():
+        streamlist.add_stream(Stream().set_key("bar"))
+        streamlist.add_viewer("bar")
+        streamlist.remove_stream("foo")
+    assert streamlist.version == version + 1
+    assert [s.key for s in streamlist.listed_streams()] == ["bar"]
+
+    # Failed writes don't publish anything
+    version = streamlist.version
+    streamlist.add_viewer("does-not-exist")
+    assert streamlist.version == version
+
+
+def test_broadcaster_coalesces():
+    import types
+    import queue
+    import logging
+    from streamviewer.streams import Stream, StreamList
+    from streamviewer.broadcast import Broadcaster
+
+    class FakeSocketIO():
+        def __init__(self):
+            self.tasks = []
+            self.emitted = []
+        def start_background_task(self, task):
+            self.tasks.append(task)
+        def emit(self, event, data, skip_sid=None):
+            self.emitted.append((event, data))
+
+    socketio = FakeSocketIO()
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(100).set_free_choice(True)
+    broadcaster = Broadcaster(socketio, streamlist, logging.getLogger("test"))
+    broadcaster.slow_clients = lambda keys: []
+    for i in range(50):
+        streamlist.add_stream(Stream().set_key("s{}".format(i)))
+        broadcaster.stream_added("s{}".format(i))
+    streamlist.remove_stream("s0")
+    broadcaster.stream_removed("s0")
+
+    assert len(socketio.tasks) == 1
+    assert broadcaster.stats()["depth"] == 50
+    broadcaster.flush()
+    assert len(socketio.emitted) == 1
+    event, data = socketio.emitted[0]
+    assert event == "streams_changed"
+    assert data["version"] == streamlist.version
+    assert data["removed"] == ["s0"] and len(data["added"]) == 49
+    assert len(data["list"]["streams"]) == 49
+    assert broadcaster.stats()["depth"] == 0
+
+    # Viewcounts are published with the next message, in one new version
+    streamlist.add_stream(Stream().set_key("s50"))
+    broadcaster.stream_added("s50")
+    version = streamlist.version
+    for key in ["s1", "s2", "s50"]:
+        streamlist.add_viewer(key)
+        broadcaster.viewcount_changed(key)
+    assert streamlist.version == version
+    broadcaster.flush()
+    event, data = socketio.emitted[-1]
+    assert data["version"] == streamlist.version == version + 1
+    assert data["added"] == ["s50"] and data["removed"] == []
+    assert [row[1] for row in data["list"]["streams"] if row[0] in ["s1", "s2", "s50"]] == [1, 1, 1]
+    # Nothing is sent for viewers that came and went again
+    streamlist.remove_viewer("s1")
+    streamlist.add_viewer("s1")
+    broadcaster.viewcount_changed("s1")
+    broadcaster.flush()
+    assert len(socketio.emitted) == 2
+
+    # Slow clients are skipped, unless they are on the page of a changed stream
+    class FakeManager():
+        rooms = {None: [("a", "ea"), ("b", "eb"), ("c", "ec")], "s1": [("b", "eb")]}
+        def get_participants(self, namespace, room):
+            for participant in self.rooms[room]:
+                yield participant
+
+    class FakeSocket():
+        def __init__(self, backlog):
+            self.queue = queue.Queue()
+            for _ in range(backlog):
+                self.queue.put(None)
+
+    socketio.server = types.SimpleNamespace(manager=FakeManager(), eio=types.SimpleNamespace(
+        sockets={"ea": FakeSocket(100), "eb": FakeSocket(100), "ec": FakeSocket(0)}))
+    del broadcaster.slow_clients
+    assert broadcaster.slow_clients(["s1", "s2"]) == ["a"]
+    assert broadcaster.slow_clients() == ["a", "b"]
+
+
+def test_broadcaster_threads():
+    import logging
+    import threading
+    from streamviewer.streams import StreamList
+    from streamviewer.broadcast import Broadcaster
+
+    class FakeSocketIO():
+        def __init__(self):
+            self.tasks = 0
+            self.added = []
+        def start_background_task(self, task):
+            self.tasks += 1
+        def emit(self, event, data, skip_sid=None):
+            self.added += data["added"]
+
+    # Changes queued by other threads while flushing are neither lost nor
+    # left without a scheduled flush
+    socketio = FakeSocketIO()
+    broadcaster = Broadcaster(socketio, StreamList(logging.getLogger("test")), logging.getLogger("test"))
+    broadcaster.slow_clients = lambda keys: []
+    def publish(n):
+        for i in range(2000):
+            broadcaster.stream_added("{}-{}".format(n, i))
+    threads = [threading.Thread(target=publish, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        broadcaster.flush()
+    assert broadcaster.scheduled == bool(broadcaster.pending)
+    broadcaster.flush()
+    assert len(socketio.added) == len(set(socketio.added)) == 8000
+    assert socketio.tasks <= broadcaster.dispatched + 1
+
+
+def test_health_monitor(tmp_path):
+    from streamviewer.health import HealthMonitor
+
+    class FakeSocketIO():
+        def start_background_task(self, task):
+            pass
+
+    monitor = HealthMonitor(FakeSocketIO(), str(tmp_path)).start()
+    assert monitor.failed_checks() == ["config", "streamlist"]
+    monitor.set_config_loaded().set_streamlist_ready()
+    assert monitor.failed_checks() == []
+    monitor.hls_path = str(tmp_path / "missing")
+    monitor.check()
+    assert monitor.failed_checks() == ["hls_path"]
+
+
+def test_asgi_loop_lag(tmp_path):
+    import time
+    import asyncio
+    import threading
+    pytest.importorskip("socketio")
+    import flask
+    from streamviewer.engine import AsyncSocketIO
+    from streamviewer.health import HealthMonitor
+    socketio = AsyncSocketIO(flask.Flask(__name__))
+    monitor = HealthMonitor(socketio, str(tmp_path))
+    assert monitor.measure_loop_lag(socketio.run_on_loop) == 0.0
+
+    # The monitor runs in a thread, the lag is measured on the event loop
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    try:
+        attached = threading.Event()
+        loop.call_soon_threadsafe(lambda: (socketio.attach(), attached.set()))
+        attached.wait(1)
+        assert monitor.measure_loop_lag(socketio.run_on_loop) < 0.1
+        loop.call_soon_threadsafe(time.sleep, 0.3)
+        assert 0.25 < monitor.measure_loop_lag(socketio.run_on_loop) < monitor.interval
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def test_config_errors(tmp_path, monkeypatch):
+    import_keeping_loggers("streamviewer.config")
+    import streamviewer.config
+    good, broken = tmp_path / "good.toml", tmp_path / "broken.toml"
+    good.write_text("[application]\nmax_streams = 7\n")
+    broken.write_text("[application\nmax_streams = 8\n")
+    monkeypatch.setattr(streamviewer.config, "get_existing_config_file_paths", lambda: [good, broken])
+    errors = []
+    config = streamviewer.config.initialize_config(errors=errors)
+    assert config["application"]["max_streams"] == 7
+    assert len(errors) == 1 and str(broken) in errors[0]
+    with pytest.raises(ValueError):
+        streamviewer.config.initialize_config()
+
+
+def test_federation_fake_origin():
+    import json
+    import logging
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from streamviewer.federation import Federation, Origin
+
+    class FakeOrigin(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        version = 1
+        requests = 0
+
+        def do_GET(self):
+            FakeOrigin.requests += 1
+            etag = '"{}"'.format(FakeOrigin.version)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = json.dumps({"streams": [{"key": "foo", "active": True}], "cursor": None}).encode()
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOrigin)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_port)
+
+    logger = logging.getLogger("test")
+    origin = Origin(logger, "ingest-1", url)
+    federation = Federation(None, logger).set_max_staleness(30).add_origin(origin)
+    assert federation.listed_streams() == []
+
+    state = federation.state()
+    assert federation.pull(origin)
+    assert federation.state() != state
+    state = federation.state()
+    assert not federation.pull(origin)
+    assert federation.state() == state
+    assert federation.listed_streams() == [{"key": "foo", "active": True, "origin": "ingest-1", "hls_url": url + "/hls"}]
+    assert FakeOrigin.requests == 2
+
+    # An unreachable origin keeps its streams until they are stale
+    origin.close()
+    server.shutdown()
+    server.server_close()
+    assert not federation.pull(origin)
+    assert origin.error is not None and federation.state() != state
+    assert len(federation.listed_streams()) == 1
+    federation.set_max_staleness(-1)
+    assert federation.listed_streams() == []
+
+
+def test_event_buffer_resume():
+    from streamviewer.events import EventBuffer
+
+    events = EventBuffer(size=3)
+    for i in range(1, 5):
+        events.publish(i, "streams", {"list": i})
+    assert events.latest_id == 4
+    assert [i for i, _ in events.after(2)] == [3, 4]
+    # Event 1 fell out of the buffer, only those who saw it can catch up
+    assert [i for i, _ in events.after(1)] == [2, 3, 4]
+    assert events.after(0) is None
+
+    snapshot = lambda: (5, events.encode(5, "streams", {"list": 5}))
+    subscriber = events.subscribe(3, snapshot)
+    assert next(subscriber) == b"retry: 2000\n\n"
+    assert next(subscriber) == b'id: 4\nevent: streams\ndata: {"list":4}\n\n'
+
+    subscriber = events.subscribe(0, snapshot)
+    next(subscriber)
+    assert next(subscriber) == b'id: 5\nevent: streams\ndata: {"list":5}\n\n'
+    # The current state went to this subscriber only
+    assert events.latest_id == 4
+    # Idle subscribers get a keepalive, not the current state again
+    subscriber = events.subscribe(None, snapshot, keepalive=0.01)
+    next(subscriber), next(subscriber)
+    assert next(subscriber) == b": keepalive\n\n"
+    # The events following the id of the current state are still sent
+    events.publish(6, "streams", {"list": 6})
+    assert next(subscriber) == b'id: 6\nevent: streams\ndata: {"list":6}\n\n'
+
+    # A state whose version wasn't published as an event (e.g. a new health)
+    # resumes with the next event
+    events = EventBuffer(size=3)
+    events.publish(2, "streams", {"list": 2})
+    assert [i for i, _ in events.after(1)] == [2] and events.after(2) == []
+
+    # Event ids of another epoch (from before a restart) are not resumed
+    events = EventBuffer(epoch="boot")
+    assert events.publish(1, "streams", {}).startswith(b"id: boot-1\n")
+    assert events.parse_id("boot-1") == 1
+    assert events.parse_id("1") is None and events.parse_id("other-1") is None
+    assert events.parse_id(None) is None and events.parse_id("boot-x") is None
+
+
+def test_api_caching(server):
+    from streamviewer.streams import Stream
+    client = server.app.test_client()
+    response = client.get("/api/streams")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200 and etag == '"{}-{}"'.format(server.BOOT_ID, server.streamlist.version)
+    assert response.headers["Cache-Control"] == "max-age=1"
+
+    # Revalidated without serializing anything
+    response = client.get("/api/streams", headers={"If-None-Match": 'W/"other", ' + etag})
+    assert response.status_code == 304 and response.headers["ETag"] == etag and response.data == b""
+
+    server.streamlist.add_stream(Stream().set_key("api-caching"))
+    response = client.get("/api/streams/api-caching", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    detail = response.get_json()
+    assert detail["key"] == "api-caching" and isinstance(detail["started"], float) and "password" not in detail
+    # The first page is serialized once per version, in the detail projection
+    builds = server.streamlist.builds
+    streams = client.get("/api/streams").get_json()["streams"]
+    assert client.get("/api/streams").get_json()["streams"] == streams and server.streamlist.builds == builds + 1
+    assert [s for s in streams if s["key"] == "api-caching"] == [detail]
+    assert client.get("/api/streams?projection=list").get_json()["streams"][-1] == {"key": "api-caching", "viewcount": 0, "started": detail["started"]}
+    assert client.get("/api/streams?projection=other").status_code == 400
+    assert client.get("/api/streams?cursor=garbage").status_code == 400
+    assert client.get("/api/streams/api-caching", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    response = client.get("/api/streams/missing")
+    assert response.status_code == 404 and "ETag" in response.headers
+    # The first event of /events/streams carries the list of its version
+    version, message = server.events_snapshot()
+    assert version == server.streamlist.version and b'["api-caching",0,' in message
+
+    # Without federation there is no remote list to poll, /api/origins is
+    # cached like the rest of the API anyway
+    assert b"remote_streamlist" not in client.get("/").data
+    response = client.get("/api/origins")
+    assert response.get_json() == {"origins": [], "streams": []} and response.headers["Cache-Control"] == "max-age=1"
+    assert client.get("/api/origins", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    with server.app.test_request_context(headers={"If-None-Match": '"a", "b"'}):
+        assert server.api_not_modified('"b"')[1] == 304
+        assert server.api_not_modified('"c"') is None
+
+
+def test_latency_report_bounds(server):
+    import time
+    from streamviewer.streams import Stream
+    server.streamlist.add_stream(Stream().set_key("latency-bounds"))
+    client = server.socketio.test_client(server.app)
+    client.emit("latency_report", {"key": "latency-bounds", "samples": [0.5] * 100000, "stalls": 10 ** 9, "seconds": 10 ** 9})
+    client.emit("latency_report", {"key": "latency-bounds", "samples": [], "stalls": -5, "seconds": -5})
+    client.disconnect()
+    _, current, _ = server.latency.windows("latency-bounds", time.monotonic())
+    max_seconds = 2 * server.config["application"]["latency_report_interval"]
+    assert len(current.latency) == server.latency.max_samples
+    assert current.stalls == max_seconds and current.seconds == max_seconds
+    assert current.reports == 2
+
+
+def test_join_catches_up(server):
+    client = server.socketio.test_client(server.app)
+    client.get_received()
+    # A page rendered with the current version missed nothing
+    client.emit("join", {"key": "foo", "version": server.streamlist.version})
+    assert [e["name"] for e in client.get_received()] == ["viewercount"]
+    # Pages of an older version get the stream info with the join
+    client.emit("join", {"key": "foo", "version": server.streamlist.version - 1})
+    received = {e["name"]: e["args"][0] for e in client.get_received()}
+    assert received["stream_info"]["key"] == "foo" and received["stream_info"]["version"] == server.streamlist.version
+    client.emit("leave", {"key": "foo"})
+    client.emit("leave", {"key": "foo"})
+    client.disconnect()
+
+
+def test_stream_list_reply(server):
+    first = server.socketio.test_client(server.app)
+    second = server.socketio.test_client(server.app)
+    first.get_received()
+    second.get_received()
+    # The list goes only to the session asking for it
+    first.emit("connect_list")
+    first.emit("stream_list")
+    assert [e["name"] for e in first.get_received()] == ["stream_list", "stream_list"]
+    assert second.get_received() == []
+    first.disconnect()
+    second.disconnect()
+
+
+def test_publish_needs_config(server, monkeypatch):
+    client = server.app.test_client()
+    assert server.monitor.streamlist_ready and "streamlist" not in server.monitor.failed_checks()
+    monkeypatch.setattr(server.monitor, "streamlist_ready", False)
+    response = client.post("/on_publish", base_url="http://localhost", data={"name": "publish-broken-config"})
+    assert response.status_code == 403 and server.streamlist.get_stream("publish-broken-config") is None
+    monkeypatch.setattr(server.monitor, "streamlist_ready", True)
+    response = client.post("/on_publish", base_url="http://localhost", data={"name": "publish-broken-config"})
+    assert response.status_code == 201
+
+
+def test_refused_session(server, monkeypatch):
+    import json
+    client = server.socketio.test_client(server.app)
+    client.disconnect()
+    sent = []
+    send_packet = server.socketio.server._send_packet
+    def record(eio_sid, pkt):
+        sent.append(pkt.encode())
+        send_packet(eio_sid, pkt)
+    monkeypatch.setattr(server.socketio.server, "_send_packet", record)
+    monkeypatch.setattr(server.admission, "admit", lambda: 5.0)
+    client.connect()
+    assert not client.is_connected()
+    # The CONNECT_ERROR packet, socket.io clients get data as error.data
+    assert sent[-1][0] == "4"
+    assert json.loads(sent[-1][1:]) == {"message": "busy", "data": {"retry_after": 5.0}}
+
+
+def test_auth_archive(server, monkeypatch):
+    from streamviewer.streams import Stream
+    from streamviewer.tokens import token_cookie
+    monkeypatch.setattr(server, "hls_tokens", "unlisted")
+    server.streamlist.add_stream(Stream().set_key("auth-listed"))
+    client = server.app.test_client()
+    def auth(uri, token=None):
+        if token is not None:
+            client.set_cookie("localhost", token_cookie("auth-gone"), token)
+        return client.get("/auth/hls", base_url="http://localhost", headers={"X-Original-URI": uri}).status_code
+
+    assert auth("/archive/auth-listed/20210101-120000/auth-listed.m3u8") == 204
+    # Nothing is known about the stream of this archive anymore
+    assert auth("/archive/auth-gone/20210101-120000/auth-gone-1.ts") == 403
+    assert auth("/archive/auth-gone/20210101-120000/auth-gone-1.ts", server.viewing_tokens.issue("auth-gone")) == 204
+    assert auth("/hls/auth-gone.m3u8", server.viewing_tokens.issue("auth-gone")) == 403
+
+
+# Drives streamviewer.asgi:app with ASGI messages, like uvicorn would
+ASGI_CLIENT = '''
+import sys
+import json
+import asyncio
+from streamviewer import asgi
+
+async def request(method, path, query="", body=b"", messages=None):
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": query.encode(),
+             "root_path": "", "client": ("127.0.0.1", 40000), "server": ("localhost", 80),
+             "headers": [(b"host", b"localhost"), (b"content-length", str(len(body)).encode())]}
+    sent = []
+    received = []
+    disconnect = asyncio.Event()
+    async def receive():
+        if not received:
+            received.append(True)
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+    async def send(message):
+        sent.append(message)
+        if len(sent) == messages:
+            disconnect.set()
+    await asyncio.wait_for(asgi.app(scope, receive, send), 10)
+    return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:]).decode()
+
+async def main():
+    result = {"api": await request("GET", "/api/streams")}
+    # The browser goes away after the retry and the snapshot
+    result["events"] = await request("GET", "/events/streams", messages=3)
+    _, opened = await request("GET", "/socket.io/", "EIO=4&transport=polling")
+    query = "EIO=4&transport=polling&sid=" + json.loads(opened[1:])["sid"]
+    await request("POST", "/socket.io/", query, b"40")
+    _, connected = await request("GET", "/socket.io/", query)
+    sid = json.loads(connected[2:])["sid"]
+    await request("POST", "/socket.io/", query, b'42["join",{"key":"foo"}]')
+    result["rooms"] = asgi.server.socketio.server.rooms(sid)
+    print(json.dumps(result))
+    sys.stdout.flush()
+
+asyncio.run(main())
+'''
+
+
+def test_asgi_app():
+    import os
+    import sys
+    import json
+    import subprocess
+    pytest.importorskip("a2wsgi")
+    pytest.importorskip("socketio")
+    # streamviewer.server is built for the engine when it is imported, the
+    # other tests imported it for Flask-SocketIO already
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    output = subprocess.run([sys.executable, "-c", ASGI_CLIENT], env=env, cwd=root, stdout=subprocess.PIPE, timeout=60, check=True).stdout
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    assert result["api"][0] == 200
+    status, events = result["events"]
+    assert status == 200
+    assert events.startswith("retry: ") and "\nevent: streams\ndata: " in events
+    assert "foo" in result["rooms"]
+
+
+def test_profiler_samples(caplog):
+    import logging
+    from streamviewer.profiling import Profiler
+
+    profiler = Profiler(None, logging.getLogger("test")).set_sample_rate(1.0)
+    handler = profiler.profiled(lambda x: sum(range(x)))
+    # Disabled, nothing gets sampled
+    assert handler(10) == 45
+    assert profiler.samples == 0
+
+    profiler.enabled = True
+    assert handler(10) == 45
+    assert handler(10) == 45
+    assert profiler.status()["samples"] == 2
+    with caplog.at_level(logging.INFO, logger="test"):
+        profiler.dump()
+    assert "Profile of 2 sampled" in caplog.text
+    assert profiler.samples == 0 and profiler.stats is None
+
+
+def test_profiler_heartbeat():
+    import logging
+    from streamviewer.profiling import Profiler
+
+    class FakeSocketIO():
+        def __init__(self):
+            self.tasks = []
+        def start_background_task(self, task):
+            self.tasks.append(task)
+        def sleep(self, seconds):
+            profiler.enabled = False
+
+    socketio = FakeSocketIO()
+    profiler = Profiler(socketio, logging.getLogger("test"))
+    profiler.started = True
+    profiler.set_enabled()
+    assert socketio.tasks == [profiler.heartbeat] and profiler.beating
+    # Disabling profiling stops the heartbeat, enabling it starts it again
+    profiler.heartbeat()
+    assert not profiler.beating
+    profiler.set_enabled()
+    assert socketio.tasks == [profiler.heartbeat, profiler.heartbeat]
+
+
+def test_profiling_needs_secret(server, monkeypatch):
+    monkeypatch.setattr(server.profiler, "sample_rate", server.profiler.sample_rate)
+    client = server.app.test_client()
+    assert client.get("/profiling", base_url="http://localhost").status_code == 200
+    assert client.post("/profiling?sample_rate=0.5", base_url="http://localhost").status_code == 403
+    monkeypatch.setitem(server.config["application"], "profiling_secret", "secret")
+    assert client.post("/profiling?sample_rate=0.5", base_url="http://localhost", headers={"X-Profiling-Secret": "wrong"}).status_code == 403
+    assert client.post("/profiling?sample_rate=0.5", base_url="http://example.com", headers={"X-Profiling-Secret": "secret"}).status_code == 403
+    response = client.post("/profiling?sample_rate=0.5", base_url="http://localhost", headers={"X-Profiling-Secret": "secret"})
+    assert response.status_code == 200 and response.get_json()["sample_rate"] == 0.5
+
+
+def test_rtmp_stat_ingest():
+    import io
+    import logging
+    from streamviewer.streams import Stream, StreamList
+    from streamviewer.rtmpstat import RTMPStat, parse_stat
+
+    def stat(bw_in):
+        return io.BytesIO("""<rtmp><server>
+            <application><name>other</name><live><stream><name>foo</name><publishing/></stream></live></application>
+            <application><name>live</name><live>
+                <stream><name>foo</name><time>60000</time><bw_in>{}</bw_in>
+                    <meta><video><width>1280</width><height>720</height><codec>H264</codec></video></meta>
+                    <nclients>1</nclients><publishing/></stream>
+                <stream><name>idle</name><time>1000</time></stream>
+            </live></application>
+        </server></rtmp>""".format(bw_in).encode())
+
+    metrics = parse_stat(stat(2500000), "live")
+    assert list(metrics.keys()) == ["foo"]
+    assert metrics["foo"]["bitrate"] == 2500 and metrics["foo"]["height"] == 720
+
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(10).set_free_choice(True)
+    streamlist.add_stream(Stream().set_key("foo"))
+    rtmp_stat = RTMPStat(None, logging.getLogger("test"), "http://127.0.0.1/stat")
+    bitrates = iter([2500000, 2600000, 4000000])
+    rtmp_stat.fetch = lambda: parse_stat(stat(next(bitrates)), "live")
+    assert rtmp_stat.update(streamlist) == 1
+    version = streamlist.version
+    # Jitter of the bitrate is not published
+    assert rtmp_stat.update(streamlist) == 0
+    assert streamlist.version == version
+    assert rtmp_stat.update(streamlist) == 1
+    assert streamlist.get_stream("foo").to_wire_dict()["ingest"]["bitrate"] == 4000
+
+
+def test_latency_stats():
+    from streamviewer.latency import QuantileSketch, LatencyStats
+
+    sketch = QuantileSketch()
+    for i in range(1, 1001):
+        sketch.add(i / 100)
+    assert abs(sketch.quantile(0.5) - 5.0) < 5.0 * 0.02 + 0.01
+    assert abs(sketch.quantile(0.95) - 9.5) < 9.5 * 0.02 + 0.01
+    # Bounded by the number of buckets, not the number of values
+    assert len(sketch.buckets) < 200
+
+    latency = LatencyStats().set_window(300)
+    assert latency.summary("foo") is None
+    latency.report("foo", [2.0, 3.0, 4.0], stalls=1, seconds=30)
+    latency.report("foo", [3.0], stalls=0, seconds=30)
+    summary = latency.summary("foo")
+    assert summary["reports"] == 2 and summary["stalls_per_minute"] == 1.0
+    assert abs(summary["p50"] - 3.0) < 0.1
+    assert list(latency.summaries().keys()) == ["foo"]
+
+    latency.report_first_frame("bar", 1.5)
+    summary = latency.summary("bar")
+    assert summary["reports"] == 0 and abs(summary["first_frame_p50"] - 1.5) < 0.05
+
+
+def test_reserved_prefixes():
+    import logging
+    from streamviewer.streams import Stream, StreamList
+
+    config = {"stream": {"key": [
+        {"name": "team-*", "password": "1234", "quota": 2},
+        {"name": "team-a-*", "password": "abcd"},
+        {"name": "foo"},
+    ]}}
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(100).set_free_choice(True).add_streams_from_config(config)
+    # Only the exact name is created up front
+    assert [s.key for s in streamlist.streams] == ["foo"]
+    assert len(streamlist.reservations) == 2
+    assert streamlist.reservations.match("team-a-x").pattern == "team-a-*"
+    assert streamlist.reservations.match("team-b").pattern == "team-*"
+    assert streamlist.reservations.match("teams") is None
+
+    assert not streamlist.add_stream(Stream().set_key("team-a-x").set_password("1234"))
+    assert streamlist.add_stream(Stream().set_key("team-a-x").set_password("abcd"))
+    assert streamlist.add_stream(Stream().set_key("team-b").set_password("1234"))
+    assert streamlist.add_stream(Stream().set_key("team-c").set_password("1234"))
+    # The quota of team-* is used up
+    assert not streamlist.add_stream(Stream().set_key("team-d").set_password("1234"))
+    assert streamlist.add_stream(Stream().set_key("bar"))
+
+    # Reserved streams stay protected after they end
+    streamlist.remove_stream("team-b")
+    assert streamlist.get_stream("team-b").protected
+    assert not streamlist.add_stream(Stream().set_key("team-b"))
+    assert streamlist.add_stream(Stream().set_key("team-b").set_password("1234"))
+
+    # An ended stream doesn't count for the quota, once its protection period
+    # is over it is dropped (the reservation still protects the key)
+    streamlist.set_password_protection_period(1)
+    streamlist.remove_stream("team-c")
+    assert streamlist.add_stream(Stream().set_key("team-d").set_password("1234"))
+    streamlist.add_stream(Stream().set_key("baz"))
+    assert not streamlist.get_stream("team-c").active
+    streamlist.set_password_protection_period(0)
+    streamlist.add_stream(Stream().set_key("qux"))
+    assert streamlist.get_stream("team-c") is None
+    streamlist.remove_stream("team-d")
+    assert not streamlist.add_stream(Stream().set_key("team-c"))
+    assert streamlist.add_stream(Stream().set_key("team-c").set_password("1234"))
+    # Streams from the config are never dropped
+    assert streamlist.get_stream("foo") is not None
+
+
+def test_viewing_tokens():
+    from streamviewer.tokens import ViewingTokens, hls_stream_key, archive_stream_key, uri_token
+
+    tokens = ViewingTokens("secret").set_lifetime(3600)
+    token = tokens.issue("foo", now=1000)
+    # Everyone within the granularity gets the same token
+    assert tokens.issue("foo", now=1010) == token
+    assert tokens.verify("foo", token, now=2000)
+    assert tokens.verify("foo", token, now=2000)
+    assert tokens.stats()["hits"] == 1
+    assert not tokens.verify("bar", token, now=2000)
+    assert not tokens.verify("foo", token, now=5000)
+    assert not tokens.verify("foo", "garbage", now=2000)
+    assert not tokens.verify("foo", token + "ä", now=2000)
+    assert not ViewingTokens("other").verify("foo", token, now=2000)
+
+    assert hls_stream_key("/hls/team-a-1.m3u8?token=x") == "team-a-1"
+    assert hls_stream_key("/hls/team-a-1-12.ts") == "team-a-1"
+    assert hls_stream_key("/hls/") is None
+    assert archive_stream_key("/archive/team%20a/20210101-120000/team%20a-3.ts") == "team a"
+    assert archive_stream_key("/recordings/foo/1/foo.m3u8?token=x", "/recordings/") == "foo"
+    assert archive_stream_key("/archive/foo/foo.m3u8") is None
+    assert archive_stream_key("/hls/foo.m3u8") is None
+    assert uri_token("/hls/foo.m3u8?token=x") == "x"
+
+
+def test_archiver(tmp_path):
+    import os
+    import logging
+    from streamviewer.streams import Stream, StreamList
+    from streamviewer.archive import Archiver
+
+    hls_path = tmp_path / "hls"
+    hls_path.mkdir()
+    (hls_path / "foo.m3u8").write_text("#EXTM3U\n#EXT-X-MEDIA-SEQUENCE:3\n#EXTINF:3.0,\nfoo-3.ts\n#EXTINF:2.5,\nfoo-4.ts\n#EXTINF:3.0,\nfoo-5.ts\n")
+    for n in [4, 5]:
+        (hls_path / "foo-{}.ts".format(n)).write_bytes(b"\x47" * 188)
+
+    archiver = Archiver(logging.getLogger("test"), str(hls_path), str(tmp_path / "archive"))
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(10).set_free_choice(True).set_archiver(archiver)
+    streamlist.add_stream(Stream().set_key("foo"))
+    streamlist.remove_stream("foo")
+    key, ended = archiver.queue.get_nowait()
+    assert key == "foo"
+
+    playlist = archiver.write(key, ended)
+    # foo-3.ts was rotated away already
+    assert playlist.read_text().splitlines()[-4:] == ["foo-4.ts", "#EXTINF:3.000,", "foo-5.ts", "#EXT-X-ENDLIST"]
+    assert os.stat(playlist.parent / "foo-4.ts").st_ino == os.stat(hls_path / "foo-4.ts").st_ino
+    assert archiver.latest("foo") == "/archive/foo/" + playlist.parent.name
+    assert archiver.write("../foo", ended) is None
+    assert archiver.write("foo\0bar", ended) is None and archiver.write("", ended) is None
+    # Playlists that aren't UTF-8 don't end a worker
+    (hls_path / "bar.m3u8").write_bytes(b"#EXTM3U\n#EXTINF:3.0,\nbar-\xff.ts\n#EXTINF:3.0,\nfoo-4.ts\n")
+    assert archiver.try_write("bar", ended).read_text().splitlines()[-2:] == ["foo-4.ts", "#EXT-X-ENDLIST"]
+    archiver.write = lambda key, ended: 1 / 0
+    assert archiver.try_write("bar", ended) is None and archiver.failed == 1
+
+
+def test_sweeper(tmp_path, monkeypatch):
+    import os
+    import time
+    import logging
+    from streamviewer.streams import Stream, StreamList
+    from streamviewer.sweeper import Sweeper
+
+    old = time.time() - 7200
+    for name in ["live.m3u8", "live-1.ts", "gone.m3u8", "gone-1.ts", "fresh-1.ts", "other.txt"]:
+        (tmp_path / name).write_bytes(b"x" * 10)
+        if name != "fresh-1.ts":
+            os.utime(tmp_path / name, (old, old))
+
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(10).set_free_choice(True)
+    streamlist.add_stream(Stream().set_key("live"))
+    sweeper = Sweeper(logging.getLogger("test"), str(tmp_path)).set_grace(3600)
+
+    # A file that can't be removed doesn't stop the sweep
+    unlink = os.unlink
+    def failing_unlink(path):
+        if path.endswith("gone.m3u8"):
+            raise PermissionError(13, "Permission denied", path)
+        unlink(path)
+    monkeypatch.setattr(os, "unlink", failing_unlink)
+    sweep = sweeper.sweep(streamlist)
+    assert sweep["scanned"] == 6 and sweep["removed"] == 1 and sweep["reclaimed"] == 10 and sweep["errors"] == 1
+
+    monkeypatch.setattr(os, "unlink", unlink)
+    sweep = sweeper.sweep(streamlist)
+    assert sweep["removed"] == 1 and sweep["errors"] == 0 and sweeper.stats()["errors"] == 1
+    assert sorted(os.listdir(tmp_path)) == ["fresh-1.ts", "live-1.ts", "live.m3u8", "other.txt"]
+
+
+def test_webhooks(tmp_path):
+    import json
+    import logging
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from streamviewer.streams import Stream
+    from streamviewer.webhooks import WebhookDispatcher, Endpoint
+
+    class FakeReceiver(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        status = 200
+        batches = []
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if FakeReceiver.status == 200:
+                FakeReceiver.batches.append(json.loads(body)["events"])
+            self.send_response(FakeReceiver.status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeReceiver)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/hook".format(server.server_port)
+
+    logger = logging.getLogger("test")
+    endpoint = Endpoint(logger, url, events=["stream.started", "stream.stopped"]).set_spill_path(tmp_path)
+    webhooks = WebhookDispatcher(None, logger).set_max_batch(2).add_endpoint(endpoint)
+
+    # Queued events are sent in batches of max_batch
+    webhooks.stream_started(Stream().set_key("foo"))
+    webhooks.stream_started(Stream().set_key("bar"))
+    webhooks.stream_stopped("foo")
+    assert endpoint.stats()["queued"] == 3
+    assert webhooks.deliver(endpoint) and webhooks.deliver(endpoint)
+    assert [[e["key"] for e in b] for b in FakeReceiver.batches] == [["foo", "bar"], ["foo"]]
+    assert FakeReceiver.batches[1][0]["event"] == "stream.stopped"
+    assert not endpoint.has_pending()
+
+    # While the endpoint fails its events are spilled to disk by the
+    # background task, in order. Queueing never touches the disk
+    FakeReceiver.status = 503
+    webhooks.stream_started(Stream().set_key("baz"))
+    assert not webhooks.deliver(endpoint)
+    webhooks.stream_stopped("baz")
+    webhooks.stream_started(Stream().set_key("qux"))
+    assert endpoint.stats()["queued"] == 2
+    webhooks.spill(endpoint)
+    assert endpoint.stats()["queued"] == 0 and endpoint.stats()["spilled"] > 0
+    assert endpoint.failures == 1 and endpoint.backoff(300) <= 1
+
+    # A crash in the middle of a write leaves a corrupt line behind
+    spill_file, = tmp_path.iterdir()
+    with open(spill_file, "ab") as f:
+        f.write(b'{"id": "trunc')
+
+    # A restarted dispatcher finds the spilled events and delivers them, the
+    # corrupt line is skipped
+    FakeReceiver.status = 200
+    endpoint.close()
+    restarted = Endpoint(logger, url).set_spill_path(tmp_path)
+    webhooks = WebhookDispatcher(None, logger).set_max_batch(2).add_endpoint(restarted)
+    webhooks.stream_stopped("qux")
+    while restarted.has_pending():
+        assert webhooks.deliver(restarted)
+    assert [[e["key"] for e in b] for b in FakeReceiver.batches[2:]] == [["baz", "baz"], ["qux"], ["qux"]]
+    assert list(tmp_path.iterdir()) == []
+    assert restarted.stats()["delivered"] == 4 and restarted.stats()["corrupt"] == 1
+    assert restarted.stats()["last_lag"] >= 0
+    restarted.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_single_flight_builds():
+    import time
+    import logging
+    import threading
+    from streamviewer.streams import Stream, StreamList
+    streamlist = StreamList(logging.getLogger("test")).set_max_streams(100).set_free_choice(True)
+    streamlist.add_stream(Stream().set_key("foo"))
+    calls = []
+
+    def build(snapshot):
+        calls.append(snapshot.version)
+        time.sleep(0.1)
+        return [s.key for s in snapshot.streams]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(streamlist.cached("keys", build))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Concurrent callers share the one build of the version
+    assert calls == [streamlist.version]
+    assert results == [["foo"]] * 8 and all(r is results[0] for r in results)
+    assert streamlist.builds == 1
+
+    streamlist.add_stream(Stream().set_key("bar"))
+    assert streamlist.cached("keys", build) == ["foo", "bar"] and len(calls) == 2
+
+
+def test_session_admission():
+    from streamviewer.admission import SessionAdmission
+    admission = SessionAdmission().set_rate(10).set_burst(5)
+    admission.updated = 0.0
+    assert [admission.admit(now=0.0) for _ in range(5)] == [None] * 5
+
+    # Refused clients get consecutive slots at the rate
+    hints = [admission.admit(now=0.0) for _ in range(20)]
+    assert all(h is not None for h in hints)
+    assert 0.1 <= hints[0] <= 0.12 and 2.0 <= hints[-1] <= 2.4
+    assert admission.stats()["refused"] == 20
+
+    # The bucket refills at the rate
+    assert admission.admit(now=0.5) is None
+    assert SessionAdmission().admit() is None
+    assert 1.0 <= SessionAdmission().set_reconnect_delay(1, 30).reconnect_hint() <= 3.0
+
+
+class StreamListModel():
+    """
+    Reference model of the admission rules of the StreamList, for
+    test_streamlist_model. Streams are plain dicts, time is a number.
+    Reservations are dicts with a prefix, password, unlisted flag and quota
+    """
+    def __init__(self, max_streams, free_choice, period, reservations=()):
+        self.max_streams = max_streams
+        self.free_choice = free_choice
+        self.period = period
+        self.reservations = list(reservations)
+        self.streams = []
+        # Keys of the streams created under a reservation, and the ones of
+        # them that ended in the order they ended
+        self.materialized = set()
+        self.expiring = []
+        self.pruned = 0
+
+    def get(self, key):
+        return next((s for s in self.streams if s["key"] == key), None)
+
+    def unprotected(self, s, now):
+        # The password of an inactive stream protects its key for the period
+        return not s["active"] and now - s["deactivated"] >= self.period
+
+    def reservation(self, key):
+        # The longest matching prefix wins
+        matches = [r for r in self.reservations if key.startswith(r["prefix"])]
+        return max(matches, key=lambda r: len(r["prefix"]), default=None)
+
+    def within_quota(self, key, reservation):
+        if reservation["quota"] is None:
+            return True
+        active = [s["key"] for s in self.streams if s["active"] and self.reservation(s["key"]) is reservation]
+        return len(active) - (key in active) < reservation["quota"]
+
+    def prune(self, now):
+        # Streams created under a reservation are dropped once their period
+        # is over, the ones ending first go first
+        while self.expiring:
+            s = self.get(self.expiring[0])
+            if s is not None and not s["active"] and not self.unprotected(s, now):
+                break
+            key = self.expiring.pop(0)
+            if s is not None and not s["active"] and key in self.materialized:
+                self.streams.remove(s)
+                self.materialized.discard(key)
+                self.pruned += 1
+
+    def publish(self, key, password, unlisted, now, protected=False):
+        self.prune(now)
+        active = sum(s["active"] for s in self.streams)
+        inactive_protected = sum(s["protected"] and not s["active"] for s in self.streams)
+        if active - inactive_protected >= self.max_streams:
+            return False
+        new = {"key": key, "active": not protected, "password": password, "protected": protected,
+               "unlisted": unlisted, "deactivated": now if protected else None, "viewcount": 0}
+        if protected:
+            self.streams.append(new)
+            return True
+        reservation = self.reservation(key)
+        if reservation is not None and not self.within_quota(key, reservation):
+            return False
+        existing = self.get(key)
+        if existing is not None:
+            valid = existing["password"] is None or existing["password"] == password
+            if existing["protected"] and not valid:
+                return False
+            if not (valid or self.unprotected(existing, now)):
+                return False
+            # A replacement brings its own password and flags
+            new["protected"] = bool(existing["protected"])
+            # The viewers stay on the page of the key
+            new["viewcount"] = existing["viewcount"]
+            self.streams[self.streams.index(existing)] = new
+            return True
+        if reservation is not None:
+            if reservation["password"] is not None and reservation["password"] != password:
+                return False
+            new.update(password=reservation["password"], protected=True,
+                       unlisted=unlisted or reservation["unlisted"])
+            self.streams.append(new)
+            self.materialized.add(key)
+            return True
+        if not self.free_choice:
+            return False
+        self.streams.append(new)
+        return True
+
+    def publish_done(self, key, now):
+        self.prune(now)
+        existing = self.get(key)
+        if existing is None:
+            return
+        if existing["protected"] and existing["active"] and key in self.materialized:
+            self.expiring.append(key)
+        if not existing["protected"] and (existing["password"] is None or self.unprotected(existing, now)):
+            self.streams.remove(existing)
+        else:
+            existing["active"] = False
+            existing["deactivated"] = now
+
+    def join(self, key):
+        existing = self.get(key)
+        if existing is not None:
+            existing["viewcount"] += 1
+            return existing["viewcount"]
+
+    def leave(self, key):
+        existing = self.get(key)
+        if existing is not None:
+            existing["viewcount"] = max(0, existing["viewcount"] - 1)
+            return existing["viewcount"]
+
+
+# Mean milliseconds an operation on a StreamList with STREAMLIST_BUDGET_SIZE
+# streams may take, generous enough for slow CI machines
+STREAMLIST_BUDGETS = {"publish": 2.0, "publish_done": 2.0, "join": 1.0, "leave": 1.0}
+STREAMLIST_BUDGET_SIZE = 1000
+
+
+def test_streamlist_model(monkeypatch):
+    """
+    Drive random operation sequences against the StreamList and the reference
+    model and compare them after every step. Set STREAMVIEWER_FUZZ_RUNS for
+    more runs, a failure names the seed to reproduce it with
+    """
+    import os
+    import time
+    import random
+    import logging
+    import datetime as dt
+    from types import SimpleNamespace
+    import streamviewer.streams
+    from streamviewer.streams import Stream, StreamList
+
+    class Clock(dt.datetime):
+        offset = 0.0
+        start = time.time()
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.fromtimestamp(cls.start + cls.offset, tz)
+
+    monkeypatch.setattr(streamviewer.streams, "dt", SimpleNamespace(datetime=Clock, timedelta=dt.timedelta))
+    logger = logging.getLogger("test")
+    # Keys under nested and separate reserved prefixes
+    keys = ["a1", "a2", "a3", "b1", "b2", "c1"]
+    prefixes = ["a", "a1", "b"]
+    passwords = [None, None, "1", "2"]
+
+    def run(seed, steps):
+        rng = random.Random(seed)
+        Clock.offset = 0.0
+        max_streams = rng.randint(1, 6)
+        free_choice = rng.random() < 0.7
+        minutes = rng.choice([0, 1, 10])
+        config = [{"name": k, "password": rng.choice(passwords)} for k in rng.sample(keys, rng.randint(0, 3))]
+        reservations = [{"prefix": p, "password": rng.choice(passwords), "unlisted": rng.random() < 0.3,
+                         "quota": rng.choice([None, 1, 2])} for p in rng.sample(prefixes, rng.randint(0, 2))]
+        entries = config + [{"name": r["prefix"] + "*", "password": r["password"], "unlisted": r["unlisted"],
+                             "quota": r["quota"]} for r in reservations]
+        rng.shuffle(entries)
+
+        streamlist = StreamList(logger).set_max_streams(max_streams).set_free_choice(free_choice)\
+                                       .set_password_protection_period(minutes)\
+                                       .add_streams_from_config({"stream": {"key": entries}})
+        model = StreamListModel(max_streams, free_choice, minutes * 60, reservations)
+        for c in entries:
+            if not c["name"].endswith("*"):
+                model.publish(c["name"], c["password"], False, 0.0, protected=True)
+
+        history = []
+        for _ in range(steps):
+            op, key = rng.choice(list(STREAMLIST_BUDGETS)), rng.choice(keys)
+            if rng.random() < 0.1:
+                Clock.offset += rng.choice([1, 59, 61, 601])
+            history.append((op, key, Clock.offset))
+            version, pruned = streamlist.version, model.pruned
+            if op == "publish":
+                password, unlisted = rng.choice(passwords), rng.random() < 0.2
+                history[-1] += (password, unlisted)
+                result = streamlist.add_stream(Stream().set_key(key).set_password(password).set_unlisted(unlisted))
+                expected = model.publish(key, password, unlisted, Clock.offset)
+                if not result and model.pruned == pruned:
+                    assert streamlist.version == version, history
+            elif op == "publish_done":
+                streamlist.remove_stream(key)
+                model.publish_done(key, Clock.offset)
+                result = expected = None
+            elif op == "join":
+                result, expected = streamlist.add_viewer(key), model.join(key)
+            else:
+                result, expected = streamlist.remove_viewer(key), model.leave(key)
+
+            message = "seed {}: {}".format(seed, history)
+            assert result == expected, message
+            if op in ["join", "leave"]:
+                # Viewers are published in batches, like the broadcaster does
+                assert streamlist.version == version, message
+                if rng.random() < 0.3:
+                    streamlist.publish_viewcounts()
+                    assert all(s.viewcount == streamlist.viewcount(s.key) for s in streamlist.streams), message
+            assert streamlist.version >= version, message
+            streams = list(streamlist.streams)
+            # Unique keys, in the same order and state as the model
+            assert len({s.key for s in streams}) == len(streams), message
+            assert [(s.key, s.active, s.password, bool(s.protected), bool(s.unlisted), streamlist.viewcount(s.key)) for s in streams] == \
+                   [(s["key"], s["active"], s["password"], s["protected"], s["unlisted"], s["viewcount"]) for s in model.streams], message
+            # Streams created under a reservation are known as such until dropped
+            assert streamlist.materialized == model.materialized, message
+            # Counts, lookups and the index agree with the streams
+            listed = [s.key for s in streams if s.active and not s.unlisted]
+            assert [s.key for s in streamlist.listed_streams()] == listed, message
+            assert len(streamlist.index) == len(listed), message
+            assert sorted(s.key for s in streamlist.page("started", limit=100)[0]) == sorted(listed), message
+            assert [row[0] for row in streamlist.wire_list()["streams"]] == listed, message
+            assert all(streamlist.get_stream(s.key) is s for s in streams), message
+            assert len(streamlist.active_streams()) == sum(s["active"] for s in model.streams), message
+
+    for seed in range(int(os.environ.get("STREAMVIEWER_FUZZ_RUNS", 40))):
+        run(seed, 150)
+
+    # Performance budgets, on a list with many streams
+    streamlist = StreamList(logger).set_max_streams(2 * STREAMLIST_BUDGET_SIZE).set_free_choice(True)
+    with streamlist.changes():
+        for i in range(STREAMLIST_BUDGET_SIZE):
+            streamlist.add_stream(Stream().set_key("stream-{}".format(i)))
+    operations = {
+        "publish": lambda i: streamlist.add_stream(Stream().set_key("new-{}".format(i))),
+        "publish_done": lambda i: streamlist.remove_stream("new-{}".format(i)),
+        "join": lambda i: streamlist.add_viewer("stream-{}".format(i)),
+        "leave": lambda i: streamlist.remove_viewer("stream-{}".format(i)),
+    }
+    for op, budget in STREAMLIST_BUDGETS.items():
+        started = time.perf_counter()
+        for i in range(100):
+            operations[op](i)
+        mean = (time.perf_counter() - started) * 10
+        assert mean < budget, "{} took {:.3f} ms on average with {} streams (budget {} ms)".format(op, mean, STREAMLIST_BUDGET_SIZE, budget)